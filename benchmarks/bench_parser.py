@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 –*-
+"""
+对比原有的 json.loads + 逐层查找 与 fulfillment_parser 的解析耗时
+
+用法：python benchmarks/bench_parser.py [直营店数量] [商品数量] [重复次数]
+      python benchmarks/bench_parser.py --archive <录制文件> [重复次数] [每组选择的商品数]
+
+--archive 使用recorder录制的真实响应，对比解析全部商品与只解析所选商品的耗时；
+每组选择的商品数默认为该组请求的全部商品，设置后只选择每组的前N个商品（模拟缩小监控范围后回放旧录制）
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fulfillment_parser import parse_stores, DEFAULT_STORES_PATH  # noqa: E402
+from recorder import read_archive  # noqa: E402
+
+HK_STORES_PATH = ("body", "stores")
+
+
+def build_store(index, parts):
+    """
+    构造与线上接口结构一致的直营店数据，包含扫描不需要的冗余字段
+    """
+    return {
+        "storeNumber": "R{:03d}".format(index),
+        "storeName": "Store {}".format(index),
+        "storeEmail": "store{}@apple.com".format(index),
+        "reservationUrl": "https://www.apple.com/retail/store{}".format(index),
+        "makeReservationUrl": "https://www.apple.com/retail/store{}".format(index),
+        "storeImageUrl": "https://rtlimages.apple.com/cmc/dieter/store/4_3/R{:03d}.png".format(index),
+        "storelatitude": 22.28,
+        "storelongitude": 114.15,
+        "address": {"address": "Apple Store {}".format(index), "address2": "Street {}".format(index),
+                    "address3": None, "postalCode": "000000"},
+        "retailStore": {"storeNumber": "R{:03d}".format(index), "address": {"street": "Street {}".format(index)},
+                        "storeHours": [{"storeDays": "Mon - Sun", "storeTimings": "10:00 - 22:00"}]},
+        "partsAvailability": {
+            part: {
+                "storePickEligible": True,
+                "pickupSearchQuote": "Available today" if (index + part_index) % 17 == 0 else "Currently unavailable",
+                "pickupDisplay": "available" if (index + part_index) % 17 == 0 else "unavailable",
+                "partNumber": part,
+                "purchaseOption": "",
+                "messageTypes": {
+                    "regular": {
+                        "storePickupLabel": "Pickup:",
+                        "storeSearchEnabled": True,
+                        "storePickupProductTitle": "iPhone 17 Pro {} GB".format(part_index),
+                        "storePickupQuote": "Currently unavailable",
+                    }
+                },
+            } for part_index, part in enumerate(parts)
+        },
+    }
+
+
+def build_payload(region, store_count, part_count):
+    parts = ["M{:04d}ZA/A".format(i) for i in range(part_count)]
+    stores = [build_store(i, parts) for i in range(store_count)]
+    if region == "hk":
+        payload = {"head": {"status": "200"}, "body": {"stores": stores}}
+    else:
+        payload = {"head": {"status": "200"}, "body": {"content": {"pickupMessage": {"stores": stores}}}}
+    return json.dumps(payload, ensure_ascii=False).encode("utf-8"), parts
+
+
+def legacy_parse(content, region, parts):
+    json_result = json.loads(content.decode("utf-8"))
+    if region == "hk":
+        stores = json_result['body']['stores']
+    else:
+        stores = json_result['body']['content']['pickupMessage']['stores']
+    result = []
+    for item in stores:
+        for product_code in parts:
+            result.append((item['storeNumber'],
+                           item['partsAvailability'][product_code]['pickupSearchQuote'],
+                           item['partsAvailability'][product_code]['pickupDisplay'],
+                           item['partsAvailability'][product_code]['messageTypes']['regular']['storePickupProductTitle']))
+    return result
+
+
+def fast_parse(content, region, parts):
+    result = []
+    for item in parse_stores(content, HK_STORES_PATH if region == "hk" else DEFAULT_STORES_PATH):
+        for product_code in parts:
+            part = item.parts[product_code]
+            result.append((item.store_number, part.quote, part.display, part.title))
+    return result
+
+
+def measure(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def bench_archive(path, repeat, select=None):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "regions.json"), encoding="utf-8") as f:
+        regions = json.load(f)
+    samples = []
+    for records in read_archive(path):
+        for record in records:
+            if record["status"] != 200:
+                continue
+            parts = record["parts"][:select] if select else record["parts"]
+            samples.append((record["body"].encode("utf-8"), regions[record["region"]].get("stores_path"), parts))
+    if not samples:
+        print("{}中没有状态码为200的响应".format(path))
+        return
+
+    # 两种解析交替执行，避免先后顺序带来的缓存和频率差异
+    full = selected = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for content, stores_path, _ in samples:
+            parse_stores(content, stores_path)
+        full += time.perf_counter() - started
+        started = time.perf_counter()
+        for content, stores_path, parts in samples:
+            parse_stores(content, stores_path, parts)
+        selected += time.perf_counter() - started
+    full = full / repeat / len(samples) * 1000
+    selected = selected / repeat / len(samples) * 1000
+    print("{}: {}个响应 平均{:.1f}KB 每组选择{}商品: 全部商品={:.3f}ms 所选商品={:.3f}ms ({:+.1f}%)".format(
+        path, len(samples), sum(len(content) for content, _, _ in samples) / len(samples) / 1024,
+        "{}个".format(select) if select else "全部", full, selected, (selected - full) / full * 100))
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "--archive":
+        bench_archive(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 20,
+                      int(sys.argv[4]) if len(sys.argv) > 4 else None)
+        return
+
+    store_count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    part_count = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+
+    for region in ("cn", "hk"):
+        content, parts = build_payload(region, store_count, part_count)
+        assert legacy_parse(content, region, parts) == fast_parse(content, region, parts)
+        legacy = measure(lambda: legacy_parse(content, region, parts), repeat)
+        fast = measure(lambda: fast_parse(content, region, parts), repeat)
+        print("{} {}个直营店 x {}个商品 ({:.1f}KB): legacy={:.2f}ms parser={:.2f}ms".format(
+            region, store_count, part_count, len(content) / 1024, legacy, fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+# -*- coding: UTF-8 –*-
+"""
+离线扫描基准：生成不同直营店/商品数量的录制文件，通过回放走完整的扫描流程
+
+输出每秒扫描次数、各阶段耗时以及单次扫描的内存分配峰值
+
+用法：python benchmarks/bench_scan.py [扫描次数]
+"""
+
+import contextlib
+import gzip
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from bench_parser import build_payload  # noqa: E402
+from engine import ScanJob  # noqa: E402
+from fulfillment_parser import parse_stores  # noqa: E402
+from monitor import AppleStoreMonitor  # noqa: E402
+from scan_plan import ScanPlan  # noqa: E402
+from state import AvailabilityState  # noqa: E402
+
+CASES = [(10, 2), (50, 10), (200, 20), (500, 40)]
+
+
+def write_archive(path, region, store_count, part_count, scans):
+    content, parts = build_payload(region, store_count, part_count)
+    # 隔轮翻转一个单元格的货源，保证检测和通知阶段也有工作量
+    body = content.decode("utf-8")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for count in range(1, scans + 1):
+            scan_body = body
+            if count % 2 == 0:
+                scan_body = body.replace('"pickupDisplay": "unavailable"', '"pickupDisplay": "available"', 1)
+            f.write(json.dumps({
+                "time": time.time() + count, "job": "{}:bench".format(region), "region": region,
+                "location": "bench", "count": count, "parts": parts, "status": 200, "latency": 0.1,
+                "body": scan_body,
+            }, ensure_ascii=False) + "\n")
+    return content, parts
+
+
+def stage(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    scans = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    os.chdir(ROOT)
+    region = "hk"
+    monitor = AppleStoreMonitor(region)
+    region_info = monitor.regions_config[region]
+
+    print("{:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        "stores", "parts", "scans/s", "scan(ms)", "parse(ms)", "plan(ms)", "state(ms)", "peak(KB)"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for store_count, part_count in CASES:
+            path = os.path.join(tmp, "bench.jsonl.gz")
+            content, parts = write_archive(path, region, store_count, part_count, scans)
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                started = time.perf_counter()
+                AppleStoreMonitor(region).replay(path)
+                elapsed = time.perf_counter() - started
+
+            job = ScanJob(region, "bench", {part: [part] for part in parts}, chunk_size=0)
+            plan = ScanPlan(job, region_info)
+            state = AvailabilityState(None)
+            stores = parse_stores(content, region_info["stores_path"])
+            parse_ms = stage(lambda: parse_stores(content, region_info["stores_path"]), scans)
+            plan_ms = stage(lambda: plan.evaluate(stores), scans)
+            observations = [plan.cell(index) for index in range(len(plan.matrix))]
+            state_ms = stage(lambda: state.update(observations), scans)
+
+            tracemalloc.start()
+            plan.evaluate(parse_stores(content, region_info["stores_path"]))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print("{:>6} {:>6} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.1f}".format(
+                store_count, part_count, scans / elapsed, elapsed / scans * 1000, parse_ms, plan_ms, state_ms,
+                peak / 1024))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: UTF-8 –*-
+"""
+对比冷启动请求（每次新建连接）与连接池请求的延迟
+
+用法：python benchmarks/bench_transport.py [请求次数]
+"""
+
+import os
+import sys
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from transport import Transport  # noqa: E402
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    body = b'{"head": {"status": "200"}, "body": {"stores": []}}'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.send_header("Set-Cookie", "dssid2=stub; Path=/")
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(func, count):
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return samples
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    print("{:<8} avg={:.3f}ms p50={:.3f}ms p95={:.3f}ms".format(
+        name, statistics.mean(samples), samples[len(samples) // 2], samples[int(len(samples) * 0.95) - 1]))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # 使用localhost以包含域名解析开销
+    url = "http://localhost:{}/shop/fulfillment-messages".format(server.server_address[1])
+
+    try:
+        report("cold", measure(lambda: requests.get(url, timeout=5), count))
+        transport = Transport(timeout=5)
+        transport.get(url)
+        report("pooled", measure(lambda: transport.get(url), count))
+        transport.close()
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
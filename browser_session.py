@@ -0,0 +1,201 @@
+# -*- coding: UTF-8 –*-
+"""
+浏览器会话引导：启动一次无头浏览器获取真实的请求头和Cookie，交给普通HTTP请求使用
+
+浏览器只在启动监控时和货源接口返回拦截状态码（如403）时启动，取到会话后立即关闭，
+每次扫描仍然是普通的HTTP请求。未安装Playwright时退化为用普通HTTP请求访问商品页获取Cookie。
+
+安装Playwright：pip install playwright && playwright install chromium
+"""
+
+import threading
+import time
+import urllib.parse
+
+import requests
+
+from transport import get_transport
+from utils import Utils
+
+try:
+    from playwright.sync_api import sync_playwright
+except ImportError:
+    sync_playwright = None
+
+# 不转交给HTTP请求的请求头：由requests自行处理或者每次请求都会变化
+SKIPPED_HEADERS = {"host", "content-length", "cookie", "connection", "accept-encoding"}
+
+
+class SessionSnapshot:
+    """
+    某个地区的会话：请求头和Cookie，Cookie为 {"name", "value", "domain", "path"} 的列表
+    """
+
+    def __init__(self, headers, cookies, source):
+        self.headers = headers
+        self.cookies = cookies
+        self.source = source
+        self.captured_at = time.time()
+
+    def install(self, cookie_jar):
+        """
+        将Cookie写入共用连接池的Cookie罐，之后Apple下发的新Cookie由Cookie罐自动更新
+        """
+        for cookie in self.cookies:
+            cookie_jar.set(cookie["name"], cookie["value"], domain=cookie["domain"], path=cookie["path"])
+
+
+class SessionBootstrapper:
+    """
+    按地区维护浏览器会话，遇到拦截时在后台重新获取，同一地区同时只有一个浏览器在运行
+    """
+
+    def __init__(self, engine="playwright", headless=True, block_statuses=(403, 541), min_interval=300, timeout=30):
+        """
+        :param engine: playwright或http，未安装Playwright时自动使用http
+        :param headless: 是否使用无头模式
+        :param block_statuses: 视为被拦截、需要重新获取会话的状态码
+        :param min_interval: 同一地区两次重新获取会话的最短间隔（秒）
+        :param timeout: 浏览器打开页面的超时时间（秒）
+        """
+        if engine == "playwright" and sync_playwright is None:
+            Utils.log("未安装Playwright，改为使用普通HTTP请求获取会话")
+            engine = "http"
+        self.engine = engine
+        self.headless = headless
+        self.block_statuses = frozenset(block_statuses)
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.snapshots = {}
+        self.refreshed_at = {}
+        self.refreshing = set()
+        self.launches = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_configs(configs):
+        """
+        未启用browser_session时返回None
+        """
+        session_configs = configs.get("browser_session", {})
+        if not session_configs.get("enabled", False):
+            return None
+        return SessionBootstrapper(engine=session_configs.get("engine", "playwright"),
+                                   headless=session_configs.get("headless", True),
+                                   block_statuses=session_configs.get("block_statuses", [403, 541]),
+                                   min_interval=session_configs.get("min_interval", 300),
+                                   timeout=session_configs.get("timeout", 30))
+
+    @staticmethod
+    def entry_url(region_info):
+        """
+        用于建立会话的商品页，域名跟随base_url，指向模拟服务时同样有效
+        """
+        base = urllib.parse.urlparse(region_info['base_url'])
+        return "{}://{}{}".format(base.scheme, base.netloc, urllib.parse.urlparse(region_info['referer']).path)
+
+    @staticmethod
+    def probe_url(region_info, job):
+        """
+        在浏览器中发出一次货源请求，以获取浏览器请求货源接口时实际使用的请求头
+        """
+        params = job.params(job.product_codes[:1])
+        return "{}{}?{}".format(region_info['base_url'], region_info['fulfillment_endpoint'],
+                                urllib.parse.urlencode(params))
+
+    def apply(self, region, headers):
+        """
+        将会话的请求头合并到静态请求头上，Cookie已在获取会话时写入连接池的Cookie罐，不在请求头中设置
+        """
+        snapshot = self.snapshots.get(region)
+        if snapshot is None:
+            return headers
+        return dict(headers, **snapshot.headers)
+
+    def bootstrap(self, region, region_info, job, headers):
+        """
+        获取会话，失败时保留原来的会话
+        """
+        started = time.perf_counter()
+        try:
+            if self.engine == "playwright":
+                snapshot = self.capture_browser(region_info, job)
+            else:
+                snapshot = self.capture_http(region_info, headers)
+        except Exception as err:
+            Utils.log("获取{}会话失败：{}".format(region_info['name'], repr(err)))
+            return None
+        finally:
+            self.launches += 1
+            self.refreshed_at[region] = time.monotonic()
+        self.snapshots[region] = snapshot
+        snapshot.install(get_transport().session.cookies)
+        Utils.log("已获取{}会话（{}），{}个请求头，{}个Cookie，耗时{:.1f}秒".format(
+            region_info['name'], snapshot.source, len(snapshot.headers), len(snapshot.cookies),
+            time.perf_counter() - started))
+        return snapshot
+
+    def capture_browser(self, region_info, job):
+        captured = {}
+
+        def on_request(request):
+            if region_info['fulfillment_endpoint'] in request.url and not captured:
+                captured.update(request.headers)
+
+        with sync_playwright() as playwright:
+            browser = playwright.chromium.launch(headless=self.headless)
+            try:
+                context = browser.new_context(locale=region_info.get('language'))
+                page = context.new_page()
+                page.on("request", on_request)
+                page.goto(SessionBootstrapper.entry_url(region_info), wait_until="domcontentloaded",
+                          timeout=self.timeout * 1000)
+                page.evaluate("url => fetch(url, {credentials: 'include'}).then(r => r.status)",
+                              SessionBootstrapper.probe_url(region_info, job))
+                if not captured:
+                    captured["user-agent"] = page.evaluate("navigator.userAgent")
+                cookies = [{"name": cookie["name"], "value": cookie["value"], "domain": cookie["domain"],
+                            "path": cookie["path"]} for cookie in context.cookies(region_info['base_url'])]
+            finally:
+                browser.close()
+
+        headers = {key: value for key, value in captured.items()
+                   if key.lower() not in SKIPPED_HEADERS and not key.startswith(":")}
+        return SessionSnapshot(headers, cookies, "playwright")
+
+    def capture_http(self, region_info, headers):
+        session = requests.Session()
+        try:
+            response = session.get(SessionBootstrapper.entry_url(region_info), headers=headers, timeout=self.timeout)
+            if response.status_code >= 400:
+                raise Exception("商品页状态码：{}".format(response.status_code))
+            cookies = [{"name": cookie.name, "value": cookie.value, "domain": cookie.domain, "path": cookie.path}
+                       for cookie in session.cookies]
+        finally:
+            session.close()
+        return SessionSnapshot({}, cookies, "http")
+
+    def is_blocked(self, status_code):
+        return status_code in self.block_statuses
+
+    def refresh_async(self, region, region_info, job, headers):
+        """
+        在后台重新获取会话，同一地区正在获取或距上次获取不足min_interval秒时忽略
+        """
+        with self._lock:
+            if region in self.refreshing:
+                return False
+            if time.monotonic() - self.refreshed_at.get(region, float("-inf")) < self.min_interval:
+                return False
+            self.refreshing.add(region)
+
+        def run():
+            try:
+                Utils.log("{}货源接口返回拦截状态码，重新获取会话".format(region_info['name']))
+                self.bootstrap(region, region_info, job, headers)
+            finally:
+                with self._lock:
+                    self.refreshing.discard(region)
+
+        threading.Thread(target=run, name="session-{}".format(region), daemon=True).start()
+        return True
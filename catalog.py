@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 –*-
+"""
+商品目录：为products.json建立型号前缀和关键字索引，并支持从Apple商品页增量更新
+
+用法：
+    python catalog.py search <地区> <关键字...>
+    python catalog.py refresh [catalog_sources.json]
+
+catalog_sources.json 为商品页列表，每一项格式如下：
+    {
+      "region": "hk",
+      "product_type": "iPhone 17 Pro",
+      "classification": null,
+      "url": "https://www.apple.com/hk/shop/buy-iphone/iphone-17-pro",
+      "format": "regex",
+      "pattern": "..."
+    }
+format为json时响应体应为 {型号: 描述} 的对象；为regex时使用pattern（包含part和description两个命名分组）
+从页面中提取型号和描述，未配置pattern时使用DEFAULT_PATTERN。
+"""
+
+import bisect
+import json
+import os
+import re
+import sys
+
+from transport import get_transport
+from utils import Utils
+
+DEFAULT_PATTERN = (r'"partNumber"\s*:\s*"(?P<part>[A-Z0-9]+/[A-Z])"[^{}]*?'
+                   r'"(?:title|name)"\s*:\s*"(?P<description>[^"]+)"')
+TOKEN_SPLITTER = re.compile(r'[\s;；,，()（）\-/]+')
+
+
+class CatalogEntry:
+    __slots__ = ("region", "product_type", "classification", "part", "description")
+
+    def __init__(self, region, product_type, classification, part, description):
+        self.region = region
+        self.product_type = product_type
+        self.classification = classification
+        self.part = part
+        self.description = description
+
+    @property
+    def model(self):
+        """
+        与配置文件selected_products中的商品名称一致：有分类时为分类名，否则为产品类型
+        """
+        return self.classification or self.product_type
+
+
+class Catalog:
+    """
+    products.json的索引
+
+    每个商品的型号、产品类型、分类和描述被切分为小写的词，存入有序的词表，
+    查询时每个关键字按前缀在词表中二分查找，多个关键字取交集
+    """
+
+    def __init__(self, products_data):
+        self.products_data = products_data
+        self.entries = []
+        for region, products in products_data['regions'].items():
+            for product_type, product_data in products.items():
+                first_item_value = list(product_data.values())[0] if product_data else None
+                if isinstance(first_item_value, dict):
+                    for classification, models in product_data.items():
+                        for part, description in models.items():
+                            self.entries.append(CatalogEntry(region, product_type, classification, part, description))
+                else:
+                    for part, description in product_data.items():
+                        self.entries.append(CatalogEntry(region, product_type, None, part, description))
+
+        postings = {}
+        for index, entry in enumerate(self.entries):
+            text = " ".join(filter(None, [entry.part, entry.product_type, entry.classification, entry.description]))
+            for token in set(Catalog.tokenize(text) + [entry.part.lower()]):
+                postings.setdefault(token, set()).add(index)
+        self.tokens = sorted(postings)
+        self.postings = [postings[token] for token in self.tokens]
+
+    @staticmethod
+    def load(path='products.json'):
+        with open(path, encoding='utf-8') as f:
+            return Catalog(json.load(f))
+
+    @staticmethod
+    def tokenize(text):
+        return [token for token in TOKEN_SPLITTER.split(text.lower()) if token]
+
+    def match_prefix(self, prefix):
+        matched = set()
+        start = bisect.bisect_left(self.tokens, prefix)
+        for index in range(start, len(self.tokens)):
+            if not self.tokens[index].startswith(prefix):
+                break
+            matched |= self.postings[index]
+        return matched
+
+    def search(self, query, region=None, limit=50):
+        """
+        搜索商品，关键字可以是型号前缀、产品名称或描述中的词（如 "MG8J"、"pro 256gb 蓝色"）
+        """
+        result = None
+        for keyword in Catalog.tokenize(query):
+            matched = self.match_prefix(keyword)
+            if not matched:
+                # 中文描述没有空格分词，退化为子串匹配
+                matched = {index for index, entry in enumerate(self.entries) if keyword in entry.description.lower()}
+            result = matched if result is None else result & matched
+            if not result:
+                return []
+        entries = [self.entries[index] for index in sorted(result or [])]
+        if region is not None:
+            entries = [entry for entry in entries if entry.region == region]
+        return entries[:limit]
+
+
+class CatalogRefresher:
+    """
+    使用条件请求（ETag / If-Modified-Since）增量更新products.json，只改写有变化的条目
+    """
+
+    def __init__(self, products_path='products.json', cache_path='catalog_cache.json'):
+        self.products_path = products_path
+        self.cache_path = cache_path
+        with open(products_path, encoding='utf-8') as f:
+            self.products_data = json.load(f)
+        self.cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, encoding='utf-8') as f:
+                self.cache = json.load(f)
+
+    @staticmethod
+    def extract(source, text):
+        if source.get("format") == "json":
+            return dict(json.loads(text))
+        pattern = re.compile(source.get("pattern") or DEFAULT_PATTERN)
+        return {match.group("part"): match.group("description") for match in pattern.finditer(text)}
+
+    def section(self, source):
+        region = self.products_data['regions'].setdefault(source["region"], {})
+        section = region.setdefault(source["product_type"], {})
+        if source.get("classification"):
+            section = section.setdefault(source["classification"], {})
+        return section
+
+    def refresh_source(self, source):
+        """
+        :return: (新增条目数, 修改条目数)，页面未变化时返回 (0, 0)
+        """
+        url = source["url"]
+        validators = self.cache.get(url, {})
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        response = get_transport().get(url, headers=headers)
+        if response.status_code == 304:
+            return 0, 0
+        if response.status_code != 200:
+            raise Exception("商品页请求失败，状态码：{}".format(response.status_code))
+
+        section = self.section(source)
+        added = updated = 0
+        for part, description in CatalogRefresher.extract(source, response.text).items():
+            if part not in section:
+                added += 1
+            elif section[part] != description:
+                updated += 1
+            else:
+                continue
+            section[part] = description
+
+        self.cache[url] = {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+        return added, updated
+
+    def refresh(self, sources):
+        changed = False
+        for source in sources:
+            try:
+                added, updated = self.refresh_source(source)
+            except Exception as err:
+                Utils.log("更新商品目录失败：{}，{}".format(source["url"], err))
+                continue
+            Utils.log("{} {}：新增{}个，修改{}个".format(source["region"], source["url"], added, updated))
+            changed = changed or added > 0 or updated > 0
+
+        if changed:
+            CatalogRefresher.write_json(self.products_path, self.products_data)
+        CatalogRefresher.write_json(self.cache_path, self.cache)
+        return changed
+
+    @staticmethod
+    def write_json(path, data):
+        """
+        与仓库中products.json的格式一致（两空格缩进、保留中文、末尾换行），更新后只有变化的条目产生差异
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) >= 4 and args[1] == "search":
+        for entry in Catalog.load().search(" ".join(args[3:]), region=args[2]):
+            print("{}  {} {}".format(entry.part, entry.model, entry.description))
+    elif len(args) in (2, 3) and args[1] == "refresh":
+        with open(args[2] if len(args) == 3 else 'catalog_sources.json', encoding='utf-8') as f:
+            CatalogRefresher().refresh(json.load(f))
+    else:
+        print("""
+        Usage: python {0} search <region> <keywords...>
+               python {0} refresh [catalog_sources.json]
+        """.format(args[0]))
+        exit(1)
@@ -0,0 +1,438 @@
+# -*- coding: UTF-8 –*-
+"""
+分片扫描：协调进程按一致性哈希把 (地区, 取货区域, 商品分组) 的货源请求分配给多个工作进程
+
+工作进程只负责发送货源请求并返回原始响应，解析、检测和通知仍然在协调进程中统一完成。
+工作进程可以在本机由协调进程启动，也可以在其他主机上运行并主动连接协调进程：
+
+    python cluster.py worker <配置文件> [工作进程名称]
+
+工作进程断开（进程退出、网络中断或请求超时）后，它负责的分片会自动转移到哈希环上的下一个工作进程，
+重新连接后再迁回。
+"""
+
+import bisect
+import hashlib
+import ipaddress
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing.connection import Client, Listener
+
+import requests
+
+from utils import Utils
+
+
+class WorkerLost(Exception):
+    pass
+
+
+class HashRing:
+    """
+    带虚拟节点的一致性哈希环，增删节点时只有相邻区间的分片需要迁移
+    """
+
+    def __init__(self, replicas=100):
+        self.replicas = replicas
+        self.points = []
+        self.owners = []
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def add(self, node):
+        for replica in range(self.replicas):
+            point = HashRing.hash("{}#{}".format(node, replica))
+            index = bisect.bisect(self.points, point)
+            self.points.insert(index, point)
+            self.owners.insert(index, node)
+
+    def remove(self, node):
+        kept = [(point, owner) for point, owner in zip(self.points, self.owners) if owner != node]
+        self.points = [point for point, _ in kept]
+        self.owners = [owner for _, owner in kept]
+
+    def nodes(self, key):
+        """
+        按哈希环顺时针方向返回负责该分片的节点，第一个为首选节点，其余为故障时的备选节点
+        """
+        if not self.points:
+            return []
+        start = bisect.bisect(self.points, HashRing.hash(key))
+        result = []
+        for offset in range(len(self.owners)):
+            owner = self.owners[(start + offset) % len(self.owners)]
+            if owner not in result:
+                result.append(owner)
+        return result
+
+
+class RemoteResponse:
+    __slots__ = ("status_code", "content", "headers")
+
+    def __init__(self, status_code, content, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+
+class WorkerLink:
+    """
+    协调进程与单个工作进程之间的连接，请求按编号复用同一条连接，由后台线程接收响应
+    """
+
+    def __init__(self, name, connection, coordinator):
+        self.name = name
+        self.connection = connection
+        self.coordinator = coordinator
+        self.pending = {}
+        self.requests = 0
+        self.errors = 0
+        self.closed = False
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self.receive, name="cluster-{}".format(name), daemon=True)
+        self.thread.start()
+
+    def call(self, request, timeout):
+        future = Future()
+        with self._lock:
+            if self.closed:
+                raise WorkerLost(self.name)
+            request_id = next(self._ids)
+            self.pending[request_id] = future
+            self.requests += 1
+            try:
+                self.connection.send((request_id, request))
+                sent = True
+            except (OSError, EOFError, ValueError):
+                sent = False
+        if not sent:
+            self.close()
+            raise WorkerLost(self.name)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            # 超时的工作进程视为失联，断开后其分片转移到其他工作进程，存活的话会自动重连
+            Utils.log("工作进程{}请求超时，断开连接".format(self.name))
+            self.close()
+            raise WorkerLost(self.name)
+
+    def receive(self):
+        while True:
+            try:
+                request_id, ok, result = self.connection.recv()
+            except (OSError, EOFError):
+                break
+            future = self.pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                self.errors += 1
+                future.set_exception(remote_error(*result))
+        self.close()
+
+    def close(self):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending.clear()
+        try:
+            self.connection.close()
+        except OSError:
+            pass
+        for future in pending:
+            if not future.done():
+                future.set_exception(WorkerLost(self.name))
+        self.coordinator.remove(self)
+
+
+class Coordinator:
+    """
+    监听工作进程的连接，维护一致性哈希环，并把货源请求转发给负责对应分片的工作进程
+    """
+
+    def __init__(self, address, authkey, replicas=100, request_timeout=15):
+        """
+        :param address: 监听地址
+        :param authkey: 工作进程连接时使用的认证密钥
+        :param replicas: 每个工作进程在哈希环上的虚拟节点数
+        :param request_timeout: 等待工作进程返回响应的最长时间（秒）
+        """
+        self.authkey = authkey
+        self.request_timeout = request_timeout
+        self.ring = HashRing(replicas)
+        self.links = {}
+        self.processes = []
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self.thread = threading.Thread(target=self.accept, name="cluster-accept", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def from_configs(configs):
+        """
+        未配置cluster或listen时返回None；listen或connect为非本机地址时必须配置authkey，
+        只监听本机且未配置authkey时使用随机密钥，此时只有本机启动的工作进程能够连接
+        """
+        cluster_configs = configs.get("cluster", {})
+        if not cluster_configs.get("listen"):
+            return None
+        address = parse_address(cluster_configs["listen"])
+        authkey = cluster_authkey(cluster_configs)
+        if authkey is None:
+            for field in ("listen", "connect"):
+                if cluster_configs.get(field) and not is_loopback(parse_address(cluster_configs[field])[0]):
+                    raise ValueError("cluster.{}为非本机地址{}，必须配置cluster.authkey".format(
+                        field, cluster_configs[field]))
+            authkey = os.urandom(32)
+        coordinator = Coordinator(address, authkey=authkey,
+                                  replicas=cluster_configs.get("replicas", 100),
+                                  request_timeout=cluster_configs.get("request_timeout", 15))
+        local_workers = cluster_configs.get("local_workers", 0)
+        if local_workers > 0:
+            coordinator.spawn_local(local_workers, configs)
+            coordinator.wait_for_workers(local_workers, timeout=cluster_configs.get("startup_timeout", 30))
+        return coordinator
+
+    def accept(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as err:
+                if self.listener is None:
+                    return
+                Utils.log("工作进程连接失败：{}".format(err))
+                continue
+            try:
+                name = connection.recv()
+            except (OSError, EOFError):
+                connection.close()
+                continue
+            with self._lock:
+                old_link = self.links.get(name)
+            if old_link is not None:
+                old_link.close()
+            link = WorkerLink(name, connection, self)
+            with self._lock:
+                self.links[name] = link
+                self.ring.add(name)
+                self._changed.notify_all()
+            Utils.log("工作进程{}已加入，当前共{}个工作进程".format(name, len(self.links)))
+
+    def remove(self, link):
+        with self._lock:
+            if self.links.get(link.name) is not link:
+                return
+            del self.links[link.name]
+            self.ring.remove(link.name)
+            self._changed.notify_all()
+        Utils.log("工作进程{}已断开，其分片转移到其余{}个工作进程".format(link.name, len(self.links)))
+
+    def wait_for_workers(self, count, timeout=30):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while len(self.links) < count:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            return len(self.links)
+
+    def spawn_local(self, count, configs):
+        """
+        在本机启动工作进程
+        """
+        context = multiprocessing.get_context("spawn")
+        for index in range(count):
+            process = context.Process(target=run_worker,
+                                      args=(self.address, self.authkey, "local-{}".format(index),
+                                            configs.get("transport", {})),
+                                      name="worker-{}".format(index), daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def request(self, key, request):
+        """
+        将请求发给负责该分片的工作进程，工作进程失联时依次尝试哈希环上的下一个
+        """
+        tried = set()
+        while True:
+            with self._lock:
+                candidates = [name for name in self.ring.nodes(key) if name not in tried]
+                link = self.links.get(candidates[0]) if candidates else None
+            if link is None:
+                raise Exception("没有可用的工作进程")
+            try:
+                return link.call(request, self.request_timeout)
+            except WorkerLost:
+                tried.add(link.name)
+
+    def owner(self, key):
+        with self._lock:
+            nodes = self.ring.nodes(key)
+            return nodes[0] if nodes else None
+
+    def stats(self):
+        with self._lock:
+            return {name: {"requests": link.requests, "errors": link.errors, "pending": len(link.pending)}
+                    for name, link in self.links.items()}
+
+    def close(self):
+        listener = self.listener
+        self.listener = None
+        listener.close()
+        with self._lock:
+            links = list(self.links.values())
+        for link in links:
+            link.close()
+        # 工作进程只负责转发请求，没有需要保存的状态，直接结束后再统一等待退出
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + 1
+        for process in self.processes:
+            process.join(max(deadline - time.monotonic(), 0))
+
+
+class ShardedTransport:
+    """
+    货源请求的传输层，接口与transport.Transport的get一致，实际请求由工作进程发出
+    """
+
+    def __init__(self, coordinator, timeout=10):
+        self.coordinator = coordinator
+        self.timeout = timeout
+
+    @staticmethod
+    def shard_key(url, params):
+        """
+        分片键为请求地址、取货区域和商品分组，不包括每次变化的时间戳参数
+        """
+        return "{}|{}".format(url, "&".join("{}={}".format(key, value) for key, value in sorted(params.items())
+                                            if key != "_"))
+
+    def get(self, url, headers=None, params=None, timeout=None, proxies=None):
+        params = params or {}
+        status_code, content, response_headers = self.coordinator.request(
+            ShardedTransport.shard_key(url, params),
+            {"url": url, "headers": headers, "params": params, "timeout": timeout or self.timeout,
+             "proxies": proxies})
+        return RemoteResponse(status_code, content, response_headers)
+
+    def close(self):
+        self.coordinator.close()
+
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+
+def cluster_authkey(cluster_configs):
+    """
+    配置中的认证密钥，未配置时返回None
+    """
+    authkey = cluster_configs.get("authkey")
+    return authkey.encode("utf-8") if authkey else None
+
+
+def remote_error(error_type, message):
+    """
+    按工作进程返回的异常类型名还原异常，requests的异常还原为同一类型，以便代理重试等逻辑按类型处理
+    """
+    error_class = getattr(requests.exceptions, error_type, None)
+    if isinstance(error_class, type) and issubclass(error_class, requests.exceptions.RequestException):
+        return error_class(message)
+    return Exception("{}: {}".format(error_type, message))
+
+
+def run_worker(address, authkey, name, transport_configs=None, concurrency=8, reconnect_interval=3):
+    """
+    工作进程主循环：连接协调进程，并发执行收到的请求，断开后自动重连
+    """
+    from transport import Transport
+
+    transport = Transport.from_configs({"transport": transport_configs or {}})
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="worker")
+    while True:
+        try:
+            connection = Client(address, authkey=authkey)
+        except (OSError, EOFError, multiprocessing.AuthenticationError) as err:
+            Utils.log("工作进程{}连接协调进程失败：{}，{}秒后重试".format(name, err, reconnect_interval))
+            time.sleep(reconnect_interval)
+            continue
+        connection.send(name)
+        send_lock = threading.Lock()
+
+        def handle(request_id, request):
+            try:
+                response = transport.get(request["url"], headers=request["headers"], params=request["params"],
+                                         timeout=request["timeout"], proxies=request.get("proxies"))
+                reply = (request_id, True, (response.status_code, response.content, dict(response.headers)))
+            except Exception as err:
+                reply = (request_id, False, (type(err).__name__, str(err)))
+            with send_lock:
+                try:
+                    connection.send(reply)
+                except (OSError, EOFError):
+                    pass
+
+        try:
+            while True:
+                request_id, request = connection.recv()
+                executor.submit(handle, request_id, request)
+        except (OSError, EOFError):
+            Utils.log("工作进程{}与协调进程断开，{}秒后重连".format(name, reconnect_interval))
+            connection.close()
+            time.sleep(reconnect_interval)
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) in (3, 4) and args[1] == "worker":
+        with open(args[2], encoding="utf-8") as f:
+            worker_configs = json.load(f)
+        cluster_configs = worker_configs.get("cluster", {})
+        worker_authkey = cluster_authkey(cluster_configs)
+        if worker_authkey is None:
+            # 协调进程未配置authkey时使用随机密钥，只接受它自己启动的本机工作进程
+            Utils.log("未配置cluster.authkey，无法连接协调进程")
+            exit(1)
+        run_worker(parse_address(cluster_configs.get("connect") or cluster_configs["listen"]),
+                   worker_authkey,
+                   args[3] if len(args) == 4 else "{}-{}".format(socket.gethostname(), os.getpid()),
+                   worker_configs.get("transport", {}),
+                   cluster_configs.get("worker_concurrency", 8))
+    else:
+        print("""
+        Usage: python {} worker <config_file> [worker_name]
+        """.format(args[0]))
+        exit(1)
@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 –*-
+"""
+配置文件监听：Linux下使用inotify，其他平台或inotify不可用时按修改时间轮询
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from utils import Utils
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class ConfigWatcher:
+    """
+    监听配置文件的变化，变化后（合并短时间内的多次写入）在后台线程中调用callback(path)
+    """
+
+    def __init__(self, path, callback, poll_interval=2, debounce=0.2):
+        """
+        :param path: 配置文件路径
+        :param callback: 配置文件变化后的回调
+        :param poll_interval: 轮询模式下的检查间隔（秒）
+        :param debounce: 编辑器保存时往往连续写入多次，等待该时间（秒）内没有新的变化后再回调
+        """
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._stopped = threading.Event()
+        self._inotify_fd = ConfigWatcher.inotify_watch(os.path.dirname(self.path))
+        self.mode = "inotify" if self._inotify_fd is not None else "poll"
+        self.thread = threading.Thread(target=self.run, name="config-watcher", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def inotify_watch(directory):
+        """
+        监听配置文件所在的目录（编辑器通常先写临时文件再重命名覆盖），不可用时返回None
+        """
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                return None
+            mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            if libc.inotify_add_watch(fd, directory.encode(), mask) < 0:
+                os.close(fd)
+                return None
+            return fd
+        except (OSError, AttributeError):
+            return None
+
+    def signature(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def run(self):
+        last_signature = self.signature()
+        while not self._stopped.is_set():
+            if self._inotify_fd is not None:
+                if not self.wait_inotify(self.poll_interval):
+                    continue
+            else:
+                self._stopped.wait(self.poll_interval)
+            # 等待写入结束
+            while not self._stopped.is_set() and self.wait_changes(self.debounce):
+                pass
+            signature = self.signature()
+            if signature is None or signature == last_signature:
+                continue
+            last_signature = signature
+            try:
+                self.callback(self.path)
+            except Exception as err:
+                Utils.log("处理配置文件变化时出现异常：{}".format(repr(err)))
+
+    def wait_changes(self, timeout):
+        if self._inotify_fd is not None:
+            return self.wait_inotify(timeout)
+        signature = self.signature()
+        time.sleep(timeout)
+        return self.signature() != signature
+
+    def wait_inotify(self, timeout):
+        """
+        :return: 超时前配置文件是否有变化
+        """
+        readable, _, _ = select.select([self._inotify_fd], [], [], timeout)
+        if not readable:
+            return False
+        try:
+            data = os.read(self._inotify_fd, 64 * 1024)
+        except BlockingIOError:
+            return False
+        name = os.path.basename(self.path).encode()
+        matched = False
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if data[offset:offset + length].rstrip(b"\0") == name:
+                matched = True
+            offset += length
+        return matched
+
+    def close(self):
+        self._stopped.set()
+        self.thread.join(self.poll_interval + 1)
+        if self._inotify_fd is not None:
+            os.close(self._inotify_fd)
+            self._inotify_fd = None
@@ -0,0 +1,190 @@
+# -*- coding: UTF-8 –*-
+"""
+异步扫描引擎：在同一个事件循环中调度多个 (地区, 取货区域, 商品) 扫描任务
+"""
+
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from scan_log import logger
+from utils import Utils
+
+
+class ScanJob:
+    """
+    单个扫描任务，每个任务拥有独立的扫描间隔和计数
+    """
+
+    def __init__(self, region, location, selected_products, scan_interval=30, exclude_stores=None, chunk_size=10):
+        self.region = region
+        self.location = location
+        self.selected_products = selected_products
+        self.scan_interval = scan_interval
+        self.exclude_stores = exclude_stores or []
+        self.chunk_size = chunk_size
+        # 请求的目标域名，用于按域名限速
+        self.host = None
+        # 预编译的扫描计划，见scan_plan.ScanPlan
+        self.plan = None
+        # 共享该任务扫描结果的订阅者，见subscriptions.Subscriber
+        self.subscribers = []
+        # 扫描期间持有，重新加载配置时用于等待正在进行的扫描结束
+        self.lock = threading.Lock()
+        self.count = 1
+        # 最近一次所有分组都请求成功的时间戳
+        self.last_success = None
+
+    @property
+    def name(self):
+        return "{}:{}".format(self.region, self.location)
+
+    @property
+    def product_codes(self):
+        return list(self.selected_products.keys())
+
+    def chunks(self):
+        """
+        按chunk_size将商品型号切分为多组，每组单独请求
+        """
+        product_codes = self.product_codes
+        if self.chunk_size <= 0:
+            return [product_codes]
+        return [product_codes[i:i + self.chunk_size] for i in range(0, len(product_codes), self.chunk_size)]
+
+    def params(self, product_codes=None):
+        """
+        构造货源查询参数
+        """
+        params = {
+            "location": self.location,
+            "mt": "regular",
+        }
+        for code_index, product_code in enumerate(product_codes or self.product_codes):
+            params["parts.{}".format(code_index)] = product_code
+        return params
+
+    @staticmethod
+    def from_configs(configs, default_region='cn'):
+        """
+        从配置文件构造扫描任务列表
+
+        未配置jobs时沿用顶层的单地区配置，配置了jobs时每一项可覆盖顶层的同名字段
+        """
+        defaults = {
+            "region": configs.get("region", default_region),
+            "selected_area": configs.get("selected_area", ""),
+            "selected_products": configs.get("selected_products", {}),
+            "exclude_stores": configs.get("exclude_stores", []),
+            "scan_interval": configs.get("scan_interval", 30),
+            "chunk_size": configs.get("chunk_size", 10),
+        }
+        jobs = []
+        for job_configs in configs.get("jobs") or [{}]:
+            merged = dict(defaults, **job_configs)
+            jobs.append(ScanJob(merged["region"], merged["selected_area"], merged["selected_products"],
+                                merged["scan_interval"], merged["exclude_stores"], merged["chunk_size"]))
+        return jobs
+
+
+class ScanEngine:
+    """
+    在一个事件循环中并发运行多个扫描任务
+
+    阻塞的扫描函数被放到线程池中执行，单个任务的请求变慢或卡住时只影响该任务自身的节奏
+    """
+
+    def __init__(self, scan_func, jobs, scheduler, deadline=30, max_workers=None):
+        """
+        :param scan_func: 扫描函数，接收ScanJob，返回命中货源列表
+        :param jobs: 扫描任务列表
+        :param scheduler: ScanScheduler，负责计算每个任务的扫描间隔
+        :param deadline: 单次扫描的最长等待时间（秒），超时后任务直接进入下一轮
+        :param max_workers: 线程池大小，默认为任务数的两倍，为超时未返回的线程留出余量；
+                            运行中加入任务使任务数超过线程池大小的一半时，线程池扩大为任务数的两倍
+        """
+        self.scan_func = scan_func
+        self.jobs = jobs
+        self.scheduler = scheduler
+        self.deadline = deadline
+        self.max_workers = max_workers or max(len(jobs) * 2, 4)
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="scan")
+        self._stopped = None
+        self._loop = None
+        self.tasks = {}
+        # 扫描任务 -> 正在线程池中执行的扫描，超时后线程仍在阻塞时不再重复提交，避免占满线程池
+        self.inflight = {}
+
+    async def run_job(self, job):
+        loop = asyncio.get_running_loop()
+        while not self._stopped.is_set():
+            available_list = []
+            previous = self.inflight.get(job.name)
+            try:
+                if previous is not None and not previous.done():
+                    Utils.log("[{}] 上一次扫描仍未返回，跳过本轮".format(job.name))
+                else:
+                    future = self.inflight[job.name] = self.executor.submit(self.scan_func, job)
+                    available_list = await asyncio.wait_for(asyncio.wrap_future(future, loop=loop),
+                                                            timeout=self.deadline)
+            except asyncio.TimeoutError:
+                Utils.log("[{}] 第{}次扫描超过{}秒未完成，跳过本轮".format(job.name, job.count, self.deadline))
+            except Exception as err:
+                Utils.log("[{}] {}".format(job.name, err))
+
+            interval = self.scheduler.next_interval(job, available_list or [])
+            if len(available_list or []) == 0 and logger.detail:
+                Utils.log('[{}] {}秒后进行第{}次尝试，当前请求速率{}次/分钟...'.format(
+                    job.name, interval, job.count + 1, self.scheduler.rate_per_minute(job.host)))
+
+            # 次数自增
+            job.count += 1
+            try:
+                await asyncio.wait_for(self._stopped.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self):
+        self._stopped = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        for job in self.jobs:
+            self.tasks[job.name] = self._loop.create_task(self.run_job(job))
+        try:
+            await self._stopped.wait()
+            await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        finally:
+            for task in self.tasks.values():
+                task.cancel()
+            self.executor.shutdown(wait=False)
+
+    def add_job(self, job):
+        """
+        在运行中加入新的扫描任务，可以在其他线程中调用
+        """
+        def start():
+            self.jobs.append(job)
+            if len(self.jobs) * 2 > self.max_workers:
+                # 换用更大的线程池，旧线程池中正在进行的扫描照常完成
+                old_executor = self.executor
+                self.max_workers = len(self.jobs) * 2
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="scan")
+                old_executor.shutdown(wait=False)
+                Utils.log("扫描任务增加到{}个，扫描线程池扩大到{}".format(len(self.jobs), self.max_workers))
+            self.tasks[job.name] = self._loop.create_task(self.run_job(job))
+        self._loop.call_soon_threadsafe(start)
+
+    def remove_job(self, job):
+        """
+        在运行中移除扫描任务，正在进行的扫描会继续完成，可以在其他线程中调用
+        """
+        def cancel():
+            self.jobs.remove(job)
+            self.inflight.pop(job.name, None)
+            task = self.tasks.pop(job.name, None)
+            if task is not None:
+                task.cancel()
+        self._loop.call_soon_threadsafe(cancel)
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
@@ -0,0 +1,314 @@
+# -*- coding: UTF-8 –*-
+"""
+本地事件流：以Server-Sent Events推送结构化的货源变化事件，供下单脚本、看板等本地程序订阅
+
+- 每次扫描比较完货源矩阵后立即发布，不经过通知渠道的合并和限速
+- 每个客户端拥有独立的有界缓冲，客户端读得慢时丢弃最早的事件并发送overflow事件，不会拖慢扫描
+- 写出长时间阻塞的客户端会被断开，客户端可以带上Last-Event-ID重连以补发缓冲内的事件
+"""
+
+import collections
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils import Utils
+
+
+class StreamEvent:
+    __slots__ = ("id", "event", "job", "frame")
+
+    def __init__(self, event_id, event, job, data):
+        self.id = event_id
+        self.event = event
+        self.job = job
+        # 每个事件只序列化一次，所有客户端共用
+        self.frame = "id: {}\nevent: {}\ndata: {}\n\n".format(
+            event_id, event, json.dumps(data, ensure_ascii=False, separators=(",", ":"))).encode("utf-8")
+
+
+class StreamClient:
+    """
+    单个订阅连接的有界缓冲，发布方只做入队，永远不会被客户端阻塞
+    """
+
+    def __init__(self, address, buffer_size, jobs=None):
+        self.address = address
+        self.buffer_size = buffer_size
+        self.jobs = jobs
+        self.queue = collections.deque()
+        self.dropped = 0
+        self.total_dropped = 0
+        self.delivered = 0
+        self.closed = False
+        self.connected_at = time.time()
+        self._condition = threading.Condition()
+
+    def wants(self, event):
+        return self.jobs is None or event.job is None or event.job in self.jobs
+
+    def offer(self, event):
+        with self._condition:
+            if len(self.queue) >= self.buffer_size:
+                self.queue.popleft()
+                self.dropped += 1
+                self.total_dropped += 1
+            self.queue.append(event)
+            self._condition.notify()
+
+    def take(self, timeout):
+        """
+        :return: (事件列表, 自上次取出后丢弃的事件数)，超时或连接关闭时事件列表为空
+        """
+        with self._condition:
+            if not self.queue and not self.closed:
+                self._condition.wait(timeout)
+            events = list(self.queue)
+            self.queue.clear()
+            dropped, self.dropped = self.dropped, 0
+            return events, dropped
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify()
+
+    def stats(self):
+        return {
+            "address": self.address,
+            "jobs": sorted(self.jobs) if self.jobs is not None else None,
+            "queued": len(self.queue),
+            "delivered": self.delivered,
+            "dropped": self.total_dropped,
+            "connected_seconds": round(time.time() - self.connected_at, 1),
+        }
+
+
+class EventStream:
+    """
+    事件流服务：GET /events 订阅事件（可用?job=cn:北京 市 东城区过滤，可重复），
+    GET /snapshot 获取当前有货的全部单元格，GET /clients 查看各连接的缓冲情况
+    """
+
+    def __init__(self, host="127.0.0.1", port=9109, buffer_size=256, replay_size=1024, heartbeat=15,
+                 write_timeout=5):
+        """
+        :param buffer_size: 每个客户端缓冲的事件数上限，超出后丢弃最早的事件
+        :param replay_size: 保留的最近事件数，用于客户端带Last-Event-ID重连时补发
+        :param heartbeat: 没有事件时发送心跳注释的间隔（秒），用于保持连接和发现断开的客户端
+        :param write_timeout: 单次写出的超时时间（秒），超时的客户端会被断开
+        """
+        self.host = host
+        self.port = port
+        self.buffer_size = buffer_size
+        self.heartbeat = heartbeat
+        self.write_timeout = write_timeout
+        self.next_id = 1
+        self.recent = collections.deque(maxlen=replay_size)
+        # 扫描任务 -> {(直营店编号, 商品型号): 事件内容}
+        self.snapshot = {}
+        self.clients = set()
+        self.published = 0
+        self._lock = threading.Lock()
+        self.server = None
+
+    @staticmethod
+    def from_configs(configs):
+        """
+        未启用event_stream时返回None
+        """
+        stream_configs = configs.get("event_stream", {})
+        if not stream_configs.get("enabled", False):
+            return None
+        stream = EventStream(host=stream_configs.get("host", "127.0.0.1"),
+                             port=stream_configs.get("port", 9109),
+                             buffer_size=stream_configs.get("buffer_size", 256),
+                             replay_size=stream_configs.get("replay_size", 1024),
+                             heartbeat=stream_configs.get("heartbeat", 15),
+                             write_timeout=stream_configs.get("write_timeout", 5))
+        stream.serve()
+        return stream
+
+    def publish(self, event, data, job=None):
+        """
+        发布一个事件，只入队到各客户端的缓冲，不做任何网络写出
+        """
+        with self._lock:
+            stream_event = StreamEvent(self.next_id, event, job, data)
+            self.next_id += 1
+            self.published += 1
+            self.recent.append(stream_event)
+            clients = [client for client in self.clients if client.wants(stream_event)]
+        for client in clients:
+            client.offer(stream_event)
+        return stream_event
+
+    def publish_scan(self, job, plan, changed, started_at, observed_at):
+        """
+        发布一次扫描中变化的单元格（每个单元格一个availability事件）和本次扫描的汇总（scan事件）
+
+        :param started_at: 扫描开始的时间戳
+        :param observed_at: 货源请求全部返回的时间戳
+        """
+        scan_id = "{}#{}".format(job.name, job.count)
+        observed_at = round(observed_at, 3)
+        with self._lock:
+            cells = self.snapshot.setdefault(job.name, {})
+        for index in changed:
+            store_number, store_name, product_code, title, available = plan.cell(index)
+            if not available:
+                with self._lock:
+                    known = cells.pop((store_number, product_code), None) is not None
+                if not known:
+                    # 首次扫描（或扫描计划重建后）从未知变为无货的单元格不发布，只发布变为有货的单元格
+                    continue
+            data = {
+                "job": job.name,
+                "scan_id": scan_id,
+                "store": store_number,
+                "store_name": store_name,
+                "part": product_code,
+                "title": title,
+                "status": "available" if available else "unavailable",
+                "observed_at": observed_at,
+                "published_at": round(time.time(), 3),
+            }
+            if available:
+                with self._lock:
+                    cells[(store_number, product_code)] = data
+            self.publish("availability", data, job.name)
+        self.publish("scan", {
+            "job": job.name,
+            "scan_id": scan_id,
+            "started_at": round(started_at, 3),
+            "observed_at": observed_at,
+            "changed": len(changed),
+            "available": len(cells),
+        }, job.name)
+
+    def attach(self, address, jobs, last_event_id=None):
+        client = StreamClient(address, self.buffer_size, jobs)
+        with self._lock:
+            self.clients.add(client)
+            # 在锁内补发，保证补发的事件排在之后发布的事件之前
+            if last_event_id is not None:
+                for event in self.recent:
+                    if event.id > last_event_id and client.wants(event):
+                        client.offer(event)
+        return client
+
+    def detach(self, client):
+        client.close()
+        with self._lock:
+            self.clients.discard(client)
+
+    def reset(self, job_name):
+        """
+        清空某个扫描任务的快照，用于任务的扫描计划重建或任务被移除；
+        只发布一个reset事件，客户端据此清空该任务的有货单元格，之后的扫描只重新发布有货的单元格
+        """
+        with self._lock:
+            existed = self.snapshot.pop(job_name, None) is not None
+        if existed:
+            self.publish("reset", {"job": job_name}, job_name)
+
+    def current(self, jobs=None):
+        """
+        当前有货的全部单元格，客户端收到overflow事件后可据此重新同步
+        """
+        with self._lock:
+            return {job: list(cells.values()) for job, cells in self.snapshot.items() if jobs is None or job in jobs}
+
+    def stats(self):
+        with self._lock:
+            clients = list(self.clients)
+        return {
+            "published": self.published,
+            "clients": [client.stats() for client in clients],
+        }
+
+    def serve(self):
+        """
+        在后台线程提供事件流接口，每个连接占用一个线程
+        """
+        stream = self
+
+        class EventStreamHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                if url.path == "/events":
+                    self.stream_events(query)
+                elif url.path == "/snapshot":
+                    self.send_json(stream.current(query.get("job")))
+                elif url.path == "/clients":
+                    self.send_json(stream.stats())
+                else:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+
+            def send_json(self, data):
+                body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def stream_events(self, query):
+                last_event_id = self.headers.get("Last-Event-ID") or (query.get("last_event_id") or [None])[0]
+                jobs = set(query["job"]) if "job" in query else None
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                # 写出阻塞超过write_timeout秒（客户端不再读取）时断开
+                self.connection.settimeout(stream.write_timeout)
+                client = stream.attach("{}:{}".format(*self.client_address[:2]), jobs,
+                                       int(last_event_id) if last_event_id and last_event_id.isdigit() else None)
+                try:
+                    self.wfile.write("retry: 1000\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                    while not client.closed:
+                        events, dropped = client.take(stream.heartbeat)
+                        chunks = []
+                        if dropped:
+                            # 告知客户端中间有事件被丢弃，需要通过/snapshot重新同步
+                            chunks.append("event: overflow\ndata: {}\n\n".format(
+                                json.dumps({"dropped": dropped})).encode("utf-8"))
+                        chunks.extend(event.frame for event in events)
+                        if not chunks:
+                            chunks.append(b": heartbeat\n\n")
+                        self.wfile.write(b"".join(chunks))
+                        self.wfile.flush()
+                        client.delivered += len(events)
+                except OSError:
+                    pass
+                finally:
+                    stream.detach(client)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), EventStreamHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="event-stream", daemon=True).start()
+        Utils.log("事件流已启用：http://{}:{}/events".format(*self.server.server_address[:2]))
+        return self.server
+
+    def close(self):
+        with self._lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.close()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
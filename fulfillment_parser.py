@@ -0,0 +1,67 @@
+# -*- coding: UTF-8 –*-
+"""
+货源接口响应解析：直接解析原始字节，只提取扫描需要的字段，输出与地区无关的统一结构
+"""
+
+try:
+    import orjson
+
+    def loads(content):
+        return orjson.loads(content)
+except ImportError:
+    import json
+
+    def loads(content):
+        return json.loads(content)
+
+
+# 未在regions.json中配置stores_path时使用中国大陆的接口结构
+DEFAULT_STORES_PATH = ("body", "content", "pickupMessage", "stores")
+
+
+class PartAvailability:
+    __slots__ = ("part", "quote", "display", "title")
+
+    def __init__(self, part, quote, display, title):
+        self.part = part
+        self.quote = quote
+        self.display = display
+        self.title = title
+
+
+class StoreRecord:
+    __slots__ = ("store_number", "store_name", "parts")
+
+    def __init__(self, store_number, store_name, parts):
+        self.store_number = store_number
+        self.store_name = store_name
+        self.parts = parts
+
+
+def parse_stores(content, stores_path=None, parts=None):
+    """
+    解析货源接口响应
+
+    :param content: 响应的原始字节（或字符串）
+    :param stores_path: 直营店列表在响应中的路径
+    :param parts: 需要的商品型号，只为这些型号构造货源记录，响应中的其他型号直接跳过；为None时保留全部型号
+    :return: StoreRecord列表
+    """
+    node = loads(content)
+    for key in stores_path or DEFAULT_STORES_PATH:
+        node = node[key]
+
+    wanted = None if parts is None else set(parts)
+    records = []
+    for store in node:
+        store_parts = {}
+        for part, availability in store['partsAvailability'].items():
+            if wanted is not None and part not in wanted:
+                continue
+            # 缺少pickupDisplay的不完整记录按无货处理，不能因为字段缺失误报有货
+            store_parts[part] = PartAvailability(part,
+                                                 availability.get('pickupSearchQuote'),
+                                                 availability.get('pickupDisplay') or 'unavailable',
+                                                 availability['messageTypes']['regular']['storePickupProductTitle'])
+        records.append(StoreRecord(store['storeNumber'], store['storeName'], store_parts))
+    return records
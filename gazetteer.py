@@ -0,0 +1,142 @@
+# -*- coding: UTF-8 –*-
+"""
+地址库缓存：并发预取地址查询接口的完整省/市/区树，保存为本地索引
+
+配置向导可以在本地搜索选择取货区域，监控启动时也可以离线校验selected_area
+"""
+
+import gzip
+import json
+import os
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from scheduler import ScanScheduler
+from transport import get_transport
+from utils import Utils
+
+DEFAULT_TTL = 7 * 24 * 3600
+
+
+class Gazetteer:
+    """
+    某个地区的地址索引，rows的每一项为 [省, 市, 区, 取货区域]
+    """
+
+    def __init__(self, region, rows, fetched_at=None):
+        self.region = region
+        self.rows = sorted(rows)
+        self.fetched_at = fetched_at or time.time()
+        self.locations = {row[-1] for row in self.rows}
+
+    @staticmethod
+    def path_for(region):
+        return "gazetteer_{}.json.gz".format(region)
+
+    def expired(self, ttl=DEFAULT_TTL):
+        return time.time() - self.fetched_at > ttl
+
+    def save(self, path=None):
+        path = path or Gazetteer.path_for(self.region)
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump({"region": self.region, "fetched_at": self.fetched_at, "rows": self.rows}, f,
+                      ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(region, path=None):
+        """
+        读取本地索引，不存在时返回None
+        """
+        path = path or Gazetteer.path_for(region)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+        return Gazetteer(data["region"], [tuple(row) for row in data["rows"]], data["fetched_at"])
+
+    @staticmethod
+    def fetch(region, region_info, headers, max_workers=8, scheduler=None, retries=2, retry_interval=2):
+        """
+        按层并发请求地址查询接口，构造完整的地址索引
+
+        每个请求都先从调度器中该域名的令牌桶取令牌，传入监控使用的调度器时与扫描共用同一个限速；
+        单个节点请求失败时退避重试，仍然失败则跳过该节点及其下级，不影响其他节点
+        """
+        url = region_info['base_url'] + region_info['address_lookup_endpoint']
+        location_params = region_info['location_params']
+        location_key = region_info['location_key']
+        scheduler = scheduler or ScanScheduler()
+        host = urllib.parse.urlparse(url).netloc
+        skipped = []
+
+        def lookup(params, key):
+            for attempt in range(retries + 1):
+                scheduler.acquire(host)
+                started = time.perf_counter()
+                try:
+                    response = get_transport().get(url, headers=headers, params=params)
+                except Exception as err:
+                    scheduler.observe(host, error=err)
+                    error = err
+                else:
+                    scheduler.observe(host, response.status_code, time.perf_counter() - started)
+                    try:
+                        if response.status_code != 200:
+                            raise Exception("状态码：{}".format(response.status_code))
+                        return json.loads(response.text)['body'][key]
+                    except Exception as err:
+                        error = err
+                if attempt < retries:
+                    time.sleep(retry_interval * 2 ** attempt)
+            Utils.log("地址查询失败，跳过节点{}：{}".format(params, error))
+            skipped.append(params)
+            return None
+
+        def children(params, param):
+            result_param = lookup(params, param)
+            if result_param is None:
+                return []
+            if type(result_param) is dict:
+                return [dict(params, **{param: item['value']}) for item in result_param['data']]
+            # 只有一个选项时接口直接返回字符串
+            return [dict(params, **{param: result_param})]
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gazetteer") as executor:
+            level = [{}]
+            for step, param in enumerate(location_params):
+                Utils.log("正在加载地址库第{}/{}层，共{}个节点，限速{}次/分钟...".format(
+                    step + 1, len(location_params), len(level), round(scheduler.rate * 60)))
+                level = [child for result in executor.map(lambda params: children(params, param), level)
+                         for child in result]
+            Utils.log("正在加载{}个取货区域...".format(len(level)))
+            locations = list(executor.map(lambda params: lookup(params, location_key), level))
+
+        rows = [tuple(params[param] for param in location_params) + (location,)
+                for params, location in zip(level, locations) if location is not None]
+        if skipped:
+            Utils.log("地址库有{}个节点查询失败已跳过，缺少区域时可删除{}后重新加载".format(
+                len(skipped), Gazetteer.path_for(region)))
+        if not rows:
+            raise Exception("地址查询全部失败")
+        return Gazetteer(region, rows)
+
+    @staticmethod
+    def load_or_fetch(region, region_info, headers, ttl=DEFAULT_TTL, max_workers=8, scheduler=None):
+        gazetteer = Gazetteer.load(region)
+        if gazetteer is None or gazetteer.expired(ttl):
+            gazetteer = Gazetteer.fetch(region, region_info, headers, max_workers, scheduler)
+            gazetteer.save()
+        return gazetteer
+
+    def search(self, keyword):
+        """
+        按空格分隔的多个关键字搜索，返回同时包含所有关键字的地址行
+        """
+        keywords = keyword.split()
+        return [row for row in self.rows if all(any(k in value for value in row) for k in keywords)]
+
+    def contains(self, location):
+        return location in self.locations
@@ -0,0 +1,199 @@
+# -*- coding: UTF-8 –*-
+"""
+对冲请求：货源请求在最近的p95耗时内没有返回时，再发一个相同的请求，使用先返回的响应
+
+第二个请求会使用连接池中的另一条连接（配置了代理池时重新选择代理）。
+requests无法中断已经发出的请求，落后的请求不会被等待，返回后直接丢弃。
+"""
+
+import collections
+import json
+import math
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import metrics
+from utils import Utils
+
+
+def quantile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * q), len(ordered) - 1)]
+
+
+class HedgedTransport:
+    """
+    在传输层外包一层对冲请求，接口与transport.Transport的get一致
+    """
+
+    def __init__(self, transport, scheduler=None, budget=0.1, quantile=0.95, initial_delay=1.0, min_delay=0.05,
+                 window=500, min_samples=20, max_workers=None, concurrency=1, report_interval=300):
+        """
+        :param transport: 实际发送请求的传输层
+        :param scheduler: ScanScheduler，对冲请求同样受按域名限速约束，没有空闲令牌时不发对冲请求
+        :param budget: 对冲请求数占总请求数的比例上限
+        :param quantile: 使用最近请求耗时的该分位数作为对冲的等待时间
+        :param initial_delay: 样本数不足min_samples时的等待时间（秒）
+        :param min_delay: 等待时间的下限（秒）
+        :param window: 用于计算分位数的最近请求数
+        :param max_workers: 线程池大小，未设置时按同时进行的货源请求数加上对冲预算计算，任务增加时自动扩大
+        :param concurrency: 同时进行的货源请求数，即所有扫描任务的商品分组数
+        :param report_interval: 输出对冲胜出率和p99耗时的间隔（秒），为0时只在停止时输出
+        """
+        self.transport = transport
+        self.scheduler = scheduler
+        self.timeout = transport.timeout
+        self.budget = budget
+        self.quantile = quantile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.latencies = collections.deque(maxlen=window)
+        self.effective_latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.max_workers = max_workers
+        self.pool_size = max_workers or HedgedTransport.pool_size(concurrency, budget)
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="hedge")
+        self.report_interval = report_interval
+        self.reported_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_configs(configs, transport, scheduler=None, concurrency=1):
+        """
+        未启用hedging时返回None
+        """
+        hedging_configs = configs.get("hedging", {})
+        if not hedging_configs.get("enabled", False):
+            return None
+        return HedgedTransport(transport, scheduler,
+                               budget=hedging_configs.get("budget", 0.1),
+                               quantile=hedging_configs.get("quantile", 0.95),
+                               initial_delay=hedging_configs.get("initial_delay", 1.0),
+                               min_delay=hedging_configs.get("min_delay", 0.05),
+                               window=hedging_configs.get("window", 500),
+                               max_workers=hedging_configs.get("max_workers"),
+                               concurrency=concurrency,
+                               report_interval=hedging_configs.get("report_interval", 300))
+
+    @staticmethod
+    def pool_size(concurrency, budget):
+        """
+        每个货源请求占一个线程，另外按对冲预算为对冲请求留出线程
+        """
+        return concurrency + max(math.ceil(concurrency * budget), 1)
+
+    def resize(self, concurrency):
+        """
+        扫描任务增加后扩大线程池，配置了max_workers时不调整；旧线程池中的请求照常完成
+        """
+        size = HedgedTransport.pool_size(concurrency, self.budget)
+        if self.max_workers or size <= self.pool_size:
+            return
+        with self._lock:
+            old_executor = self.executor
+            self.pool_size = size
+            self.executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix="hedge")
+            old_executor.shutdown(wait=False)
+
+    def submit(self, *args):
+        with self._lock:
+            return self.executor.submit(*args)
+
+    def delay(self):
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return self.initial_delay
+            return max(quantile(self.latencies, self.quantile), self.min_delay)
+
+    def allow_hedge(self, url):
+        with self._lock:
+            if self.hedges + 1 > self.budget * self.requests:
+                return False
+        if self.scheduler is not None:
+            host = urllib.parse.urlparse(url).netloc
+            return self.scheduler.host(host).bucket.try_acquire() == 0
+        return True
+
+    def timed_get(self, url, kwargs, running=None):
+        if running is not None:
+            running.set()
+        started = time.perf_counter()
+        response = self.transport.get(url, **kwargs)
+        with self._lock:
+            self.latencies.append(time.perf_counter() - started)
+        return response
+
+    def get(self, url, **kwargs):
+        started = time.perf_counter()
+        with self._lock:
+            self.requests += 1
+        # 对冲的等待时间从主请求真正开始执行时算起，不包括在线程池中排队的时间
+        running = threading.Event()
+        primary = self.submit(self.timed_get, url, kwargs, running)
+        running.wait()
+        done, _ = wait([primary], timeout=self.delay())
+        if done or not self.allow_hedge(url):
+            try:
+                return primary.result()
+            finally:
+                self.record(started)
+
+        with self._lock:
+            self.hedges += 1
+        metrics.hedged_requests_total.inc("sent")
+        hedge = self.submit(self.timed_get, url, kwargs)
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is not None:
+                        error = future.exception()
+                        continue
+                    # 落后的请求未开始时取消，已经发出时返回后直接丢弃
+                    for other in pending:
+                        other.cancel()
+                    if future is hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                        metrics.hedged_requests_total.inc("won")
+                    return future.result()
+            raise error
+        finally:
+            self.record(started)
+
+    def record(self, started):
+        now = time.monotonic()
+        with self._lock:
+            self.effective_latencies.append(time.perf_counter() - started)
+            report = self.report_interval > 0 and now - self.reported_at >= self.report_interval
+            if report:
+                self.reported_at = now
+        if report:
+            Utils.log("对冲请求：{}".format(json.dumps(self.stats(), ensure_ascii=False)))
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self.effective_latencies)
+            stats = {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_rate": round(self.hedges / self.requests, 3) if self.requests else 0,
+                "hedge_win_rate": round(self.hedge_wins / self.hedges, 3) if self.hedges else 0,
+                "pool_size": self.pool_size,
+            }
+        for name, q in (("p50_ms", 0.5), ("p95_ms", 0.95), ("p99_ms", 0.99)):
+            value = quantile(latencies, q)
+            stats[name] = round(value * 1000, 1) if value is not None else None
+        return stats
+
+    def close(self):
+        self.executor.shutdown(wait=False)
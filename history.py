@@ -0,0 +1,347 @@
+# -*- coding: UTF-8 –*-
+"""
+货源历史：把每次扫描中各直营店、各商品的有货/无货状态追加写入SQLite，并提供补货规律查询
+
+直营店和商品型号各自编码为整数，每条观测只占 (时间, 直营店, 商品, 状态) 四个整数，
+同一秒内的多次观测按写入顺序（rowid）区分，写入由后台线程批量提交，扫描循环只负责入队。
+
+用法：
+    python history.py restock <直营店编号或名称> <商品型号> [history.db]
+    python history.py durations [商品型号] [history.db]
+    python history.py hot [时段数] [history.db]
+"""
+
+import collections
+import queue
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+
+from scan_plan import UNKNOWN, AVAILABLE
+from utils import Utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stores (
+    id INTEGER PRIMARY KEY,
+    store_number TEXT UNIQUE NOT NULL,
+    store_name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS parts (
+    id INTEGER PRIMARY KEY,
+    part TEXT UNIQUE NOT NULL
+);
+CREATE TABLE IF NOT EXISTS observations (
+    id INTEGER PRIMARY KEY,
+    store_id INTEGER NOT NULL,
+    part_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    available INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS observations_cell ON observations (store_id, part_id, ts);
+"""
+
+# 旧版本以 (store_id, part_id, ts) 为主键，同一秒内的第二次观测会被忽略，启动时迁移为rowid表
+MIGRATE_OBSERVATIONS = """
+ALTER TABLE observations RENAME TO observations_old;
+CREATE TABLE observations (
+    id INTEGER PRIMARY KEY,
+    store_id INTEGER NOT NULL,
+    part_id INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    available INTEGER NOT NULL
+);
+INSERT INTO observations (store_id, part_id, ts, available)
+    SELECT store_id, part_id, ts, available FROM observations_old ORDER BY ts, store_id, part_id;
+DROP TABLE observations_old;
+"""
+
+WEEKDAYS = ["周一", "周二", "周三", "周四", "周五", "周六", "周日"]
+
+
+class HistoryStore:
+    """
+    货源历史库，record()只把货源矩阵的快照放入队列，由后台线程展开后批量写入
+    """
+
+    def __init__(self, path="history.db", batch_size=5000, flush_interval=2, queue_size=1000):
+        """
+        :param path: SQLite数据库路径
+        :param batch_size: 单个事务最多写入的观测条数
+        :param flush_interval: 队列空闲时最长等待多少秒提交一次
+        :param queue_size: 最多缓存的扫描快照数，写入跟不上时丢弃新的快照
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written = 0
+        self.dropped = 0
+        # 建表在调用线程中完成，保证查询接口立即可用
+        connection = HistoryStore.connect(path)
+        columns = [column[1] for column in connection.execute("PRAGMA table_info(observations)")]
+        if columns and "id" not in columns:
+            Utils.log("正在迁移货源历史表结构：{}".format(path))
+            connection.executescript("BEGIN;" + MIGRATE_OBSERVATIONS + "COMMIT;")
+        connection.executescript(SCHEMA)
+        connection.close()
+        self.thread = threading.Thread(target=self.run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def from_configs(configs):
+        history_configs = configs.get("history", {})
+        if not history_configs.get("path"):
+            return None
+        return HistoryStore(history_configs["path"],
+                            batch_size=history_configs.get("batch_size", 5000),
+                            flush_interval=history_configs.get("flush_interval", 2),
+                            queue_size=history_configs.get("queue_size", 1000))
+
+    @staticmethod
+    def connect(path):
+        connection = sqlite3.connect(path)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def record(self, plan, now=None):
+        """
+        记录扫描计划当前的货源矩阵，不阻塞调用线程
+        """
+        snapshot = (int(now or time.time()), plan, bytes(plan.matrix), len(plan.store_numbers))
+        try:
+            self.queue.put_nowait(snapshot)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        connection = HistoryStore.connect(self.path)
+        store_ids = {}
+        part_ids = {}
+        rows = []
+        closing = False
+        while not closing:
+            try:
+                snapshot = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                snapshot = ()
+            if snapshot is None:
+                closing = True
+            elif snapshot:
+                rows.extend(self.expand(connection, snapshot, store_ids, part_ids))
+            if rows and (closing or len(rows) >= self.batch_size or self.queue.empty()):
+                try:
+                    with connection:
+                        connection.executemany(
+                            "INSERT INTO observations (store_id, part_id, ts, available) "
+                            "VALUES (?, ?, ?, ?)", rows)
+                    self.written += len(rows)
+                except sqlite3.Error as err:
+                    Utils.log("写入货源历史失败：{}".format(err))
+                rows = []
+        connection.close()
+
+    @staticmethod
+    def expand(connection, snapshot, store_ids, part_ids):
+        """
+        将货源矩阵快照展开为观测记录，未观测到的单元格不写入
+        """
+        ts, plan, matrix, store_count = snapshot
+        width = plan.width
+        columns = []
+        for part in plan.product_codes:
+            if part not in part_ids:
+                with connection:
+                    connection.execute("INSERT OR IGNORE INTO parts (part) VALUES (?)", (part,))
+                part_ids[part] = connection.execute("SELECT id FROM parts WHERE part = ?", (part,)).fetchone()[0]
+            columns.append(part_ids[part])
+
+        rows = []
+        for row in range(store_count):
+            store_number = plan.store_numbers[row]
+            store_id = store_ids.get(store_number)
+            if store_id is None:
+                with connection:
+                    connection.execute("INSERT INTO stores (store_number, store_name) VALUES (?, ?) "
+                                       "ON CONFLICT (store_number) DO UPDATE SET store_name = excluded.store_name",
+                                       (store_number, plan.store_names[row]))
+                store_id = connection.execute("SELECT id FROM stores WHERE store_number = ?",
+                                              (store_number,)).fetchone()[0]
+                store_ids[store_number] = store_id
+            offset = row * width
+            for column, part_id in enumerate(columns):
+                value = matrix[offset + column]
+                if value != UNKNOWN:
+                    rows.append((store_id, part_id, ts, 1 if value == AVAILABLE else 0))
+        return rows
+
+    def close(self, timeout=10):
+        """
+        写入队列中剩余的快照后停止后台线程
+        """
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        if self.dropped:
+            Utils.log("货源历史写入跟不上扫描，共丢弃{}次扫描快照".format(self.dropped))
+
+
+class HistoryQuery:
+    """
+    货源历史的只读查询
+    """
+
+    def __init__(self, path="history.db"):
+        self.connection = sqlite3.connect("file:{}?mode=ro".format(path), uri=True)
+
+    def find_stores(self, keyword):
+        """
+        按直营店编号或名称查找直营店
+
+        :return: [(id, 直营店编号, 直营店名称)]
+        """
+        return self.connection.execute(
+            "SELECT id, store_number, store_name FROM stores WHERE store_number = ? OR store_name LIKE ?",
+            (keyword, "%{}%".format(keyword))).fetchall()
+
+    def restocks(self, store_id=None, part=None):
+        """
+        由无货变为有货的时间点
+
+        :return: [(直营店编号, 直营店名称, 商品型号, 时间戳)]
+        """
+        conditions = []
+        params = []
+        if store_id is not None:
+            conditions.append("o.store_id = ?")
+            params.append(store_id)
+        if part is not None:
+            conditions.append("p.part = ?")
+            params.append(part)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        sql = """
+            SELECT store_number, store_name, part, ts FROM (
+                SELECT s.store_number, s.store_name, p.part, o.id, o.ts, o.available,
+                       LAG(o.available) OVER (PARTITION BY o.store_id, o.part_id ORDER BY o.ts, o.id) AS previous
+                FROM observations o
+                JOIN stores s ON s.id = o.store_id
+                JOIN parts p ON p.id = o.part_id
+                {}
+            ) WHERE available = 1 AND previous = 0
+            ORDER BY ts, id
+        """.format(where)
+        return self.connection.execute(sql, params).fetchall()
+
+    def in_stock_durations(self, part=None):
+        """
+        每段连续有货的持续时间，从首次观测到有货算到首次观测到无货，尚未结束的时段不计入
+
+        :return: {(直营店编号, 直营店名称): [秒数]}
+        """
+        sql = """
+            SELECT s.store_number, s.store_name, o.part_id, o.ts, o.available
+            FROM observations o
+            JOIN stores s ON s.id = o.store_id
+            JOIN parts p ON p.id = o.part_id
+            {}
+            ORDER BY o.store_id, o.part_id, o.ts, o.id
+        """.format("WHERE p.part = ?" if part else "")
+        durations = collections.defaultdict(list)
+        current_key = None
+        since = None
+        for store_number, store_name, part_id, ts, available in self.connection.execute(sql, [part] if part else []):
+            key = (store_number, store_name, part_id)
+            if key != current_key:
+                current_key = key
+                since = None
+            if available and since is None:
+                since = ts
+            elif not available and since is not None:
+                durations[(store_number, store_name)].append(ts - since)
+                since = None
+        return durations
+
+    def hot_hours(self, top=3):
+        """
+        历史上补货次数最多的几个小时
+
+        :return: [(小时, 补货次数)]
+        """
+        counter = collections.Counter(time.localtime(ts).tm_hour for _, _, _, ts in self.restocks())
+        return counter.most_common(top)
+
+    def hot_windows(self, top=3, interval=5):
+        """
+        将补货最多的几个小时转换为ScanScheduler的抢购时段配置
+        """
+        return [{"start": "{:02d}:00".format(hour), "end": "{:02d}:00".format((hour + 1) % 24), "interval": interval}
+                for hour, _ in self.hot_hours(top)]
+
+    def close(self):
+        self.connection.close()
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}小时{}分钟".format(hours, minutes)
+    return "{}分钟{}秒".format(minutes, seconds)
+
+
+def print_restock_pattern(query, keyword, part):
+    stores = query.find_stores(keyword)
+    if len(stores) == 0:
+        print("没有找到直营店：{}".format(keyword))
+        return
+    for store_id, store_number, store_name in stores:
+        restocks = query.restocks(store_id, part)
+        print("{:-<60}".format("【{} {}】{} 共补货{}次".format(store_number, store_name, part, len(restocks))))
+        if len(restocks) == 0:
+            continue
+        moments = [time.localtime(ts) for _, _, _, ts in restocks]
+        hours = collections.Counter(moment.tm_hour for moment in moments)
+        weekdays = collections.Counter(moment.tm_wday for moment in moments)
+        print("按小时：")
+        for hour, count in hours.most_common():
+            print("\t{:02d}:00 ~ {:02d}:59  {}次（{:.0%}）".format(hour, hour, count, count / len(moments)))
+        print("按星期：")
+        for weekday, count in weekdays.most_common():
+            print("\t{}  {}次（{:.0%}）".format(WEEKDAYS[weekday], count, count / len(moments)))
+        print("最近一次补货：{}".format(time.strftime("%Y-%m-%d %H:%M:%S", moments[-1])))
+
+
+def print_durations(query, part):
+    durations = query.in_stock_durations(part)
+    if len(durations) == 0:
+        print("没有完整的有货时段记录")
+        return
+    for (store_number, store_name), values in sorted(durations.items(), key=lambda item: -statistics.median(item[1])):
+        print("【{} {}】有货{}次，持续时间中位数：{}，最长：{}".format(
+            store_number, store_name, len(values), format_duration(statistics.median(values)),
+            format_duration(max(values))))
+
+
+if __name__ == '__main__':
+    args = sys.argv
+    if len(args) in (4, 5) and args[1] == "restock":
+        history_query = HistoryQuery(args[4] if len(args) == 5 else "history.db")
+        print_restock_pattern(history_query, args[2], args[3])
+    elif len(args) in (2, 3, 4) and args[1] == "durations":
+        history_query = HistoryQuery(args[3] if len(args) == 4 else "history.db")
+        print_durations(history_query, args[2] if len(args) >= 3 and args[2] != "*" else None)
+    elif len(args) in (2, 3, 4) and args[1] == "hot":
+        history_query = HistoryQuery(args[3] if len(args) == 4 else "history.db")
+        for hot_hour, hot_count in history_query.hot_hours(int(args[2]) if len(args) >= 3 else 3):
+            print("{:02d}:00 ~ {:02d}:59  补货{}次".format(hot_hour, hot_hour, hot_count))
+    else:
+        print("""
+        Usage: python {0} restock <store_number|store_name> <part> [history.db]
+               python {0} durations [part|*] [history.db]
+               python {0} hot [top] [history.db]
+        """.format(args[0]))
+        exit(1)
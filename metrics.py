@@ -0,0 +1,212 @@
+# -*- coding: UTF-8 –*-
+"""
+Prometheus格式的监控指标
+
+未启用时所有指标都是空操作对象，扫描路径上只多出一次属性查找和一次空函数调用
+"""
+
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                            .replace("\n", "\\n"))
+                          for name, value in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self.values.items())
+        for label_values, value in items:
+            yield self.name + format_labels(self.label_names, label_values), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self.values[label_values] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # 标签值 -> [各桶计数..., 总和, 总数]
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            data = self.values.get(label_values)
+            if data is None:
+                data = [0] * (len(self.buckets) + 2)
+                self.values[label_values] = data
+            if index < len(self.buckets):
+                data[index] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(label_values, list(data)) for label_values, data in self.values.items()]
+        for label_values, data in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, data):
+                cumulative += count
+                yield (self.name + "_bucket" + format_labels(self.label_names, label_values, ("le", bound)),
+                       cumulative)
+            yield self.name + "_bucket" + format_labels(self.label_names, label_values, ("le", "+Inf")), data[-1]
+            yield self.name + "_sum" + format_labels(self.label_names, label_values), data[-2]
+            yield self.name + "_count" + format_labels(self.label_names, label_values), data[-1]
+
+
+class NullMetric:
+    """
+    未启用指标时使用的空操作对象
+    """
+
+    def inc(self, *label_values, amount=1):
+        pass
+
+    def set(self, value, *label_values):
+        pass
+
+    def observe(self, value, *label_values):
+        pass
+
+
+NULL_METRIC = NullMetric()
+
+
+class Metrics:
+    """
+    扫描链路上的全部指标，enable()之前均为空操作
+    """
+
+    DEFINITIONS = {
+        "fulfillment_latency": (Histogram, "apple_monitor_fulfillment_request_seconds",
+                                "货源接口请求耗时", ("host",)),
+        "parse_seconds": (Histogram, "apple_monitor_parse_seconds", "货源响应解析耗时", ("region",)),
+        "detect_seconds": (Histogram, "apple_monitor_detect_seconds", "货源矩阵比较与状态更新耗时", ("job",)),
+        "scan_seconds": (Histogram, "apple_monitor_scan_seconds", "单次扫描总耗时", ("job",)),
+        "notification_seconds": (Histogram, "apple_monitor_notification_delivery_seconds",
+                                 "通知从入队到送达的耗时", ("channel",)),
+        "scans_total": (Counter, "apple_monitor_scans_total", "扫描次数", ("job",)),
+        "http_responses_total": (Counter, "apple_monitor_http_responses_total", "货源接口响应状态码",
+                                 ("host", "status")),
+        "exceptions_total": (Counter, "apple_monitor_exceptions_total", "扫描异常次数", ("job", "type")),
+        "availability_edges_total": (Counter, "apple_monitor_availability_edges_total", "货源状态翻转次数",
+                                     ("job", "direction")),
+        "last_success_timestamp": (Gauge, "apple_monitor_last_success_timestamp_seconds",
+                                   "最近一次成功扫描的时间戳", ("job",)),
+        "proxy_requests_total": (Counter, "apple_monitor_proxy_requests_total", "各代理的请求次数",
+                                 ("proxy", "outcome")),
+        "proxy_latency": (Histogram, "apple_monitor_proxy_request_seconds", "各代理的请求耗时", ("proxy",)),
+        "proxy_score": (Gauge, "apple_monitor_proxy_health_score", "各代理的健康度", ("proxy",)),
+        "hedged_requests_total": (Counter, "apple_monitor_hedged_requests_total",
+                                  "对冲请求次数，outcome为sent（发出）或won（先于原请求返回）", ("outcome",)),
+        "worker_restarts_total": (Counter, "apple_monitor_worker_restarts_total",
+                                  "监督模式下工作进程的重启次数", ("job", "reason")),
+        "worker_rss_bytes": (Gauge, "apple_monitor_worker_rss_bytes", "监督模式下工作进程的常驻内存", ("job",)),
+    }
+
+    def __init__(self):
+        self.enabled = False
+        self.server = None
+        for attribute in self.DEFINITIONS:
+            setattr(self, attribute, NULL_METRIC)
+
+    def enable(self):
+        if self.enabled:
+            return
+        for attribute, (metric_class, name, documentation, label_names) in self.DEFINITIONS.items():
+            setattr(self, attribute, metric_class(name, documentation, label_names))
+        self.enabled = True
+
+    def render(self):
+        lines = []
+        for attribute in self.DEFINITIONS:
+            metric = getattr(self, attribute)
+            if metric is NULL_METRIC:
+                continue
+            lines.append("# HELP {} {}".format(metric.name, metric.documentation))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for sample, value in metric.samples():
+                lines.append("{} {}".format(sample, value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host="127.0.0.1", port=9108):
+        """
+        在后台线程提供 /metrics 接口
+        """
+        # 只在启用时导入，单次扫描模式不需要承担http.server的导入耗时
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        return self.server
+
+    def configure(self, configs):
+        metrics_configs = configs.get("metrics", {})
+        if not metrics_configs.get("enabled"):
+            return
+        self.enable()
+        if self.server is None:
+            self.serve(metrics_configs.get("host", "127.0.0.1"), metrics_configs.get("port", 9108))
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+metrics = Metrics()
@@ -6,111 +6,69 @@
 """
 
 import sys
+
+if __name__ == '__main__' and sys.argv[1:2] == ["once"]:
+    # 单次扫描只需要oneshot导入的模块，在导入下面的常驻组件之前直接转交
+    import oneshot
+    exit(oneshot.run_once())
+
 import os
-import random
-import datetime
-import requests
+import asyncio
+import collections
 import json
+import threading
 import time
-import hmac
-import hashlib
-import base64
 import urllib.parse
-
-
-class Utils:
-
-    @staticmethod
-    def time_title(message):
-        return "[{}] {}".format(datetime.datetime.now().strftime('%H:%M:%S'), message)
-
-    @staticmethod
-    def log(message):
-        print(Utils.time_title(message))
-
-    @staticmethod
-    def send_message(notification_configs, message, **kwargs):
-        if len(message) == 0:
-            return
-
-        # Wrapper for exception caught
-        def invoke(func, configs):
-            try:
-                func(configs, message, **kwargs)
-            except Exception as err:
-                Utils.log(err)
-
-        # DingTalk message
-        invoke(Utils.send_dingtalk_message, notification_configs["dingtalk"])
-
-        # Bark message
-        invoke(Utils.send_bark_message, notification_configs["bark"])
-
-        # Telegram message
-        invoke(Utils.send_telegram_message, notification_configs["telegram"])
-
-    @staticmethod
-    def send_dingtalk_message(dingtalk_configs, message, **kwargs):
-        if len(dingtalk_configs["access_token"]) == 0 or len(dingtalk_configs["secret_key"]) == 0:
-            return
-
-        timestamp = str(round(time.time() * 1000))
-        secret_enc = dingtalk_configs["secret_key"].encode('utf-8')
-        string_to_sign = '{}\n{}'.format(timestamp, dingtalk_configs["secret_key"])
-        string_to_sign_enc = string_to_sign.encode('utf-8')
-        hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
-        sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
-
-        headers = {
-            'Content-Type': 'application/json'
-        }
-
-        params = {
-            "access_token": dingtalk_configs["access_token"],
-            "timestamp": timestamp,
-            "sign": sign
-        }
-
-        content = {
-            "msgtype": "text" if "message_type" not in kwargs else kwargs["message_type"],
-            "text": {
-                "content": message
-            }
-        }
-
-        response = requests.post("https://oapi.dingtalk.com/robot/send", headers=headers, params=params, json=content)
-        Utils.log("Dingtalk发送消息状态码：{}".format(response.status_code))
-
-    @staticmethod
-    def send_telegram_message(telegram_configs, message, **kwargs):
-        if len(telegram_configs["bot_token"]) == 0 or len(telegram_configs["chat_id"]) == 0:
-            return
-
-        headers = {
-            'Content-Type': 'application/json'
-        }
-
-        proxies = {
-            "https": telegram_configs["http_proxy"],
-        }
-
-        content = {
-            "chat_id": telegram_configs["chat_id"],
-            "text": message
-        }
-
-        url = "https://api.telegram.org/bot{}/sendMessage".format(telegram_configs["bot_token"])
-        response = requests.post(url, headers=headers, proxies=proxies, json=content)
-        Utils.log("Telegram发送消息状态码：{}".format(response.status_code))
-
-    @staticmethod
-    def send_bark_message(bark_configs, message, **kwargs):
-        if len(bark_configs["url"]) == 0:
-            return
-
-        url = "{}/{}".format(bark_configs["url"].strip("/"), urllib.parse.quote(message, safe=""))
-        response = requests.post(url, params=bark_configs["query_parameters"])
-        Utils.log("Bark发送消息状态码：{}".format(response.status_code))
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import Utils
+from scan_log import logger
+from transport import Transport, get_transport, set_transport
+from engine import ScanJob, ScanEngine
+from notifier import NotificationDispatcher, PRIORITY_ERROR
+from state import AvailabilityState
+from scheduler import ScanScheduler
+from fulfillment_parser import parse_stores
+from scan_plan import ScanPlan
+from metrics import metrics
+from subscriptions import Subscriber, load_subscriber_configs, merge_subscriptions
+from gazetteer import Gazetteer
+from catalog import Catalog
+from cluster import Coordinator, ShardedTransport
+from proxy_pool import ProxyPool, ProxiedTransport
+from config_watcher import ConfigWatcher
+from browser_session import SessionBootstrapper
+from hedging import HedgedTransport, quantile
+from event_stream import EventStream
+from supervisor import Supervisor
+from history import HistoryStore, HistoryQuery
+from recorder import ResponseRecorder, ReplayTransport, CollectingDispatcher, read_archive
+
+
+# 配置热更新可以直接生效的字段，其余字段的修改需要重启监控
+RELOADABLE_SECTIONS = frozenset(("region", "selected_area", "selected_products", "exclude_stores", "scan_interval",
+                                 "chunk_size", "jobs", "notification_configs", "notification_dispatcher",
+                                 "alert_exception", "alert_startup", "schedule", "logging"))
+# 只有部分子字段可以热更新的配置
+RELOADABLE_FIELDS = {"state": ("reminder_interval",), "history": ("hot_windows",)}
+
+
+def restart_required_sections(old_configs, configs):
+    """
+    与当前配置相比有修改、但热更新无法生效的配置字段
+    """
+    sections = []
+    for section in sorted(set(old_configs) | set(configs)):
+        if section in RELOADABLE_SECTIONS:
+            continue
+        old_value, value = old_configs.get(section), configs.get(section)
+        if section in RELOADABLE_FIELDS:
+            fields = RELOADABLE_FIELDS[section]
+            old_value = {key: item for key, item in (old_value or {}).items() if key not in fields}
+            value = {key: item for key, item in (value or {}).items() if key not in fields}
+        if old_value != value:
+            sections.append(section)
+    return sections
 
 
 class AppleStoreMonitor:
@@ -120,13 +78,13 @@ class AppleStoreMonitor:
         self.region = region
         
         # 加载地区配置
-        with open('regions.json', encoding='utf-8') as f:
-            self.regions_config = json.load(f)
+        self.regions_config = AppleStoreMonitor.load_regions_config()
         
         if region not in self.regions_config:
             raise ValueError(f"不支持的地区: {region}")
         
         self.region_info = self.regions_config[region]
+        self.session_bootstrapper = None
         
         # 根据地区设置请求头
         self.headers = {
@@ -138,14 +96,61 @@ class AppleStoreMonitor:
             'sec-ch-ua-platform': '"macOS"',
         }
 
+    @staticmethod
+    def load_regions_config(base_url_overrides=None):
+        """
+        加载地区配置
+
+        环境变量APPLE_STORE_BASE_URL会覆盖所有地区的base_url，base_url_overrides可按地区单独覆盖，
+        用于指向本地模拟服务（见stub_server.py）
+        """
+        with open('regions.json', encoding='utf-8') as f:
+            regions_config = json.load(f)
+        base_url = os.environ.get('APPLE_STORE_BASE_URL')
+        for region, region_info in regions_config.items():
+            if base_url:
+                region_info['base_url'] = base_url.rstrip('/')
+            if base_url_overrides and region in base_url_overrides:
+                region_info['base_url'] = base_url_overrides[region].rstrip('/')
+        return regions_config
+
+    @staticmethod
+    def select_area_offline(region, region_info, headers):
+        """
+        在本地地址库中搜索并选择取货区域，地址库不存在或过期时先并发预取，加载失败返回None
+
+        预取请求按已有配置文件中schedule的限速发送，没有配置文件时使用默认限速
+        """
+        try:
+            configs = {}
+            if os.path.exists('apple_store_monitor_configs.json'):
+                with open('apple_store_monitor_configs.json', encoding='utf-8') as f:
+                    configs = json.load(f)
+            gazetteer = Gazetteer.load_or_fetch(region, region_info, headers,
+                                                scheduler=ScanScheduler.from_configs(configs))
+        except Exception as err:
+            print('加载地址库失败：{}，改为逐级在线选择'.format(err))
+            return None
+
+        while True:
+            print('--------------------')
+            rows = gazetteer.search(input('输入地址关键字搜索，多个关键字以空格分隔[如：上海 黄浦]：'))
+            if len(rows) == 0:
+                print('未找到匹配的地址，请重新输入')
+                continue
+            for index, row in enumerate(rows[:50]):
+                print('[{}] {}'.format(index, row[-1]))
+            input_index = input('请选择地区序号[直接回车重新搜索]：').strip()
+            if len(input_index) != 0:
+                return rows[int(input_index)][-1]
+
     @staticmethod
     def config():
         """
         进行各类配置操作
         """
         # 加载地区配置
-        with open('regions.json', encoding='utf-8') as f:
-            regions_config = json.load(f)
+        regions_config = AppleStoreMonitor.load_regions_config()
         
         products_data = json.load(open('products.json', encoding='utf-8'))
         
@@ -191,45 +196,59 @@ class AppleStoreMonitor:
             "alert_exception": False
         }
 
+        # 商品目录索引，支持按型号或关键字直接搜索
+        catalog = Catalog(products_data)
         while True:
-            # chose product type
             print('--------------------')
-            for index, item in enumerate(products):
-                print('[{}] {}'.format(index, item))
-            product_type = list(products)[int(input('选择要监控的产品：'))]
+            keyword = input('输入型号或关键字搜索商品[直接回车按分类选择]：').strip()
+            if len(keyword) != 0:
+                entries = catalog.search(keyword, region=selected_region)
+                if len(entries) == 0:
+                    print('未找到匹配的商品')
+                    continue
+                for index, entry in enumerate(entries):
+                    print('[{}] {} {} {}'.format(index, entry.part, entry.model, entry.description))
+                entry = entries[int(input('选择要监控的产品型号：'))]
+                configs["selected_products"][entry.part] = (entry.model, entry.description)
+            else:
+                # chose product type
+                print('--------------------')
+                for index, item in enumerate(products):
+                    print('[{}] {}'.format(index, item))
+                product_type = list(products)[int(input('选择要监控的产品：'))]
 
-            # 检查产品数据结构
-            product_data = products[product_type]
+                # 检查产品数据结构
+                product_data = products[product_type]
             
-            # 判断是否有分类层级（中国大陆）还是直接是产品型号（香港）
-            first_item_value = list(product_data.values())[0]
-            has_classification = isinstance(first_item_value, dict)
+                # 判断是否有分类层级（中国大陆）还是直接是产品型号（香港）
+                first_item_value = list(product_data.values())[0]
+                has_classification = isinstance(first_item_value, dict)
             
-            if has_classification:
-                # 中国大陆的三层结构：产品类型 -> 产品分类 -> 产品型号
-                # chose product classification
-                print('--------------------')
-                for index, (key, value) in enumerate(products[product_type].items()):
-                    print('[{}] {}'.format(index, key))
-                product_classification = list(products[product_type])[int(input('选择要监控的产品子类：'))]
+                if has_classification:
+                    # 中国大陆的三层结构：产品类型 -> 产品分类 -> 产品型号
+                    # chose product classification
+                    print('--------------------')
+                    for index, (key, value) in enumerate(products[product_type].items()):
+                        print('[{}] {}'.format(index, key))
+                    product_classification = list(products[product_type])[int(input('选择要监控的产品子类：'))]
 
-                # chose product model
-                print('--------------------')
-                for index, (key, value) in enumerate(products[product_type][product_classification].items()):
-                    print('[{}] {}'.format(index, value))
-                product_model = list(products[product_type][product_classification])[int(input('选择要监控的产品型号：'))]
+                    # chose product model
+                    print('--------------------')
+                    for index, (key, value) in enumerate(products[product_type][product_classification].items()):
+                        print('[{}] {}'.format(index, value))
+                    product_model = list(products[product_type][product_classification])[int(input('选择要监控的产品型号：'))]
 
-                configs["selected_products"][product_model] = (
-                    product_classification, products[product_type][product_classification][product_model])
-            else:
-                # 香港的两层结构：产品类型 -> 产品型号
-                print('--------------------')
-                for index, (key, value) in enumerate(products[product_type].items()):
-                    print('[{}] {}'.format(index, value))
-                product_model = list(products[product_type])[int(input('选择要监控的产品型号：'))]
+                    configs["selected_products"][product_model] = (
+                        product_classification, products[product_type][product_classification][product_model])
+                else:
+                    # 香港的两层结构：产品类型 -> 产品型号
+                    print('--------------------')
+                    for index, (key, value) in enumerate(products[product_type].items()):
+                        print('[{}] {}'.format(index, value))
+                    product_model = list(products[product_type])[int(input('选择要监控的产品型号：'))]
 
-                configs["selected_products"][product_model] = (
-                    product_type, products[product_type][product_model])
+                    configs["selected_products"][product_model] = (
+                        product_type, products[product_type][product_model])
 
             print('--------------------')
             if len(input('是否添加更多产品[Enter继续添加，非Enter键退出]：')) != 0:
@@ -244,11 +263,15 @@ class AppleStoreMonitor:
         choice_params = {}
         param_dict = {}
         
-        if len(url_param) > 0:  # 中国大陆需要选择省市区
+        selected_area = None
+        if len(url_param) > 0:  # 中国大陆需要选择省市区，优先在本地地址库中搜索
+            selected_area = AppleStoreMonitor.select_area_offline(selected_region, region_info, monitor.headers)
+
+        if len(url_param) > 0 and selected_area is None:  # 地址库不可用时逐级在线选择
             for step, param in enumerate(url_param):
                 print('请稍后...{}/{}'.format(step + 1, len(url_param)))
-                response = requests.get(region_info['base_url'] + region_info['address_lookup_endpoint'], 
-                                        headers=monitor.headers, params=choice_params)
+                response = get_transport().get(region_info['base_url'] + region_info['address_lookup_endpoint'], 
+                                               headers=monitor.headers, params=choice_params)
                 result_param = json.loads(response.text)['body'][param]
                 if type(result_param) is dict:
                     result_data = result_param['data']
@@ -263,10 +286,10 @@ class AppleStoreMonitor:
                     choice_params[param] = result_param
 
             print('正在加载网络资源...')
-            response = requests.get(region_info['base_url'] + region_info['address_lookup_endpoint'], 
-                                    headers=monitor.headers, params=choice_params)
+            response = get_transport().get(region_info['base_url'] + region_info['address_lookup_endpoint'], 
+                                           headers=monitor.headers, params=choice_params)
             selected_area = json.loads(response.text)['body'][region_info['location_key']]
-        else:  # 香港等地区使用固定位置
+        elif len(url_param) == 0:  # 香港等地区使用固定位置
             if selected_region == 'hk':
                 selected_area = region_info.get('default_location', 'Hong Kong')
             else:
@@ -287,8 +310,8 @@ class AppleStoreMonitor:
             store_params["mt"] = "regular"
             import time
             store_params["_"] = int(time.time() * 1000)
-        response = requests.get(region_info['base_url'] + region_info['fulfillment_endpoint'],
-                                headers=monitor.headers, params=store_params)
+        response = get_transport().get(region_info['base_url'] + region_info['fulfillment_endpoint'],
+                                       headers=monitor.headers, params=store_params)
 
         # 添加响应状态检查和调试信息
         if response.status_code != 200:
@@ -409,145 +432,654 @@ class AppleStoreMonitor:
             print('--------------------')
             print("扫描配置已生成，并已写入到{}文件中\n请使用 python {} start 命令启动监控".format(file.name, os.path.abspath(__file__)))
 
-    def start(self):
+    def headers_for(self, region, session=True):
         """
-        开始监控
+        获取指定地区的请求头，启用了浏览器会话时合并会话的请求头和Cookie
         """
-        configs = json.load(open('apple_store_monitor_configs.json', encoding='utf-8'))
-        
+        headers = dict(self.headers)
+        headers['Referer'] = self.regions_config[region]['referer']
+        if session and self.session_bootstrapper is not None:
+            headers = self.session_bootstrapper.apply(region, headers)
+        return headers
+
+    def setup(self, configs):
+        """
+        根据配置初始化扫描所需的各个组件，返回扫描任务列表
+        """
+        jobs = ScanJob.from_configs(configs, self.region)
+        self.setup_components(configs, jobs)
+        # 货源状态表，只在有货/无货翻转时通知
+        self.state = AvailabilityState.from_configs(configs)
+        for job in jobs:
+            self.subscribe_default(job)
+            self.prepare_job(job)
+        return jobs
+
+    def setup_components(self, configs, jobs):
+        """
+        初始化与扫描任务无关的组件：传输层、通知分发器、限速、监控指标等，多用户模式下同样使用
+
+        :param jobs: 将要运行的扫描任务，用于计算对冲请求的线程池大小
+        """
+        # 启用时在本地提供 /metrics 接口
+        metrics.configure(configs)
+        # 日志等级、格式和缓冲
+        logger.configure(configs)
+
+        if configs.get('base_url_overrides'):
+            self.regions_config = AppleStoreMonitor.load_regions_config(configs['base_url_overrides'])
+
         # 如果配置中有地区信息，更新当前实例的地区
         if 'region' in configs:
             self.region = configs['region']
             self.region_info = self.regions_config[self.region]
             self.headers['Referer'] = self.region_info['referer']
         
-        selected_products = configs["selected_products"]
-        selected_area = configs["selected_area"]
-        exclude_stores = configs["exclude_stores"]
-        notification_configs = configs["notification_configs"]
-        scan_interval = configs["scan_interval"]
-        alert_exception = configs["alert_exception"]
+        # 扫描、配置和通知共用同一个连接池
+        set_transport(Transport.from_configs(configs))
+        self.transport = get_transport()
+        self.timeout = self.transport.timeout
+        # 配置了cluster时货源请求由各工作进程按分片发出，通知仍使用本进程的连接池
+        self.coordinator = Coordinator.from_configs(configs)
+        if self.coordinator is not None:
+            Utils.log("分片扫描已启用，监听{}:{}，当前共{}个工作进程".format(
+                *self.coordinator.address, len(self.coordinator.links)))
+            self.transport = ShardedTransport(self.coordinator, self.timeout)
+        # 货源请求按健康度和延迟分配到代理池中的各个代理
+        self.proxy_pool = ProxyPool.from_configs(configs)
+        if self.proxy_pool is not None:
+            self.transport = ProxiedTransport(self.transport, self.proxy_pool)
+        # 用无头浏览器获取真实的请求头和Cookie，被拦截时重新获取
+        self.session_bootstrapper = SessionBootstrapper.from_configs(configs)
+
+        self.notification_configs = configs.get("notification_configs", {})
+        # 通知在后台并行发送，不阻塞扫描
+        self.dispatcher = NotificationDispatcher.from_configs(configs)
+        self.alert_exception = configs.get("alert_exception", False)
+        # 商品分组并发请求使用的线程池
+        self.chunk_executor = ThreadPoolExecutor(max_workers=configs.get("chunk_concurrency", 4),
+                                                 thread_name_prefix="chunk")
+        # 按域名限速并根据限流情况调整扫描间隔
+        self.scheduler = ScanScheduler.from_configs(configs)
+        # 慢请求超过最近的p95耗时后再发一个对冲请求，线程池按所有任务的商品分组数计算
+        self.hedging = HedgedTransport.from_configs(configs, self.transport, self.scheduler,
+                                                    sum(len(job.chunks()) for job in jobs))
+        if self.hedging is not None:
+            self.transport = self.hedging
+        self.scan_latencies = collections.deque(maxlen=1000)
+        # 录制货源接口的原始响应，未配置时为None
+        self.recorder = ResponseRecorder.from_configs(configs)
+        # 货源历史库，未配置时为None
+        self.history = HistoryStore.from_configs(configs)
+        # 本地事件流，扫描完成后立即推送结构化的货源变化，未配置时为None
+        self.event_stream = EventStream.from_configs(configs)
+        self.apply_hot_windows(configs)
+        self.configs = configs
+
+    def setup_supervised(self, configs):
+        """
+        监督模式下监督进程只初始化货源状态表和通知分发器，扫描所需的组件由各工作进程各自初始化
+        """
+        if configs.get("cluster", {}).get("listen"):
+            # 每个任务的工作进程都会各自监听同一地址并启动分片工作进程，两者不能同时使用
+            raise ValueError("监督模式下不支持分片扫描，请去掉cluster.listen或关闭supervisor")
+        metrics.configure(configs)
+        logger.configure(configs)
+        if configs.get('base_url_overrides'):
+            self.regions_config = AppleStoreMonitor.load_regions_config(configs['base_url_overrides'])
+        set_transport(Transport.from_configs(configs))
+        self.notification_configs = configs.get("notification_configs", {})
+        self.dispatcher = NotificationDispatcher.from_configs(configs)
+        self.state = AvailabilityState.from_configs(configs)
+        self.alert_exception = configs.get("alert_exception", False)
+        if configs.get("event_stream", {}).get("enabled", False):
+            Utils.log("监督模式下不支持事件流，event_stream配置已忽略")
+        self.configs = configs
+        return self.validate_configs(configs)
+
+    def apply_hot_windows(self, configs):
+        hot_windows = configs.get("history", {}).get("hot_windows", 0)
+        if self.history is None or hot_windows <= 0:
+            return
+        # 在历史补货最多的几个小时内加快扫描
+        history_query = HistoryQuery(self.history.path)
+        windows = history_query.hot_windows(hot_windows, self.scheduler.hit_interval)
+        history_query.close()
+        self.scheduler.add_windows(windows)
+        if windows:
+            Utils.log("根据货源历史在以下时段加快扫描：{}".format(
+                "，".join("{} ~ {}".format(w["start"], w["end"]) for w in windows)))
+
+    def subscribe_default(self, job):
+        # 单用户模式下配置文件本身就是唯一的订阅者
+        job.subscribers = [Subscriber("default", job.selected_products, job.exclude_stores,
+                                      self.dispatcher, self.state, self.alert_exception)]
+
+    def prepare_job(self, job):
+        if job.region not in self.regions_config:
+            raise ValueError(f"不支持的地区: {job.region}")
+        # 使用本地地址库离线校验取货区域
+        if len(self.regions_config[job.region]['location_params']) > 0:
+            gazetteer = Gazetteer.load(job.region)
+            if gazetteer is not None and not gazetteer.contains(job.location):
+                Utils.log("警告：取货区域“{}”不在{}地址库中，请确认selected_area是否正确".format(
+                    job.location, self.regions_config[job.region]['name']))
+        job.host = urllib.parse.urlparse(self.regions_config[job.region]['base_url']).netloc
+        job.plan = ScanPlan(job, self.regions_config[job.region])
+        if self.event_stream is not None:
+            # 新的扫描计划会重新发布全部单元格
+            self.event_stream.reset(job.name)
+        if self.session_bootstrapper is not None and job.region not in self.session_bootstrapper.refreshed_at:
+            self.session_bootstrapper.bootstrap(job.region, self.regions_config[job.region], job,
+                                                self.headers_for(job.region, session=False))
+
+    def teardown(self):
+        self.chunk_executor.shutdown(wait=False)
+        if self.coordinator is not None:
+            self.coordinator.close()
+        if self.proxy_pool is not None:
+            for name, stats in self.proxy_pool.stats().items():
+                Utils.log("代理{}：{}".format(name, json.dumps(stats, ensure_ascii=False)))
+        if self.hedging is not None:
+            self.hedging.close()
+            Utils.log("对冲请求：{}，扫描耗时p99：{:.0f}ms".format(
+                json.dumps(self.hedging.stats(), ensure_ascii=False),
+                (quantile(self.scan_latencies, 0.99) or 0) * 1000))
+        self.dispatcher.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.history is not None:
+            self.history.close()
+        if self.event_stream is not None:
+            self.event_stream.close()
+        metrics.close()
+        logger.flush()
+
+    def start(self):
+        """
+        开始监控
+        """
+        config_file = 'apple_store_monitor_configs.json'
+        configs = json.load(open(config_file, encoding='utf-8'))
+        supervisor = None
+        if configs.get("supervisor", {}).get("enabled", False):
+            jobs = self.setup_supervised(configs)
+            supervisor = Supervisor.from_configs(self, configs, jobs)
+        else:
+            jobs = self.setup(configs)
         alert_startup = configs.get("alert_startup", True)  # 默认为True保持向后兼容
 
-        products_info = []
-        for index, product_info in enumerate(selected_products.items()):
-            products_info.append("【{}】{}".format(index, " ".join(product_info[1])))
-        message = "准备开始监测，地区：{}\n商品信息如下：\n{}\n取货区域：{}\n扫描频次：{}秒/次".format(
-            self.region_info['name'], "\n".join(products_info), selected_area, scan_interval)
+        jobs_info = []
+        for job in jobs:
+            products_info = []
+            for index, product_info in enumerate(job.selected_products.items()):
+                products_info.append("【{}】{}".format(index, " ".join(product_info[1])))
+            jobs_info.append("地区：{}\n商品信息如下：\n{}\n取货区域：{}\n扫描频次：{}秒/次".format(
+                self.regions_config[job.region]['name'], "\n".join(products_info), job.location, job.scan_interval))
+        message = "准备开始监测，{}".format("\n\n".join(jobs_info))
         Utils.log(message)
         if alert_startup:
-            Utils.send_message(notification_configs, message)
+            self.dispatcher.send(message)
 
-        params = {
-            "location": selected_area,
-            "mt": "regular",
+        if supervisor is not None:
+            # 各扫描任务在独立的工作进程中运行，监督进程负责看门狗、货源状态和通知
+            try:
+                supervisor.run()
+            finally:
+                self.dispatcher.close()
+                metrics.close()
+                logger.flush()
+            return
+
+        engine = ScanEngine(self.scan, jobs, self.scheduler, deadline=self.timeout * 3)
+        watcher = None
+        if configs.get("hot_reload", True):
+            # 配置文件变化后只把差异应用到运行中的扫描任务和通知渠道
+            watcher = ConfigWatcher(config_file, lambda path: self.reload(engine, path))
+            Utils.log("正在监听配置文件的变化（{}）".format(watcher.mode))
+        try:
+            asyncio.run(engine.run())
+        except KeyboardInterrupt:
+            Utils.log("监控已停止")
+        finally:
+            if watcher is not None:
+                watcher.close()
+            self.teardown()
+
+    def validate_configs(self, configs):
+        """
+        校验配置文件，返回其中的扫描任务列表，配置有误时抛出ValueError
+        """
+        jobs = ScanJob.from_configs(configs, self.region)
+        names = set()
+        for job in jobs:
+            if job.region not in self.regions_config:
+                raise ValueError("不支持的地区：{}".format(job.region))
+            if not isinstance(job.selected_products, dict) or len(job.selected_products) == 0:
+                raise ValueError("[{}] 没有选择要监控的商品".format(job.name))
+            if not isinstance(job.scan_interval, (int, float)) or job.scan_interval <= 0:
+                raise ValueError("[{}] 扫描间隔必须大于0".format(job.name))
+            if len(self.regions_config[job.region]['location_params']) > 0 and not job.location:
+                raise ValueError("[{}] 没有设置取货区域".format(job.name))
+            if job.name in names:
+                raise ValueError("重复的扫描任务：{}".format(job.name))
+            names.add(job.name)
+        # 构造调度器时会校验时段格式
+        ScanScheduler.from_configs(configs)
+        return jobs
+
+    def reload(self, engine, path):
+        """
+        重新加载配置文件，只更新有变化的部分，连接池和货源状态保持不变
+        """
+        started = time.perf_counter()
+        try:
+            with open(path, encoding='utf-8') as f:
+                configs = json.load(f)
+            new_jobs = self.validate_configs(configs)
+        except (ValueError, KeyError, TypeError) as err:
+            Utils.log("配置文件有误，继续使用原配置：{}".format(err))
+            return
+
+        old_configs = self.configs
+        changes = []
+        for section in restart_required_sections(old_configs, configs):
+            Utils.log("{}配置的修改需要重启监控后生效".format(section))
+
+        if old_configs.get("logging") != configs.get("logging"):
+            logger.configure(configs)
+            changes.append("日志输出")
+
+        if (old_configs.get("notification_configs") != configs.get("notification_configs") or
+                old_configs.get("notification_dispatcher") != configs.get("notification_dispatcher")):
+            old_dispatcher = self.dispatcher
+            self.dispatcher = NotificationDispatcher.from_configs(configs)
+            self.notification_configs = configs.get("notification_configs", {})
+            for job in engine.jobs:
+                for subscriber in job.subscribers:
+                    subscriber.dispatcher = self.dispatcher
+            # 旧的分发器在后台发送完队列中的消息后退出
+            threading.Thread(target=old_dispatcher.close, name="dispatcher-close", daemon=True).start()
+            changes.append("通知渠道：{}".format("、".join(self.dispatcher.workers) or "无"))
+
+        if configs.get("alert_exception", False) != self.alert_exception:
+            self.alert_exception = configs.get("alert_exception", False)
+            for job in engine.jobs:
+                for subscriber in job.subscribers:
+                    subscriber.alert_exception = self.alert_exception
+            changes.append("异常通知：{}".format("开启" if self.alert_exception else "关闭"))
+
+        reminder_interval = configs.get("state", {}).get("reminder_interval", 0)
+        if reminder_interval != self.state.reminder_interval:
+            self.state.reminder_interval = reminder_interval
+            changes.append("重复提醒间隔：{}秒".format(reminder_interval))
+
+        if (old_configs.get("schedule") != configs.get("schedule") or
+                old_configs.get("history", {}).get("hot_windows") != configs.get("history", {}).get("hot_windows")):
+            self.scheduler.update(ScanScheduler.from_configs(configs))
+            self.apply_hot_windows(configs)
+            changes.append("扫描节奏")
+
+        current = {job.name: job for job in engine.jobs}
+        for new_job in new_jobs:
+            job = current.pop(new_job.name, None)
+            if job is None:
+                self.subscribe_default(new_job)
+                self.prepare_job(new_job)
+                engine.add_job(new_job)
+                changes.append("新增任务{}".format(new_job.name))
+                continue
+            if (job.selected_products != new_job.selected_products or
+                    list(job.exclude_stores) != list(new_job.exclude_stores) or job.chunk_size != new_job.chunk_size):
+                # 等待正在进行的扫描结束后替换扫描计划，货源状态表保留，已通知过的货源不会重复告警
+                with job.lock:
+                    job.selected_products = new_job.selected_products
+                    job.exclude_stores = new_job.exclude_stores
+                    job.chunk_size = new_job.chunk_size
+                    self.subscribe_default(job)
+                    self.prepare_job(job)
+                changes.append("[{}] {}个商品，{}个排除的直营店".format(
+                    job.name, len(job.selected_products), len(job.exclude_stores)))
+            if job.scan_interval != new_job.scan_interval:
+                job.scan_interval = new_job.scan_interval
+                changes.append("[{}] 扫描频次：{}秒/次".format(job.name, job.scan_interval))
+        for job in current.values():
+            engine.remove_job(job)
+            if self.event_stream is not None:
+                self.event_stream.reset(job.name)
+            changes.append("移除任务{}".format(job.name))
+        if self.hedging is not None:
+            self.hedging.resize(sum(len(job.chunks()) for job in new_jobs))
+
+        self.configs = configs
+        Utils.log("配置已重新加载，耗时{:.1f}ms，{}".format(
+            (time.perf_counter() - started) * 1000, "；".join(changes) if changes else "没有需要更新的内容"))
+
+    def replay(self, archive, realtime=False):
+        """
+        使用录制文件代替真实请求，走完整的解析/检测/通知流程
+
+        :param archive: 录制文件路径
+        :param realtime: 为True时按录制时的时间间隔回放，否则尽可能快地回放
+        :return: 回放期间产生的通知消息列表
+        """
+        configs = {
+            "notification_configs": {},
+            "alert_exception": True,
+            "state": {"path": ""},
+            "schedule": {"requests_per_minute": 10 ** 9, "burst": 10 ** 9},
         }
+        self.setup(configs)
+        self.transport = ReplayTransport(self.timeout)
+        self.dispatcher = CollectingDispatcher()
+
+        jobs = {}
+        scans = read_archive(archive)
+        started = time.perf_counter()
+        first_time = scans[0][0]["time"] if scans else 0
+        for records in scans:
+            first = records[0]
+            parts = []
+            for record in records:
+                parts.extend(part for part in record["parts"] if part not in parts)
+            job = jobs.get(first["job"])
+            if job is None or job.product_codes != parts:
+                job = ScanJob(first["region"], first["location"], {part: [part] for part in parts},
+                              chunk_size=len(first["parts"]))
+                job.subscribers = [Subscriber("replay", job.selected_products, [], self.dispatcher, self.state, True)]
+                self.prepare_job(job)
+                jobs[first["job"]] = job
+            job.count = first["count"]
+
+            if realtime:
+                delay = (first["time"] - first_time) - (time.perf_counter() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            self.transport.load(records)
+            self.scan(job)
+
+        elapsed = time.perf_counter() - started
+        Utils.log("回放完成：共{}次扫描，耗时{:.2f}秒，{:.1f}次扫描/秒，产生{}条通知".format(
+            len(scans), elapsed, len(scans) / elapsed if elapsed > 0 else 0, len(self.dispatcher.messages)))
+        self.teardown()
+        return self.dispatcher.messages
+
+    def serve(self, server_config_file):
+        """
+        多用户订阅模式：合并所有订阅者的配置后统一扫描，请求量只随不同的商品型号增长
+        """
+        with open(server_config_file, encoding='utf-8') as f:
+            configs = json.load(f)
 
-        code_index = 0
-        product_codes = selected_products.keys()
-        for product_code in product_codes:
-            params["parts.{}".format(code_index)] = product_code
-            code_index += 1
+        subscriber_configs = load_subscriber_configs(configs.get("subscribers", []))
+        if len(subscriber_configs) == 0:
+            Utils.log("没有找到订阅者配置")
+            return
+        jobs = merge_subscriptions(subscriber_configs, configs)
+        # 只初始化公共组件，扫描任务全部来自合并后的订阅，不按服务端配置的顶层字段创建默认任务
+        self.setup_components(configs, jobs)
+        for job in jobs:
+            self.prepare_job(job)
+            Utils.log("[{}] {}个订阅者，{}个商品型号，每轮{}次请求，扫描频次：{}秒/次".format(
+                job.name, len(job.subscribers), len(job.product_codes), len(job.chunks()), job.scan_interval))
+
+        engine = ScanEngine(self.scan, jobs, self.scheduler, deadline=self.timeout * 3)
+        try:
+            asyncio.run(engine.run())
+        except KeyboardInterrupt:
+            Utils.log("监控已停止")
+        finally:
+            self.teardown()
+            for subscriber in {id(s.dispatcher): s for job in jobs for s in job.subscribers}.values():
+                subscriber.dispatcher.close()
+
+    def fetch_chunk(self, job, product_codes):
+        """
+        请求一组商品的货源信息，返回直营店列表和耗时（秒）
+        """
+        region_info = self.regions_config[job.region]
+        params = job.params(product_codes)
+        # 更新请求时间
+        params["_"] = int(time.time() * 1000)
 
-        # 上次整点通知时间
-        last_exactly_time = -1
-        while True:
-            available_list = []
-            tm_hour = time.localtime(time.time()).tm_hour
+        self.scheduler.acquire(job.host)
+        started = time.perf_counter()
+        try:
+            response = self.transport.get(region_info['base_url'] + region_info['fulfillment_endpoint'],
+                                          headers=self.headers_for(job.region),
+                                          params=params,
+                                          timeout=self.timeout)
+        except Exception as err:
+            self.scheduler.observe(job.host, error=err)
+            metrics.http_responses_total.inc(job.host, "error")
+            raise
+        latency = time.perf_counter() - started
+        self.scheduler.observe(job.host, response.status_code, latency)
+        metrics.fulfillment_latency.observe(latency, job.host)
+        metrics.http_responses_total.inc(job.host, response.status_code)
+        if self.recorder is not None:
+            self.recorder.record(job, product_codes, response, latency)
+        if response.status_code in ScanScheduler.THROTTLE_STATUSES:
+            raise Exception("请求被限流，状态码：{}".format(response.status_code))
+        if self.session_bootstrapper is not None and self.session_bootstrapper.is_blocked(response.status_code):
+            self.session_bootstrapper.refresh_async(job.region, region_info, job,
+                                                    self.headers_for(job.region, session=False))
+            raise Exception("请求被拦截，状态码：{}".format(response.status_code))
+
+        # 根据不同地区的API结构获取stores数据
+        parse_started = time.perf_counter()
+        stores = parse_stores(response.content, region_info.get('stores_path'), product_codes)
+        metrics.parse_seconds.observe(time.perf_counter() - parse_started, job.region)
+        return stores, latency
+
+    def fetch_stores(self, job):
+        """
+        分组并发请求所有商品，按直营店合并结果
+
+        :return: (合并后的直营店列表, 失败的分组异常列表)，全部分组失败时抛出第一个异常
+        """
+        chunks = job.chunks()
+        if len(chunks) == 1:
+            return self.fetch_chunk(job, chunks[0])[0], []
+
+        futures = [self.chunk_executor.submit(self.fetch_chunk, job, product_codes) for product_codes in chunks]
+        merged = {}
+        errors = []
+        for index, future in enumerate(futures):
             try:
-                # 更新请求时间
-                params["_"] = int(time.time() * 1000)
+                stores, latency = future.result()
+            except Exception as err:
+                logger.error("[{}] 第{}/{}组商品请求失败：{}".format(job.name, index + 1, len(chunks), repr(err)),
+                             job=job.name, chunk=index)
+                errors.append(err)
+                continue
+            if logger.detail:
+                Utils.log("[{}] 第{}/{}组商品（{}个）请求耗时{:.0f}ms".format(
+                    job.name, index + 1, len(chunks), len(chunks[index]), latency * 1000))
+            for item in stores:
+                merged_item = merged.get(item.store_number)
+                if merged_item is None:
+                    merged[item.store_number] = item
+                else:
+                    merged_item.parts.update(item.parts)
 
-                response = requests.get(self.region_info['base_url'] + self.region_info['fulfillment_endpoint'],
-                                        headers=self.headers,
-                                        params=params,
-                                        timeout=self.timeout)
+        if len(errors) == len(chunks):
+            raise errors[0]
+        return list(merged.values()), errors
 
-                json_result = json.loads(response.text)
-                
-                # 根据不同地区的API结构获取stores数据
-                if self.region == 'hk':
-                    # 香港地区API结构
-                    stores = json_result['body']['stores']
-                else:
-                    # 中国大陆等地区API结构
-                    stores = json_result['body']['content']['pickupMessage']['stores']
+    def scan(self, job):
+        """
+        执行一次扫描，返回有货的直营店列表
+        """
+        # 重新加载配置时会等待正在进行的扫描结束
+        with job.lock:
+            return self.scan_job(job)
+
+    def scan_job(self, job):
+        plan = job.plan
+        available_list = []
+        started_at = time.time()
+        tm_hour = time.localtime(started_at).tm_hour
+        scan_started = time.perf_counter()
+        metrics.scans_total.inc(job.name)
+        try:
+            stores, errors = self.fetch_stores(job)
+            fetch_seconds = time.perf_counter() - scan_started
+            if logger.detail:
                 Utils.log(
-                    '-------------------- 第{}次扫描 --------------------'.format(
-                        self.count + 1))
-                for item in stores:
-                    store_name = item['storeName']
-                    if item["storeNumber"] in exclude_stores:
-                        print("【{}：已排除】".format(store_name))
-                        continue
-                    print("{:-<100}".format("【{}】".format(store_name)))
-                    for product_code in product_codes:
-                        pickup_search_quote = item['partsAvailability'][product_code]['pickupSearchQuote']
-                        pickup_display = item['partsAvailability'][product_code]['pickupDisplay']
-                        store_pickup_product_title = item['partsAvailability'][product_code]['messageTypes']['regular']['storePickupProductTitle']
-                        print('\t【{}】{}'.format(pickup_search_quote, store_pickup_product_title))
-                        # 根据地区判断可用状态
-                        available_statuses = [self.region_info['available_status']]
-                        if 'available_status_alt' in self.region_info:
-                            available_statuses.append(self.region_info['available_status_alt'])
-                        
-                        is_available = (pickup_search_quote in available_statuses or 
-                                        pickup_display != 'unavailable')
-                        if is_available:
-                            available_list.append((store_name, product_code, store_pickup_product_title))
-
-                if len(available_list) > 0:
-                    messages = []
-                    print("命中货源，请注意 >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-                    Utils.log("以下直营店预约可用：")
-                    for item in available_list:
-                        messages.append("【{}】 {}".format(item[0], item[2]))
-                        print("【{}】{}".format(item[0], item[2]))
-                    print("命中货源，请注意 >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-
-                    Utils.send_message(notification_configs,
-                                       Utils.time_title(
-                                           "第{}次扫描到直营店有货，信息如下：\n{}".format(self.count, "\n".join(messages))))
+                    '-------------------- [{}] 第{}次扫描 --------------------'.format(
+                        job.name, job.count))
+            detect_started = time.perf_counter()
+            changed = plan.evaluate(stores)
+            detect_seconds = time.perf_counter() - detect_started
+            if self.event_stream is not None:
+                self.event_stream.publish_scan(job, plan, changed, started_at, started_at + fetch_seconds)
+            if self.history is not None:
+                self.history.record(plan)
+            if logger.detail:
+                self.log_stores(plan, stores)
+
+            available = plan.available()
+            for index in available:
+                store_number, store_name, product_code, title, _ = plan.cell(index)
+                available_list.append((store_name, product_code, title))
+
+            if len(available_list) > 0:
+                self.log_hits(job, available_list)
+
+            # 只有变化的单元格和仍然有货的单元格需要交给状态表（后者用于重复提醒）
+            detect_started = time.perf_counter()
+            indexes = sorted(set(changed).union(available))
+            transitions = [(subscriber, subscriber.observe(plan, indexes)) for subscriber in job.subscribers]
+            detect_seconds += time.perf_counter() - detect_started
+            metrics.detect_seconds.observe(detect_seconds, job.name)
+            for subscriber, (became_available, became_unavailable, reminders) in transitions:
+                self.notify_transitions(job, subscriber.dispatcher, became_available, became_unavailable, reminders)
+
+            for err in errors:
+                self.alert_error(job, err, tm_hour)
+            if len(errors) == 0:
+                job.last_success = time.time()
+                metrics.last_success_timestamp.set(job.last_success, job.name)
+
+            if logger.summary:
+                logger.info("[{}] 第{}次扫描：{}个直营店，{}个商品，有货{}个，变化{}个，失败分组{}个，"
+                            "请求{:.0f}ms，检测{:.1f}ms，总耗时{:.0f}ms".format(
+                                job.name, job.count, len(stores), len(plan.product_codes), len(available_list),
+                                len(changed), len(errors), fetch_seconds * 1000, detect_seconds * 1000,
+                                (time.perf_counter() - scan_started) * 1000),
+                            event="scan", job=job.name, count=job.count, stores=len(stores),
+                            parts=len(plan.product_codes), available=len(available_list), changed=len(changed),
+                            errors=len(errors), fetch_ms=round(fetch_seconds * 1000, 1),
+                            detect_ms=round(detect_seconds * 1000, 2),
+                            scan_ms=round((time.perf_counter() - scan_started) * 1000, 1))
+
+        except Exception as err:
+            logger.error(err, job=job.name, count=job.count, type=type(err).__name__)
+            self.alert_error(job, err, tm_hour)
+
+        scan_seconds = time.perf_counter() - scan_started
+        metrics.scan_seconds.observe(scan_seconds, job.name)
+        self.scan_latencies.append(scan_seconds)
+        return available_list
 
-            except Exception as err:
-                Utils.log(err)
-                # 6:00 ~ 23:00才发送异常消息
-                if alert_exception and 6 <= tm_hour <= 23:
-                    Utils.send_message(notification_configs,
-                                       Utils.time_title("第{}次扫描出现异常：{}".format(self.count, repr(err))))
-
-            if len(available_list) == 0:
-                interval = max(random.randint(int(scan_interval / 2), scan_interval * 2), 5)
-                Utils.log('{}秒后进行第{}次尝试...'.format(interval, self.count))
-
-                # 整点通知已禁用 - 只在有货或异常时才通知
-                # if last_exactly_time != tm_hour and (6 <= tm_hour <= 23):
-                #     Utils.send_message(notification_configs,
-                #                        Utils.time_title("已扫描{}次，扫描程序运行正常".format(self.count)))
-                #     last_exactly_time = tm_hour
-                time.sleep(interval)
-            else:
-                time.sleep(5)
+    @staticmethod
+    def log_stores(plan, stores):
+        """
+        输出每个直营店、每个商品的货源明细
+        """
+        for item in stores:
+            if logger.json_format:
+                logger.info("", event="store", store=item.store_number, name=item.store_name,
+                            excluded=plan.is_excluded(item),
+                            parts={code: item.parts[code].quote for code in plan.product_codes if code in item.parts})
+                continue
+            if plan.is_excluded(item):
+                logger.info("【{}：已排除】".format(item.store_name), timestamp=False)
+                continue
+            lines = ["{:-<100}".format("【{}】".format(item.store_name))]
+            for product_code in plan.product_codes:
+                part = item.parts.get(product_code)
+                # 所在分组请求失败的商品本轮跳过
+                if part is not None:
+                    lines.append('\t【{}】{}'.format(part.quote, part.title))
+            logger.info("\n".join(lines), timestamp=False)
 
-            # 次数自增
-            self.count += 1
+    @staticmethod
+    def log_hits(job, available_list):
+        """
+        命中货源时立即输出，不经过缓冲
+        """
+        if logger.json_format:
+            logger.hit("", job=job.name, count=job.count,
+                       items=[{"store": store_name, "part": code, "title": title}
+                              for store_name, code, title in available_list])
+            return
+        banner = "命中货源，请注意 >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>"
+        logger.hit(banner, timestamp=False)
+        logger.hit("以下直营店预约可用：")
+        logger.hit("\n".join("【{}】{}".format(item[0], item[2]) for item in available_list), timestamp=False)
+        logger.hit(banner, timestamp=False)
+
+    def alert_error(self, job, err, tm_hour):
+        metrics.exceptions_total.inc(job.name, type(err).__name__)
+        # 6:00 ~ 23:00才发送异常消息
+        if not 6 <= tm_hour <= 23:
+            return
+        message = Utils.time_title("[{}] 第{}次扫描出现异常：{}".format(job.name, job.count, repr(err)))
+        dispatchers = {id(s.dispatcher): s.dispatcher for s in job.subscribers if s.alert_exception}
+        for dispatcher in dispatchers.values():
+            dispatcher.send(message, priority=PRIORITY_ERROR)
+
+    def notify_transitions(self, job, dispatcher, became_available, became_unavailable, reminders):
+        """
+        根据货源状态的翻转发送通知
+        """
+        def format_items(transitions):
+            return "\n".join("【{}】 {}".format(t.store_name, t.title) for t in transitions)
+
+        if len(became_available) > 0:
+            metrics.availability_edges_total.inc(job.name, "available", amount=len(became_available))
+        if len(became_unavailable) > 0:
+            metrics.availability_edges_total.inc(job.name, "unavailable", amount=len(became_unavailable))
+
+        messages = []
+        if len(became_available) > 0:
+            messages.append("第{}次扫描到直营店有货，信息如下：\n{}".format(job.count, format_items(became_available)))
+        if len(reminders) > 0:
+            messages.append("以下直营店仍然有货：\n{}".format(format_items(reminders)))
+        if len(became_unavailable) > 0:
+            messages.append("以下直营店已无货：\n{}".format(format_items(became_unavailable)))
+        if len(messages) > 0:
+            dispatcher.send(Utils.time_title("\n".join(messages)))
 
 
 if __name__ == '__main__':
     args = sys.argv
 
-    if len(args) < 2 or len(args) > 3:
+    if len(args) < 2 or len(args) > 4:
         print("""
         Usage: python {} <option> [region]
         option can be:
         \tconfig: pre config of products or notification
         \tstart: start to monitor
+        \tonce: run a single scan and exit (see oneshot.py)
+        \treplay <archive> [realtime]: replay recorded fulfillment responses
+        \tserve <server_config>: multi-tenant mode, merge polls of all subscriber configs
         region can be:
         \tcn: 中国大陆 (default)
         \thk: 香港
         """.format(args[0]))
         exit(1)
 
+    if args[1] == "replay" and len(args) >= 3:
+        AppleStoreMonitor().replay(args[2], len(args) == 4 and args[3] == "realtime")
+        exit(0)
+
+    if args[1] == "serve" and len(args) == 3:
+        AppleStoreMonitor().serve(args[2])
+        exit(0)
+
     # 获取地区参数，默认为中国大陆
     region = args[2] if len(args) == 3 else 'cn'
 
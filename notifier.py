@@ -0,0 +1,271 @@
+# -*- coding: UTF-8 –*-
+"""
+并行消息分发：每个通知渠道拥有独立的有界队列和后台线程
+
+短时间内到达的多条消息会合并为一条摘要，每个渠道按各自的频率限制发送，货源消息优先于异常消息
+"""
+
+import collections
+import json
+import threading
+import time
+
+from metrics import metrics
+from scheduler import TokenBucket
+from utils import Utils
+
+# 消息优先级，数值越小越优先
+PRIORITY_AVAILABILITY = 0
+PRIORITY_ERROR = 1
+
+# 各渠道默认的每分钟发送上限，钉钉群机器人每分钟最多20条
+DEFAULT_RATE_LIMITS = {
+    "dingtalk": 20,
+    "telegram": 20,
+    "bark": 60,
+}
+
+
+class NotificationTask:
+    __slots__ = ("message", "kwargs", "enqueued_at", "attempts", "priority", "merged")
+
+    def __init__(self, message, kwargs, priority=PRIORITY_AVAILABILITY):
+        self.message = message
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.priority = priority
+        self.merged = 1
+
+
+class ChannelWorker:
+    """
+    单个通知渠道的后台发送线程
+
+    - 收到第一条消息后最多等待coalesce_window秒，期间到达的消息合并为一条摘要
+    - 按令牌桶限制发送频率，令牌不足时继续合并新到达的消息
+    - 只有异常消息时会为货源消息预留reserve_tokens个令牌
+    - 失败后按指数退避重试，重试耗尽后写入死信
+    """
+
+    def __init__(self, name, send_func, channel_configs, dispatcher):
+        self.name = name
+        self.send_func = send_func
+        self.channel_configs = channel_configs
+        self.dispatcher = dispatcher
+        self.pending = {PRIORITY_AVAILABILITY: collections.deque(), PRIORITY_ERROR: collections.deque()}
+        rate_limit = dispatcher.rate_limits.get(name, DEFAULT_RATE_LIMITS.get(name, 60))
+        self.bucket = TokenBucket(rate_limit / 60, dispatcher.burst)
+        self.latencies = []
+        self.delivered = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closing = False
+        self._condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="notify-{}".format(name), daemon=True)
+        self.thread.start()
+
+    def qsize(self):
+        return sum(len(tasks) for tasks in self.pending.values())
+
+    def put(self, task):
+        dropped = None
+        with self._condition:
+            if self.qsize() >= self.dispatcher.queue_size:
+                # 队列已满时优先丢弃最早的异常消息
+                if self.pending[PRIORITY_ERROR] and task.priority == PRIORITY_AVAILABILITY:
+                    dropped = self.pending[PRIORITY_ERROR].popleft()
+                else:
+                    dropped = task
+            if dropped is not task:
+                self.pending[task.priority].append(task)
+                self._condition.notify()
+        if dropped is not None:
+            self.dropped += 1
+            self.dispatcher.dead_letter(self.name, dropped, "队列已满")
+
+    def run(self):
+        while True:
+            with self._condition:
+                while not self.closing and self.qsize() == 0:
+                    self._condition.wait()
+                if self.qsize() == 0:
+                    return
+                # 等待合并窗口结束，关闭时立即发送
+                first_at = min(tasks[0].enqueued_at for tasks in self.pending.values() if tasks)
+                deadline = first_at + self.dispatcher.coalesce_window
+                while not self.closing and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                # 等待发送令牌，期间新到达的消息继续合并
+                while True:
+                    reserve = 0
+                    if not self.pending[PRIORITY_AVAILABILITY]:
+                        reserve = min(self.dispatcher.reserve_tokens, self.bucket.capacity - 1)
+                    wait = self.bucket.try_acquire(reserve)
+                    if wait <= 0 or self.closing:
+                        break
+                    self._condition.wait(wait)
+                tasks = list(self.pending[PRIORITY_AVAILABILITY]) + list(self.pending[PRIORITY_ERROR])
+                self.pending[PRIORITY_AVAILABILITY].clear()
+                self.pending[PRIORITY_ERROR].clear()
+            self.deliver(self.digest(tasks))
+
+    def digest(self, tasks):
+        """
+        将多条消息合并为一条，货源消息在前；异常消息较多时只保留最早和最近的一条
+        """
+        if len(tasks) == 1:
+            return tasks[0]
+        self.coalesced += len(tasks) - 1
+        availability = [task.message for task in tasks if task.priority == PRIORITY_AVAILABILITY]
+        errors = [task.message for task in tasks if task.priority == PRIORITY_ERROR]
+        if len(errors) > 2:
+            errors = [errors[0], "……期间共出现{}次异常……".format(len(errors)), errors[-1]]
+        task = NotificationTask("\n\n".join(availability + errors), tasks[0].kwargs, tasks[0].priority)
+        task.enqueued_at = min(t.enqueued_at for t in tasks)
+        task.merged = len(tasks)
+        return task
+
+    def deliver(self, task):
+        dispatcher = self.dispatcher
+        while True:
+            task.attempts += 1
+            error = None
+            try:
+                response = self.send_func(self.channel_configs, task.message,
+                                          timeout=dispatcher.timeout, **task.kwargs)
+                if response is None:
+                    # 渠道未配置
+                    return
+                if response.status_code == 429 or response.status_code >= 500:
+                    error = "状态码{}".format(response.status_code)
+            except Exception as err:
+                error = repr(err)
+
+            if error is None:
+                latency = time.monotonic() - task.enqueued_at
+                self.delivered += 1
+                self.latencies.append(latency)
+                del self.latencies[:-dispatcher.latency_window]
+                metrics.notification_seconds.observe(latency, self.name)
+                Utils.log("{}消息送达{}，入队到送达耗时{:.0f}ms".format(
+                    self.name, "（合并{}条）".format(task.merged) if task.merged > 1 else "", latency * 1000))
+                return
+
+            if task.attempts > dispatcher.max_retries:
+                self.failed += 1
+                dispatcher.dead_letter(self.name, task, error)
+                return
+
+            backoff = dispatcher.backoff * (2 ** (task.attempts - 1))
+            Utils.log("{}消息发送失败：{}，{}秒后第{}次重试".format(self.name, error, backoff, task.attempts))
+            time.sleep(backoff)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        stats = {
+            "queued": self.qsize(),
+            "delivered": self.delivered,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+            "dropped": self.dropped,
+        }
+        if latencies:
+            stats["latency_avg_ms"] = round(sum(latencies) / len(latencies) * 1000, 1)
+            stats["latency_p95_ms"] = round(latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1000, 1)
+        return stats
+
+    def close(self):
+        """
+        不再等待合并窗口和发送令牌，立即发送队列中剩余的消息后退出
+        """
+        with self._condition:
+            self.closing = True
+            self._condition.notify_all()
+
+
+class NotificationDispatcher:
+    """
+    消息分发器，send()只负责入队并立即返回，各渠道并行发送互不阻塞
+    """
+
+    CHANNELS = {
+        "dingtalk": Utils.send_dingtalk_message,
+        "bark": Utils.send_bark_message,
+        "telegram": Utils.send_telegram_message,
+    }
+
+    def __init__(self, notification_configs, queue_size=100, timeout=5, max_retries=3, backoff=1,
+                 dead_letter_file="notification_dead_letters.jsonl", latency_window=1000, coalesce_window=2,
+                 rate_limits=None, burst=3, reserve_tokens=1):
+        """
+        :param coalesce_window: 合并窗口（秒），即合并给第一条消息带来的最大额外延迟
+        :param rate_limits: 各渠道每分钟的发送上限，未配置的渠道使用DEFAULT_RATE_LIMITS
+        :param burst: 各渠道令牌桶的容量
+        :param reserve_tokens: 只有异常消息时为货源消息预留的令牌数
+        """
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.dead_letter_file = dead_letter_file
+        self.latency_window = latency_window
+        self.coalesce_window = coalesce_window
+        self.rate_limits = rate_limits or {}
+        self.burst = burst
+        self.reserve_tokens = reserve_tokens
+        self._dead_letter_lock = threading.Lock()
+        self.workers = {}
+        for name, send_func in self.CHANNELS.items():
+            if name in notification_configs:
+                self.workers[name] = ChannelWorker(name, send_func, notification_configs[name], self)
+
+    @staticmethod
+    def from_configs(configs):
+        dispatcher_configs = configs.get("notification_dispatcher", {})
+        return NotificationDispatcher(configs.get("notification_configs", {}),
+                                      queue_size=dispatcher_configs.get("queue_size", 100),
+                                      timeout=dispatcher_configs.get("timeout", 5),
+                                      max_retries=dispatcher_configs.get("max_retries", 3),
+                                      backoff=dispatcher_configs.get("backoff", 1),
+                                      dead_letter_file=dispatcher_configs.get("dead_letter_file",
+                                                                              "notification_dead_letters.jsonl"),
+                                      coalesce_window=dispatcher_configs.get("coalesce_window", 2),
+                                      rate_limits=dispatcher_configs.get("rate_limits"),
+                                      burst=dispatcher_configs.get("burst", 3),
+                                      reserve_tokens=dispatcher_configs.get("reserve_tokens", 1))
+
+    def send(self, message, priority=PRIORITY_AVAILABILITY, **kwargs):
+        if len(message) == 0:
+            return
+        for worker in self.workers.values():
+            worker.put(NotificationTask(message, kwargs, priority))
+
+    def dead_letter(self, channel, task, reason):
+        Utils.log("{}消息投递失败，已写入死信：{}".format(channel, reason))
+        if not self.dead_letter_file:
+            return
+        record = {
+            "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "channel": channel,
+            "reason": reason,
+            "attempts": task.attempts,
+            "message": task.message,
+        }
+        with self._dead_letter_lock:
+            with open(self.dead_letter_file, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def stats(self):
+        return {name: worker.stats() for name, worker in self.workers.items()}
+
+    def close(self, timeout=10):
+        """
+        等待队列中的消息发送完毕后停止后台线程
+        """
+        for worker in self.workers.values():
+            worker.close()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers.values():
+            worker.thread.join(max(deadline - time.monotonic(), 0))
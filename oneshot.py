@@ -0,0 +1,247 @@
+# -*- coding: UTF-8 –*-
+"""
+单次扫描模式：每次调用对所有扫描任务执行一次扫描，保存货源状态后退出，供cron或云函数调用
+
+- 配置文件和regions.json预先编译为快照，只包含扫描需要的字段；快照不存在或源文件变化时自动重新编译
+- 只导入扫描需要的模块，不启动事件循环、配置监听、事件流等常驻组件，也不发送启动通知
+- 所有任务的所有商品分组并发请求
+- 货源状态与监控模式共用同一个状态文件，跨调用只在有货/无货翻转时通知
+
+用法：python oneshot.py [配置文件] [快照文件]
+预先编译快照：python oneshot.py compile [配置文件] [快照文件]
+"""
+
+import time
+
+STARTED = time.perf_counter()
+
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from fulfillment_parser import parse_stores
+from notifier import NotificationDispatcher, PRIORITY_ERROR
+from scan_log import logger
+from scan_plan import ScanPlan
+from scheduler import ScanScheduler
+from state import AvailabilityState
+from transport import Transport, get_transport, set_transport
+from utils import Utils
+
+IMPORTED = time.perf_counter()
+
+CONFIG_FILE = "apple_store_monitor_configs.json"
+SNAPSHOT_FILE = "scan_snapshot.json"
+SNAPSHOT_VERSION = 1
+# 扫描需要的地区配置字段
+REGION_FIELDS = ("name", "available_status", "available_status_alt", "stores_path")
+# 原样复制到快照中的配置字段
+COPIED_SECTIONS = ("transport", "state", "logging", "notification_configs", "notification_dispatcher",
+                   "alert_exception", "chunk_concurrency")
+
+
+class SnapshotJob:
+    """
+    快照中预先编译好的扫描任务：请求地址、请求头和每个分组的查询参数都已确定
+    """
+
+    def __init__(self, name, region, url, headers, chunks, selected_products, exclude_stores, region_info):
+        self.name = name
+        self.region = region
+        self.url = url
+        self.headers = headers
+        self.chunks = chunks
+        self.selected_products = selected_products
+        self.exclude_stores = exclude_stores
+        self.region_info = region_info
+
+    @property
+    def product_codes(self):
+        return list(self.selected_products.keys())
+
+
+def source_signature(config_path):
+    """
+    快照的来源：配置文件和regions.json的修改时间、大小，以及覆盖base_url的环境变量
+    """
+    signature = {"APPLE_STORE_BASE_URL": os.environ.get("APPLE_STORE_BASE_URL", "")}
+    for path in (config_path, "regions.json"):
+        stat = os.stat(path)
+        signature[path] = [stat.st_mtime_ns, stat.st_size]
+    return signature
+
+
+def compile_snapshot(config_path=CONFIG_FILE, snapshot_path=SNAPSHOT_FILE):
+    """
+    校验配置文件并编译为快照，只在这里导入完整的监控模块
+    """
+    from monitor import AppleStoreMonitor
+
+    with open(config_path, encoding='utf-8') as f:
+        configs = json.load(f)
+    monitor = AppleStoreMonitor(configs.get("region", "cn"))
+    if configs.get('base_url_overrides'):
+        monitor.regions_config = AppleStoreMonitor.load_regions_config(configs['base_url_overrides'])
+    jobs = []
+    for job in monitor.validate_configs(configs):
+        region_info = monitor.regions_config[job.region]
+        jobs.append({
+            "name": job.name,
+            "region": job.region,
+            "url": region_info['base_url'] + region_info['fulfillment_endpoint'],
+            "headers": monitor.headers_for(job.region, session=False),
+            "chunks": [job.params(product_codes) for product_codes in job.chunks()],
+            "selected_products": job.selected_products,
+            "exclude_stores": list(job.exclude_stores),
+            "region_info": {field: region_info.get(field) for field in REGION_FIELDS},
+        })
+
+    snapshot = {section: configs[section] for section in COPIED_SECTIONS if section in configs}
+    snapshot.update(version=SNAPSHOT_VERSION, sources=source_signature(config_path), jobs=jobs)
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_path, snapshot_path)
+    Utils.log("已编译扫描快照{}：{}个扫描任务".format(snapshot_path, len(jobs)))
+    return snapshot
+
+
+def load_snapshot(config_path=CONFIG_FILE, snapshot_path=SNAPSHOT_FILE):
+    """
+    加载快照，快照不存在、版本不同或源文件有变化时重新编译；只部署了快照时直接使用快照
+    """
+    try:
+        with open(snapshot_path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except FileNotFoundError:
+        return compile_snapshot(config_path, snapshot_path)
+    if not os.path.exists(config_path):
+        return snapshot
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("sources") != source_signature(config_path):
+        return compile_snapshot(config_path, snapshot_path)
+    return snapshot
+
+
+def process_age():
+    """
+    进程启动至今的秒数（包括解释器启动，精度为一个时钟周期），非Linux平台返回None
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def fetch_chunk(job, params):
+    """
+    请求一组商品的货源信息，返回直营店列表和耗时（秒）
+    """
+    transport = get_transport()
+    params = dict(params, _=int(time.time() * 1000))
+    started = time.perf_counter()
+    response = transport.get(job.url, headers=job.headers, params=params, timeout=transport.timeout)
+    latency = time.perf_counter() - started
+    if response.status_code in ScanScheduler.THROTTLE_STATUSES:
+        raise Exception("请求被限流，状态码：{}".format(response.status_code))
+    return parse_stores(response.content, job.region_info.get('stores_path'), job.product_codes), latency
+
+
+def format_items(transitions):
+    return "\n".join("【{}】 {}".format(t.store_name, t.title) for t in transitions)
+
+
+def run_once(config_path=CONFIG_FILE, snapshot_path=SNAPSHOT_FILE):
+    """
+    执行一次扫描
+
+    :return: 进程退出码，有扫描任务的全部分组请求失败时为1
+    """
+    load_started = time.perf_counter()
+    snapshot = load_snapshot(config_path, snapshot_path)
+    logger.configure(snapshot)
+    set_transport(Transport.from_configs(snapshot))
+    dispatcher = NotificationDispatcher.from_configs(snapshot)
+    state = AvailabilityState.from_configs(snapshot)
+    jobs = [SnapshotJob(**job) for job in snapshot["jobs"]]
+    ready = time.perf_counter()
+    startup_seconds = process_age() or ready - STARTED
+
+    # 所有任务的所有分组并发请求
+    tasks = [(job, params) for job in jobs for params in job.chunks]
+    with ThreadPoolExecutor(max_workers=min(len(tasks), snapshot.get("chunk_concurrency", 4) * len(jobs))) as executor:
+        futures = [executor.submit(fetch_chunk, job, params) for job, params in tasks]
+    fetch_seconds = time.perf_counter() - ready
+
+    results = {job.name: ([], []) for job in jobs}
+    latencies = []
+    for (job, _), future in zip(tasks, futures):
+        stores, errors = results[job.name]
+        try:
+            chunk_stores, latency = future.result()
+        except Exception as err:
+            logger.error("[{}] 商品请求失败：{}".format(job.name, repr(err)), job=job.name)
+            errors.append(err)
+            continue
+        latencies.append(latency)
+        stores.extend(chunk_stores)
+
+    exit_code = 0
+    tm_hour = time.localtime().tm_hour
+    for job in jobs:
+        stores, errors = results[job.name]
+        if len(errors) == len(job.chunks):
+            exit_code = 1
+        if errors and snapshot.get("alert_exception", False) and 6 <= tm_hour <= 23:
+            dispatcher.send(Utils.time_title("[{}] 单次扫描出现异常：{}".format(job.name, repr(errors[0]))),
+                            priority=PRIORITY_ERROR)
+
+        # 全新的扫描计划中每个观测到的单元格都是变化，是否翻转由持久化的状态表判断
+        plan = ScanPlan(job, job.region_info)
+        changed = plan.evaluate(stores)
+        became_available, became_unavailable, reminders = state.update([plan.cell(index) for index in changed])
+        available = plan.available()
+        if available:
+            logger.hit("[{}] 以下直营店预约可用：\n{}".format(job.name, "\n".join(
+                "【{}】{}".format(plan.cell(index)[1], plan.cell(index)[3]) for index in available)))
+
+        messages = []
+        if len(became_available) > 0:
+            messages.append("扫描到直营店有货，信息如下：\n{}".format(format_items(became_available)))
+        if len(reminders) > 0:
+            messages.append("以下直营店仍然有货：\n{}".format(format_items(reminders)))
+        if len(became_unavailable) > 0:
+            messages.append("以下直营店已无货：\n{}".format(format_items(became_unavailable)))
+        if len(messages) > 0:
+            dispatcher.send(Utils.time_title("\n".join(messages)))
+        logger.info("[{}] 单次扫描：{}个直营店，{}个商品，有货{}个，新到货{}个，售罄{}个，失败分组{}个".format(
+            job.name, len(plan.store_numbers), len(plan.product_codes), len(available), len(became_available),
+            len(became_unavailable), len(errors)),
+            event="scan", job=job.name, stores=len(plan.store_numbers), parts=len(plan.product_codes),
+            available=len(available), became_available=len(became_available),
+            became_unavailable=len(became_unavailable), errors=len(errors))
+
+    dispatcher.close()
+    slowest = max(latencies) if latencies else 0
+    logger.info("单次扫描完成：启动{:.0f}ms（导入{:.0f}ms，加载快照{:.1f}ms），请求{:.0f}ms（最慢分组{:.0f}ms），"
+                "总耗时{:.0f}ms".format(startup_seconds * 1000, (IMPORTED - STARTED) * 1000,
+                                     (ready - load_started) * 1000, fetch_seconds * 1000, slowest * 1000,
+                                     (process_age() or time.perf_counter() - STARTED) * 1000),
+                event="once", startup_ms=round(startup_seconds * 1000, 1),
+                import_ms=round((IMPORTED - STARTED) * 1000, 1), load_ms=round((ready - load_started) * 1000, 2),
+                fetch_ms=round(fetch_seconds * 1000, 1), slowest_ms=round(slowest * 1000, 1))
+    logger.flush()
+    return exit_code
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if args[:1] == ["compile"]:
+        compile_snapshot(*args[1:3])
+        logger.flush()
+        exit(0)
+    exit(run_once(*args[:2]))
@@ -0,0 +1,235 @@
+# -*- coding: UTF-8 –*-
+"""
+扫描请求的代理池：按健康度和延迟加权分配代理，失败或被限流的代理自动摘除，冷却后重新加入
+"""
+
+import collections
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+from metrics import metrics
+from scheduler import ScanScheduler, TokenBucket
+from utils import Utils
+
+# 不使用代理、直接从本机出口请求
+DIRECT = "direct"
+# 连接阶段的异常（代理不可达、连接超时、TLS握手失败），出现一次即摘除代理并换一个代理重试
+# requests的ConnectionError还包括请求发出后连接被重置，此时请求可能已到达Apple，不能算作连接失败
+CONNECT_ERRORS = (requests.exceptions.ConnectTimeout, requests.exceptions.ProxyError,
+                  requests.exceptions.SSLError)
+
+
+def is_connect_error(error):
+    """
+    判断异常是否发生在建立连接阶段，即请求一定没有发出
+    """
+    if isinstance(error, CONNECT_ERRORS):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = error.args[0]
+        if isinstance(reason, MaxRetryError):
+            reason = reason.reason
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class ProxyState:
+    """
+    单个代理的健康度、延迟和吞吐统计
+    """
+
+    def __init__(self, url, name=None, weight=1, rate=None, burst=1):
+        self.url = url
+        self.name = name or ProxyState.display_name(url)
+        self.weight = weight
+        # 单个代理出口的限速，未配置时只受全局的按域名限速约束
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        # 健康度为最近请求成功率的指数移动平均，取值0~1
+        self.score = 1.0
+        self.latency = None
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.consecutive_failures = 0
+        self.evictions = 0
+        self.evicted_until = 0
+        self.recent = collections.deque()
+
+    @staticmethod
+    def display_name(url):
+        """
+        去掉代理地址中的用户名和密码，用于日志和监控指标
+        """
+        if url == DIRECT:
+            return DIRECT
+        parsed = urllib.parse.urlparse(url)
+        return "{}://{}".format(parsed.scheme, parsed.hostname + (":{}".format(parsed.port) if parsed.port else ""))
+
+    @property
+    def proxies(self):
+        if self.url == DIRECT:
+            return None
+        return {"http": self.url, "https": self.url}
+
+    def available(self, now):
+        return self.evicted_until <= now
+
+    def effective_weight(self):
+        # 延迟越低、成功率越高的代理分到的请求越多
+        latency = max(self.latency if self.latency is not None else 1, 0.05)
+        return self.weight * max(self.score, 0.01) / latency
+
+
+class ProxyPool:
+    """
+    代理池
+
+    - 按 权重 x 健康度 / 平均延迟 随机分配代理
+    - 连接失败、遇到429/503或其他异常连续达到max_failures次时摘除代理，
+      冷却时间按摘除次数指数增长，冷却结束后重新参与分配，请求成功后摘除次数清零
+    - 所有代理都被摘除时使用冷却最早结束的代理，不中断扫描
+    """
+
+    def __init__(self, proxies, include_direct=False, requests_per_minute=None, burst=1, max_failures=3,
+                 eviction_time=60, max_eviction_time=900, latency_alpha=0.3):
+        """
+        :param proxies: 代理列表，元素为代理地址或 {"url": 代理地址, "name": 名称, "weight": 权重}
+        :param include_direct: 是否把本机出口也作为一个代理参与分配
+        :param requests_per_minute: 每个代理每分钟的最大请求数，为空则不单独限速
+        :param burst: 每个代理的令牌桶容量
+        :param max_failures: 连接失败以外的异常连续出现多少次后摘除代理
+        :param eviction_time: 首次摘除的冷却时间（秒）
+        :param max_eviction_time: 冷却时间上限（秒）
+        :param latency_alpha: 延迟和健康度移动平均的平滑系数
+        """
+        rate = requests_per_minute / 60 if requests_per_minute else None
+        self.proxies = []
+        for proxy in proxies:
+            if isinstance(proxy, str):
+                proxy = {"url": proxy}
+            self.proxies.append(ProxyState(proxy["url"], proxy.get("name"), proxy.get("weight", 1), rate, burst))
+        if include_direct:
+            self.proxies.append(ProxyState(DIRECT, rate=rate, burst=burst))
+        if not self.proxies:
+            raise ValueError("代理池中没有可用的代理")
+        self.max_failures = max_failures
+        self.eviction_time = eviction_time
+        self.max_eviction_time = max_eviction_time
+        self.latency_alpha = latency_alpha
+        self.random = random.Random()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_configs(configs):
+        """
+        未配置proxy_pool时返回None
+        """
+        pool_configs = configs.get("proxy_pool", {})
+        if not pool_configs.get("proxies"):
+            return None
+        return ProxyPool(pool_configs["proxies"],
+                         include_direct=pool_configs.get("include_direct", False),
+                         requests_per_minute=pool_configs.get("requests_per_minute"),
+                         burst=pool_configs.get("burst", 1),
+                         max_failures=pool_configs.get("max_failures", 3),
+                         eviction_time=pool_configs.get("eviction_time", 60),
+                         max_eviction_time=pool_configs.get("max_eviction_time", 900))
+
+    def choose(self, now=None):
+        now = now or time.monotonic()
+        with self._lock:
+            candidates = [proxy for proxy in self.proxies if proxy.available(now)]
+            if not candidates:
+                return min(self.proxies, key=lambda proxy: proxy.evicted_until)
+            return self.random.choices(candidates, [proxy.effective_weight() for proxy in candidates])[0]
+
+    def observe(self, proxy, status_code=None, latency=None, error=None):
+        """
+        请求完成后调用，更新代理的健康度和延迟，必要时摘除
+        """
+        now = time.monotonic()
+        throttled = status_code in ScanScheduler.THROTTLE_STATUSES
+        connect_failed = is_connect_error(error)
+        failed = error is not None or throttled
+        alpha = self.latency_alpha
+        with self._lock:
+            proxy.requests += 1
+            proxy.recent.append(now)
+            while proxy.recent and proxy.recent[0] < now - 60:
+                proxy.recent.popleft()
+            if latency is not None:
+                proxy.latency = latency if proxy.latency is None else proxy.latency * (1 - alpha) + latency * alpha
+            proxy.score = proxy.score * (1 - alpha) + (0 if failed else 1) * alpha
+            if not failed:
+                proxy.consecutive_failures = 0
+                proxy.evictions = 0
+            else:
+                proxy.errors += 1
+                proxy.throttled += 1 if throttled else 0
+                proxy.consecutive_failures += 1
+                if throttled or connect_failed or proxy.consecutive_failures >= self.max_failures:
+                    proxy.evictions += 1
+                    cooldown = min(self.eviction_time * (2 ** (proxy.evictions - 1)), self.max_eviction_time)
+                    proxy.evicted_until = now + cooldown
+                    proxy.consecutive_failures = 0
+                    Utils.log("代理{}已摘除，{}秒后重试：{}".format(
+                        proxy.name, cooldown, "状态码{}".format(status_code) if throttled else repr(error)))
+
+        outcome = "error" if error is not None else ("throttled" if throttled else "ok")
+        metrics.proxy_requests_total.inc(proxy.name, outcome)
+        if latency is not None:
+            metrics.proxy_latency.observe(latency, proxy.name)
+        metrics.proxy_score.set(proxy.score, proxy.name)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            stats = {}
+            for proxy in self.proxies:
+                stats[proxy.name] = {
+                    "requests": proxy.requests,
+                    "requests_per_minute": sum(1 for t in proxy.recent if t >= now - 60),
+                    "error_rate": round(proxy.errors / proxy.requests, 3) if proxy.requests else 0,
+                    "throttled": proxy.throttled,
+                    "latency_ms": round(proxy.latency * 1000, 1) if proxy.latency is not None else None,
+                    "score": round(proxy.score, 3),
+                    "evicted_for": max(round(proxy.evicted_until - now), 0),
+                }
+            return stats
+
+
+class ProxiedTransport:
+    """
+    在传输层外包一层代理池，接口与transport.Transport的get一致
+    """
+
+    def __init__(self, transport, pool):
+        self.transport = transport
+        self.pool = pool
+        self.timeout = transport.timeout
+
+    def get(self, url, **kwargs):
+        # 连接失败时请求并未到达Apple，失败的代理已被摘除，换一个代理重试一次
+        attempts = min(2, len(self.pool.proxies))
+        for attempt in range(attempts):
+            proxy = self.pool.choose()
+            if proxy.bucket is not None:
+                proxy.bucket.acquire()
+            started = time.perf_counter()
+            try:
+                response = self.transport.get(url, proxies=proxy.proxies, **kwargs)
+            except Exception as err:
+                self.pool.observe(proxy, error=err)
+                if not is_connect_error(err) or attempt == attempts - 1:
+                    raise
+                continue
+            self.pool.observe(proxy, response.status_code, time.perf_counter() - started)
+            return response
+
+    def close(self):
+        self.transport.close()
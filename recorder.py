@@ -0,0 +1,133 @@
+# -*- coding: UTF-8 –*-
+"""
+货源接口响应的录制与回放
+
+录制文件为gzip压缩的JSON Lines，每行对应一次货源请求（分组请求时每组一行）
+"""
+
+import gzip
+import json
+import threading
+import time
+
+
+class ResponseRecorder:
+    """
+    将每次货源请求的原始响应及耗时追加写入录制文件
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_configs(configs):
+        recorder_configs = configs.get("recorder", {})
+        if not recorder_configs.get("path"):
+            return None
+        return ResponseRecorder(time.strftime(recorder_configs["path"]))
+
+    def record(self, job, product_codes, response, latency):
+        record = {
+            "time": time.time(),
+            "job": job.name,
+            "region": job.region,
+            "location": job.location,
+            "count": job.count,
+            "parts": list(product_codes),
+            "status": response.status_code,
+            "latency": latency,
+            "body": response.content.decode("utf-8", errors="replace"),
+        }
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def read_archive(path):
+    """
+    按录制顺序读取录制文件，并按 (任务, 扫描次数) 将分组请求合并为一次扫描
+
+    :return: 扫描列表，每一项为该次扫描的录制记录列表
+    """
+    scans = []
+    index = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = (record["job"], record["count"])
+            if key not in index:
+                index[key] = len(scans)
+                scans.append([])
+            scans[index[key]].append(record)
+    return scans
+
+
+class ReplayResponse:
+    __slots__ = ("status_code", "content")
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+
+class ReplayTransport:
+    """
+    用录制的响应代替真实网络请求，接口与transport.Transport一致
+    """
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.responses = {}
+
+    def load(self, records):
+        """
+        载入一次扫描的录制记录，按请求的商品型号匹配响应
+        """
+        self.responses = {tuple(record["parts"]): ReplayResponse(record["status"], record["body"].encode("utf-8"))
+                          for record in records}
+
+    def get(self, url, params=None, **kwargs):
+        parts = []
+        code_index = 0
+        while "parts.{}".format(code_index) in params:
+            parts.append(params["parts.{}".format(code_index)])
+            code_index += 1
+        response = self.responses.get(tuple(parts))
+        if response is None:
+            raise Exception("录制文件中没有该组商品的响应：{}".format(parts))
+        return response
+
+    def close(self):
+        pass
+
+
+class CollectingDispatcher:
+    """
+    回放时使用的通知分发器，只记录消息不真正发送
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, message, **kwargs):
+        if len(message) > 0:
+            self.messages.append(message)
+
+    def stats(self):
+        return {}
+
+    def close(self, timeout=10):
+        pass
@@ -0,0 +1,158 @@
+# -*- coding: UTF-8 –*-
+"""
+分级、缓冲的日志输出
+
+- 普通日志先写入内存缓冲，由后台线程批量写出，扫描循环不会被终端或journald的写入拖慢
+- 命中货源和错误日志立即写出（连同之前缓冲的日志，保证顺序）
+- format为json时每行输出一个JSON对象，便于日志系统检索
+- mode为summary时不输出每个直营店、每个商品的明细，每次扫描只输出一行汇总
+"""
+
+import atexit
+import datetime
+import json
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+HIT = 25
+WARNING = 30
+ERROR = 40
+
+LEVELS = {"debug": DEBUG, "info": INFO, "hit": HIT, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+
+class ScanLogger:
+    """
+    日志写出器，默认配置下的输出与直接print完全一致
+    """
+
+    def __init__(self, stream=None, path=None, level=INFO, json_format=False, summary=False, flush_interval=0,
+                 buffer_size=1000):
+        """
+        :param stream: 输出流，默认为标准输出，配置了path时输出到文件
+        :param path: 日志文件路径（追加写入）
+        :param level: 最低输出等级
+        :param json_format: 是否输出JSON Lines
+        :param summary: 是否只输出每次扫描的汇总
+        :param flush_interval: 后台线程写出缓冲的间隔（秒），0表示不缓冲，配置向导等交互场景使用
+        :param buffer_size: 缓冲的日志条数达到该值时立即写出
+        """
+        self.level = level
+        self.json_format = json_format
+        self.summary = summary
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.path = path
+        self.stream = open(path, "a", encoding="utf-8") if path else stream
+        self.buffer = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    @property
+    def detail(self):
+        """
+        是否输出每个直营店、每个商品的明细，扫描循环据此跳过明细日志的格式化
+        """
+        return not self.summary and self.level <= INFO
+
+    def enabled_for(self, level):
+        return level >= self.level
+
+    def emit(self, level, message, event="log", timestamp=True, immediate=False, **fields):
+        if level < self.level:
+            return
+        if self.json_format:
+            record = {"ts": round(time.time(), 3), "level": LEVEL_NAMES.get(level, level), "event": event}
+            if message:
+                record["msg"] = str(message)
+            record.update(fields)
+            line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str)
+        elif timestamp:
+            line = "[{}] {}".format(datetime.datetime.now().strftime('%H:%M:%S'), message)
+        else:
+            line = str(message)
+
+        with self._lock:
+            self.buffer.append(line)
+            if immediate or level >= HIT or self.flush_interval <= 0 or self._closed:
+                self.write_buffer()
+            elif len(self.buffer) >= self.buffer_size:
+                self._wakeup.notify()
+
+    def debug(self, message, event="log", **fields):
+        self.emit(DEBUG, message, event, **fields)
+
+    def info(self, message, event="log", **fields):
+        self.emit(INFO, message, event, **fields)
+
+    def hit(self, message, event="hit", **fields):
+        self.emit(HIT, message, event, **fields)
+
+    def warning(self, message, event="log", **fields):
+        self.emit(WARNING, message, event, **fields)
+
+    def error(self, message, event="error", **fields):
+        self.emit(ERROR, message, event, **fields)
+
+    def write_buffer(self):
+        """
+        写出缓冲中的日志，调用方需持有锁
+        """
+        if not self.buffer:
+            return
+        lines = self.buffer
+        self.buffer = []
+        stream = self.stream or sys.stdout
+        try:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def run(self):
+        with self._lock:
+            while not self._closed:
+                self._wakeup.wait(self.flush_interval if self.flush_interval > 0 else None)
+                self.write_buffer()
+
+    def flush(self):
+        with self._lock:
+            self.write_buffer()
+
+    def configure(self, configs):
+        """
+        根据配置文件中的logging字段调整输出方式
+        """
+        log_configs = configs.get("logging", {})
+        with self._lock:
+            self.write_buffer()
+            self._wakeup.notify()
+            self.level = LEVELS.get(log_configs.get("level", "info"), INFO)
+            self.json_format = log_configs.get("format", "text") == "json"
+            self.summary = log_configs.get("mode", "full") == "summary"
+            self.flush_interval = log_configs.get("flush_interval", 1)
+            self.buffer_size = log_configs.get("buffer_size", 1000)
+            path = log_configs.get("path")
+            if path != self.path:
+                if self.path:
+                    self.stream.close()
+                self.path = path
+                self.stream = open(path, "a", encoding="utf-8") if path else None
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self.write_buffer()
+            self._wakeup.notify()
+        self.thread.join(1)
+
+
+logger = ScanLogger()
+atexit.register(logger.flush)
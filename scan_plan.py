@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 –*-
+"""
+扫描计划：监控开始（或配置变更）时预先编译，扫描循环只负责把解析结果填入计划
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# 货源矩阵中每个单元格的取值
+UNKNOWN = 0
+UNAVAILABLE = 1
+AVAILABLE = 2
+
+
+def compile_predicate(region_info):
+    """
+    根据地区配置生成可用状态判断函数
+    """
+    available_statuses = frozenset(filter(None, [region_info['available_status'],
+                                                 region_info.get('available_status_alt')]))
+
+    def is_available(quote, display):
+        return quote in available_statuses or display != 'unavailable'
+
+    return is_available
+
+
+class ScanPlan:
+    """
+    单个扫描任务的扫描计划
+
+    - 排除的直营店使用集合判断
+    - 可用状态判断函数按地区预先编译
+    - 直营店 x 商品的货源矩阵按行连续存储，与上一轮扫描结果逐元素比较得到变化的单元格
+    """
+
+    def __init__(self, job, region_info):
+        self.exclude_stores = frozenset(job.exclude_stores)
+        self.product_codes = tuple(job.product_codes)
+        self.part_index = {code: index for index, code in enumerate(self.product_codes)}
+        self.is_available = compile_predicate(region_info)
+        self.width = len(self.product_codes)
+        # 直营店编号 -> 行号
+        self.store_index = {}
+        self.store_numbers = []
+        self.store_names = []
+        self.titles = []
+        self.matrix = bytearray()
+        self.previous = bytearray()
+
+    def row(self, store):
+        index = self.store_index.get(store.store_number)
+        if index is None:
+            index = len(self.store_numbers)
+            self.store_index[store.store_number] = index
+            self.store_numbers.append(store.store_number)
+            self.store_names.append(store.store_name)
+            self.titles.extend([""] * self.width)
+            self.previous.extend(bytes(self.width))
+        else:
+            self.store_names[index] = store.store_name
+        return index
+
+    def evaluate(self, stores):
+        """
+        将一轮扫描的直营店记录填入货源矩阵
+
+        :return: 变化的单元格下标列表（首次观测到的单元格也算作变化）
+        """
+        # 未出现在本轮结果中的单元格沿用上一轮的值，不会被当作变化
+        self.matrix = bytearray(self.previous)
+        for store in stores:
+            if store.store_number in self.exclude_stores:
+                continue
+            offset = self.row(store) * self.width
+            if len(self.matrix) < len(self.previous):
+                self.matrix.extend(bytes(len(self.previous) - len(self.matrix)))
+            for code, column in self.part_index.items():
+                part = store.parts.get(code)
+                if part is None:
+                    continue
+                self.matrix[offset + column] = AVAILABLE if self.is_available(part.quote, part.display) else UNAVAILABLE
+                self.titles[offset + column] = part.title
+
+        changed = self.diff()
+        self.previous = bytearray(self.matrix)
+        return changed
+
+    def diff(self):
+        if numpy is not None:
+            current = numpy.frombuffer(bytes(self.matrix), dtype=numpy.uint8)
+            previous = numpy.frombuffer(bytes(self.previous), dtype=numpy.uint8)
+            return numpy.flatnonzero(current != previous).tolist()
+        return [index for index, (current, previous) in enumerate(zip(self.matrix, self.previous))
+                if current != previous]
+
+    def available(self):
+        """
+        当前有货的单元格下标列表
+        """
+        if numpy is not None:
+            return numpy.flatnonzero(numpy.frombuffer(bytes(self.matrix), dtype=numpy.uint8) == AVAILABLE).tolist()
+        return [index for index, value in enumerate(self.matrix) if value == AVAILABLE]
+
+    def cell(self, index):
+        """
+        :return: (直营店编号, 直营店名称, 商品型号, 商品描述, 是否有货)
+        """
+        row, column = divmod(index, self.width)
+        return (self.store_numbers[row], self.store_names[row], self.product_codes[column],
+                self.titles[index], self.matrix[index] == AVAILABLE)
+
+    def is_excluded(self, store):
+        return store.store_number in self.exclude_stores
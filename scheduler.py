@@ -0,0 +1,221 @@
+# -*- coding: UTF-8 –*-
+"""
+扫描节奏调度：按域名限速，遇到限流退避，在抢购时段加快扫描、夜间放缓扫描
+"""
+
+import collections
+import datetime
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    令牌桶限速器，rate为每秒补充的令牌数，capacity为允许的突发请求数
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """
+        预定一个令牌，返回需要等待的秒数
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def try_acquire(self, reserve=0):
+        """
+        令牌数多于reserve时取走一个令牌并返回0，否则不取令牌，返回还需等待的秒数
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1 + reserve:
+                self.tokens -= 1
+                return 0
+            return (1 + reserve - self.tokens) / self.rate
+
+    def acquire(self):
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class HostState:
+    """
+    单个域名的限速与退避状态
+    """
+
+    def __init__(self, rate, capacity):
+        self.bucket = TokenBucket(rate, capacity)
+        self.backoff_level = 0
+        self.requests = collections.deque()
+        self.latencies = collections.deque(maxlen=50)
+
+
+class TimeWindow:
+    """
+    每天的某个时间段，支持跨零点，例如 23:00 ~ 07:00
+    """
+
+    def __init__(self, start, end):
+        self.start = datetime.datetime.strptime(start, "%H:%M").time()
+        self.end = datetime.datetime.strptime(end, "%H:%M").time()
+
+    def contains(self, moment):
+        if self.start <= self.end:
+            return self.start <= moment < self.end
+        return moment >= self.start or moment < self.end
+
+
+class ScanScheduler:
+    """
+    计算每个扫描任务的下一次扫描间隔
+
+    - 每个域名一个令牌桶，保证整体请求速率不超过上限
+    - 429/503、异常或响应过慢时按指数退避，请求恢复正常后逐级恢复
+    - 在配置的抢购/补货时段使用更短的间隔，在夜间按倍数放缓
+    """
+
+    THROTTLE_STATUSES = (429, 503)
+
+    def __init__(self, requests_per_minute=30, burst=5, hit_interval=5, min_interval=5, max_backoff=300,
+                 slow_latency=5, windows=None, night=None):
+        """
+        :param requests_per_minute: 每个域名每分钟的最大请求数
+        :param burst: 令牌桶容量
+        :param hit_interval: 命中货源后的扫描间隔（秒）
+        :param min_interval: 最短扫描间隔（秒）
+        :param max_backoff: 退避后的最长扫描间隔（秒）
+        :param slow_latency: 响应耗时超过该值（秒）时视为服务端压力过大，按限流处理
+        :param windows: 抢购/补货时段列表，元素为 {"start": "HH:MM", "end": "HH:MM", "interval": 秒}
+        :param night: 夜间时段，格式为 {"start": "HH:MM", "end": "HH:MM", "factor": 倍数}
+        """
+        self.rate = requests_per_minute / 60
+        self.burst = burst
+        self.hit_interval = hit_interval
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.slow_latency = slow_latency
+        self.windows = [(TimeWindow(w["start"], w["end"]), w["interval"]) for w in windows or []]
+        self.night = None
+        if night:
+            self.night = (TimeWindow(night["start"], night["end"]), night.get("factor", 2))
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_configs(configs):
+        schedule_configs = configs.get("schedule", {})
+        return ScanScheduler(requests_per_minute=schedule_configs.get("requests_per_minute", 30),
+                             burst=schedule_configs.get("burst", 5),
+                             hit_interval=schedule_configs.get("hit_interval", 5),
+                             min_interval=schedule_configs.get("min_interval", 5),
+                             max_backoff=schedule_configs.get("max_backoff", 300),
+                             slow_latency=schedule_configs.get("slow_latency", 5),
+                             windows=schedule_configs.get("windows"),
+                             night=schedule_configs.get("night"))
+
+    def update(self, other):
+        """
+        使用新配置构造的调度器更新当前参数，保留各域名的退避等级和请求记录
+        """
+        with self._lock:
+            self.rate = other.rate
+            self.burst = other.burst
+            self.hit_interval = other.hit_interval
+            self.min_interval = other.min_interval
+            self.max_backoff = other.max_backoff
+            self.slow_latency = other.slow_latency
+            self.windows = list(other.windows)
+            self.night = other.night
+            for state in self.hosts.values():
+                state.bucket.rate = self.rate
+                state.bucket.capacity = self.burst
+
+    def add_windows(self, windows):
+        """
+        追加抢购/补货时段，例如根据货源历史统计出的补货高峰
+        """
+        self.windows.extend((TimeWindow(w["start"], w["end"]), w["interval"]) for w in windows)
+
+    def host(self, host):
+        with self._lock:
+            state = self.hosts.get(host)
+            if state is None:
+                state = HostState(self.rate, self.burst)
+                self.hosts[host] = state
+            return state
+
+    def acquire(self, host):
+        """
+        发送请求前调用，超出速率上限时阻塞等待
+        """
+        state = self.host(host)
+        wait = state.bucket.acquire()
+        now = time.monotonic()
+        with self._lock:
+            state.requests.append(now)
+            while state.requests and state.requests[0] < now - 60:
+                state.requests.popleft()
+        return wait
+
+    def observe(self, host, status_code=None, latency=None, error=None):
+        """
+        请求完成后调用，根据状态码、耗时和异常调整退避等级
+        """
+        state = self.host(host)
+        with self._lock:
+            if latency is not None:
+                state.latencies.append(latency)
+            throttled = (error is not None or status_code in self.THROTTLE_STATUSES or
+                         (latency is not None and latency > self.slow_latency))
+            if throttled:
+                state.backoff_level = min(state.backoff_level + 1, 10)
+            elif state.backoff_level > 0:
+                state.backoff_level -= 1
+
+    def rate_per_minute(self, host):
+        """
+        最近一分钟内的实际请求速率
+        """
+        state = self.host(host)
+        now = time.monotonic()
+        with self._lock:
+            return sum(1 for t in state.requests if t >= now - 60)
+
+    def next_interval(self, job, available_list, now=None):
+        now = now or datetime.datetime.now()
+        moment = now.time()
+        state = self.host(job.host)
+
+        if len(available_list) > 0:
+            interval = self.hit_interval
+        else:
+            base = job.scan_interval
+            for window, window_interval in self.windows:
+                if window.contains(moment):
+                    base = min(base, window_interval)
+                    break
+            else:
+                if self.night and self.night[0].contains(moment):
+                    base = base * self.night[1]
+            interval = random.uniform(base / 2, base * 2)
+
+        if state.backoff_level > 0:
+            interval = min(interval * (2 ** state.backoff_level), max(self.max_backoff, interval))
+        return max(round(interval), self.min_interval)
@@ -0,0 +1,120 @@
+# -*- coding: UTF-8 –*-
+"""
+货源状态表：按 (直营店编号, 商品型号) 记录有货/无货状态，只在状态翻转时触发通知
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+class StoreState:
+    __slots__ = ("available", "since", "last_alert", "store_name", "title")
+
+    def __init__(self, available, since, last_alert=0.0, store_name="", title=""):
+        self.available = available
+        self.since = since
+        self.last_alert = last_alert
+        self.store_name = store_name
+        self.title = title
+
+
+class Transition:
+    __slots__ = ("store_number", "part", "available", "time", "store_name", "title")
+
+    def __init__(self, store_number, part, available, time, store_name, title):
+        self.store_number = store_number
+        self.part = part
+        self.available = available
+        self.time = time
+        self.store_name = store_name
+        self.title = title
+
+
+class AvailabilityState:
+    """
+    内存中的状态表，状态变化后写回磁盘，重启后不会对已通知过的货源重复告警
+    """
+
+    def __init__(self, path="availability_state.json", reminder_interval=0, history_size=1000):
+        """
+        :param path: 状态文件路径，为空则不持久化
+        :param reminder_interval: 持续有货时的重复提醒间隔（秒），0表示不提醒
+        :param history_size: 内存中保留的状态翻转记录条数
+        """
+        self.path = path
+        self.reminder_interval = reminder_interval
+        self.table = {}
+        self.transitions = collections.deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self.load()
+
+    @staticmethod
+    def from_configs(configs):
+        state_configs = configs.get("state", {})
+        return AvailabilityState(path=state_configs.get("path", "availability_state.json"),
+                                 reminder_interval=state_configs.get("reminder_interval", 0))
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        for store_number, part, available, since, last_alert, store_name, title in data.get("table", []):
+            self.table[(store_number, part)] = StoreState(available, since, last_alert, store_name, title)
+
+    def save(self):
+        if not self.path:
+            return
+        data = {
+            "table": [[key[0], key[1], s.available, s.since, s.last_alert, s.store_name, s.title]
+                      for key, s in self.table.items()]
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    def update(self, observations, now=None):
+        """
+        合并一次扫描的结果
+
+        :param observations: (直营店编号, 直营店名称, 商品型号, 商品描述, 是否有货) 的列表
+        :return: (新到货列表, 售罄列表, 到期提醒列表)，元素为Transition
+        """
+        now = now or time.time()
+        became_available = []
+        became_unavailable = []
+        reminders = []
+        with self._lock:
+            changed = False
+            for store_number, store_name, part, title, available in observations:
+                key = (store_number, part)
+                state = self.table.get(key)
+                if state is None:
+                    # 首次见到的组合，只有有货时才算作一次翻转
+                    state = StoreState(False, now, 0.0, store_name, title)
+                    self.table[key] = state
+                    changed = True
+                state.store_name = store_name
+                state.title = title
+                if state.available != available:
+                    state.available = available
+                    state.since = now
+                    transition = Transition(store_number, part, available, now, store_name, title)
+                    self.transitions.append(transition)
+                    if available:
+                        state.last_alert = now
+                        became_available.append(transition)
+                    else:
+                        became_unavailable.append(transition)
+                    changed = True
+                elif available and self.reminder_interval > 0 and now - state.last_alert >= self.reminder_interval:
+                    state.last_alert = now
+                    reminders.append(Transition(store_number, part, available, state.since, store_name, title))
+                    changed = True
+            if changed:
+                self.save()
+        return became_available, became_unavailable, reminders
@@ -0,0 +1,373 @@
+# -*- coding: UTF-8 –*-
+"""
+本地模拟的Apple Store服务，用于压测和故障测试
+
+实现 /shop/fulfillment-messages（中国大陆结构）、/shop/retail/pickup-message（香港结构）、
+/shop/address-lookup 和 /shop/buy-* 商品页（支持ETag/If-Modified-Since），
+支持脚本化的库存变化、延迟注入、429/503突发、截断/空响应和非法JSON。
+开启会话校验后，货源接口只接受访问商品页时下发的Cookie，否则返回403，用于测试浏览器会话的重新获取。
+另外提供 /notify/ 前缀的通知接收端点，可以把Bark等通知地址指向这里压测通知链路。
+
+控制接口：
+    POST /__stub/stock    {"store": "R0001" | "*", "part": "MG8J4ZA/A" | "*", "available": true}
+    POST /__stub/fault    {"mode": "429" | "503" | "truncate" | "empty" | "malformed", "count": 5}
+    POST /__stub/latency  {"latency": 0.5, "jitter": 0.2}
+    POST /__stub/catalog  {"part": "MG8J4ZA/A", "description": "256GB 蓝色"}
+    POST /__stub/session  {"required": true, "rotate": true}
+    GET  /__stub/stats
+
+用法：python stub_server.py [--host 127.0.0.1] [--port 8080] [--stores 50] [--script script.json]
+然后设置环境变量 APPLE_STORE_BASE_URL=http://127.0.0.1:8080 启动监控
+"""
+
+import argparse
+import collections
+import email.utils
+import http.cookies
+import json
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAULT_MODES = ("429", "503", "truncate", "empty", "malformed")
+
+ADDRESS_TREE = {
+    "北京": {"北京": ["朝阳区", "东城区", "西城区"]},
+    "上海": {"上海": ["黄浦区", "浦东新区", "徐汇区"]},
+    "广东": {"广州": ["天河区", "越秀区"], "深圳": ["福田区", "南山区"]},
+}
+
+
+class StubStore:
+    """
+    模拟的直营店与库存状态
+    """
+
+    def __init__(self, store_count=50, seed=None):
+        self.stores = [("R{:04d}".format(index), "Stub Store {}".format(index)) for index in range(store_count)]
+        self.stock = set()
+        self.all_stores_parts = set()
+        self.faults = collections.deque()
+        self.latency = 0
+        self.jitter = 0
+        self.random = random.Random(seed)
+        self.stats = collections.Counter()
+        self.notifications = []
+        # 商品页内容：型号 -> 描述，每次修改后版本号加一
+        self.catalog = {}
+        self.catalog_version = 0
+        self.catalog_modified = time.time()
+        # 会话校验：开启后货源接口只接受商品页下发的Cookie
+        self.session_required = False
+        self.session_tokens = set()
+        self._lock = threading.Lock()
+
+    def set_stock(self, store, part, available):
+        """
+        store或part为"*"时表示全部直营店或全部商品
+        """
+        with self._lock:
+            target = (store, part)
+            if store == "*" or part == "*":
+                container = self.all_stores_parts
+            else:
+                container = self.stock
+            if available:
+                container.add(target)
+            else:
+                container.discard(target)
+                if store == "*" and part == "*":
+                    self.stock.clear()
+                    self.all_stores_parts.clear()
+
+    def is_available(self, store, part):
+        return ((store, part) in self.stock or ("*", part) in self.all_stores_parts or
+                (store, "*") in self.all_stores_parts or ("*", "*") in self.all_stores_parts)
+
+    def inject(self, mode, count=1):
+        if mode not in FAULT_MODES:
+            raise ValueError("不支持的故障类型：{}".format(mode))
+        with self._lock:
+            self.faults.extend([mode] * count)
+
+    def set_latency(self, latency, jitter=0):
+        self.latency = latency
+        self.jitter = jitter
+
+    def next_fault(self):
+        with self._lock:
+            return self.faults.popleft() if self.faults else None
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0))
+
+    def stores_payload(self, region, parts):
+        stores = []
+        for store_number, store_name in self.stores:
+            parts_availability = {}
+            for part in parts:
+                available = self.is_available(store_number, part)
+                if region == "hk":
+                    quote = "Available today" if available else "Currently unavailable"
+                else:
+                    quote = "今天可取货" if available else "暂无供应"
+                parts_availability[part] = {
+                    "storePickEligible": True,
+                    "pickupSearchQuote": quote,
+                    "pickupDisplay": "available" if available else "unavailable",
+                    "partNumber": part,
+                    "messageTypes": {
+                        "regular": {
+                            "storePickupProductTitle": "Stub Product {}".format(part),
+                            "storePickupQuote": quote,
+                        }
+                    },
+                }
+            store = {
+                "storeNumber": store_number,
+                "storeName": store_name,
+                "partsAvailability": parts_availability,
+            }
+            if region == "hk":
+                store["address"] = {"address2": "{} Street".format(store_name), "address3": "Hong Kong"}
+            else:
+                store["retailStore"] = {"address": {"street": "{}路1号".format(store_name)}}
+            stores.append(store)
+        if region == "hk":
+            return {"head": {"status": "200"}, "body": {"stores": stores}}
+        return {"head": {"status": "200"}, "body": {"content": {"pickupMessage": {"stores": stores}}}}
+
+    @staticmethod
+    def address_payload(params):
+        body = {}
+        state = params.get("state")
+        city = params.get("city")
+        district = params.get("district")
+        body["state"] = {"data": [{"value": value} for value in ADDRESS_TREE]}
+        if state in ADDRESS_TREE:
+            body["city"] = {"data": [{"value": value} for value in ADDRESS_TREE[state]]}
+            if city in ADDRESS_TREE[state]:
+                body["district"] = {"data": [{"value": value} for value in ADDRESS_TREE[state][city]]}
+        body["provinceCityDistrict"] = " ".join(filter(None, [state, city, district]))
+        return {"head": {"status": "200"}, "body": body}
+
+    def set_catalog(self, part, description):
+        with self._lock:
+            if self.catalog.get(part) == description:
+                return
+            self.catalog[part] = description
+            self.catalog_version += 1
+            self.catalog_modified = time.time()
+
+    def set_session(self, required, rotate=False):
+        with self._lock:
+            self.session_required = required
+            if rotate:
+                # 使已经下发的Cookie全部失效
+                self.session_tokens.clear()
+
+    def new_session_token(self):
+        token = "{:016x}".format(self.random.getrandbits(64))
+        with self._lock:
+            self.session_tokens.add(token)
+        return token
+
+    def session_valid(self, cookie_header):
+        if not self.session_required:
+            return True
+        cookies = http.cookies.SimpleCookie(cookie_header or "")
+        return "stub_session" in cookies and cookies["stub_session"].value in self.session_tokens
+
+    def catalog_page(self):
+        """
+        生成嵌入商品JSON的商品页
+        """
+        products = ",".join(json.dumps({"partNumber": part, "title": description}, ensure_ascii=False)
+                            for part, description in sorted(self.catalog.items()))
+        return "<html><script>window.products = [{}];</script></html>".format(products).encode("utf-8")
+
+    def run_script(self, steps):
+        """
+        按时间执行脚本，每一步为 {"after": 秒, "action": "stock" | "fault" | "latency", ...其余参数}
+        """
+        def run():
+            started = time.monotonic()
+            for step in sorted(steps, key=lambda s: s.get("after", 0)):
+                wait = step.get("after", 0) - (time.monotonic() - started)
+                if wait > 0:
+                    time.sleep(wait)
+                self.apply(step["action"], step)
+
+        thread = threading.Thread(target=run, name="stub-script", daemon=True)
+        thread.start()
+        return thread
+
+    def apply(self, action, payload):
+        if action == "stock":
+            self.set_stock(payload.get("store", "*"), payload.get("part", "*"), payload.get("available", True))
+        elif action == "fault":
+            self.inject(str(payload["mode"]), payload.get("count", 1))
+        elif action == "latency":
+            self.set_latency(payload.get("latency", 0), payload.get("jitter", 0))
+        elif action == "catalog":
+            self.set_catalog(payload["part"], payload["description"])
+        elif action == "session":
+            self.set_session(payload.get("required", True), payload.get("rotate", False))
+        else:
+            raise ValueError("不支持的操作：{}".format(action))
+
+
+def make_handler(stub):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def reply(self, status, body, content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def reply_json(self, payload, status=200):
+            self.reply(status, json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            params = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+            stub.stats["requests"] += 1
+
+            if url.path == "/__stub/stats":
+                self.reply_json(dict(stub.stats, notifications=len(stub.notifications)))
+                return
+
+            if url.path.endswith("/shop/fulfillment-messages") or url.path.endswith("/shop/retail/pickup-message"):
+                region = "hk" if url.path.endswith("/shop/retail/pickup-message") else "cn"
+                if not stub.session_valid(self.headers.get("Cookie")):
+                    stub.stats["403"] += 1
+                    self.reply(403, b"")
+                    return
+                code_index = 0
+                parts = []
+                while "parts.{}".format(code_index) in params:
+                    parts.append(params["parts.{}".format(code_index)])
+                    code_index += 1
+                payload = stub.stores_payload(region, parts)
+            elif url.path.endswith("/shop/address-lookup"):
+                payload = stub.address_payload(params)
+            elif "/shop/buy-" in url.path:
+                self.reply_catalog()
+                return
+            else:
+                stub.stats["404"] += 1
+                self.reply(404, b"")
+                return
+
+            stub.delay()
+            fault = stub.next_fault()
+            if fault is not None:
+                stub.stats[fault] += 1
+            if fault in ("429", "503"):
+                self.reply(int(fault), b"")
+                return
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            if fault == "truncate":
+                body = body[:len(body) // 2]
+            elif fault == "empty":
+                body = b""
+            elif fault == "malformed":
+                body = b"<html>" + body
+            stub.stats["200"] += 1
+            self.reply(200, body)
+
+        def reply_catalog(self):
+            etag = '"v{}"'.format(stub.catalog_version)
+            last_modified = email.utils.formatdate(stub.catalog_modified, usegmt=True)
+            session_cookie = "stub_session={}; Path=/".format(stub.new_session_token())
+            if_modified_since = self.headers.get("If-Modified-Since")
+            if self.headers.get("If-None-Match") == etag or (
+                    if_modified_since and "If-None-Match" not in self.headers and
+                    email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= int(stub.catalog_modified)):
+                stub.stats["304"] += 1
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Set-Cookie", session_cookie)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = stub.catalog_page()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.send_header("Set-Cookie", session_cookie)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            url = urllib.parse.urlparse(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+
+            if url.path.startswith("/notify/"):
+                stub.stats["notify"] += 1
+                stub.notifications.append((time.time(), url.path, raw))
+                self.reply_json({"code": 200, "errcode": 0, "ok": True})
+                return
+
+            if url.path.startswith("/__stub/"):
+                try:
+                    stub.apply(url.path[len("/__stub/"):], json.loads(raw or b"{}"))
+                except (ValueError, KeyError) as err:
+                    self.reply_json({"error": str(err)}, 400)
+                    return
+                self.reply_json({"ok": True})
+                return
+
+            self.reply(404, b"")
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+def serve(host="127.0.0.1", port=0, store_count=50, script=None, seed=None):
+    """
+    在后台线程启动模拟服务
+
+    :return: (server, stub, base_url)
+    """
+    stub = StubStore(store_count, seed)
+    server = ThreadingHTTPServer((host, port), make_handler(stub))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    if script:
+        stub.run_script(script)
+    return server, stub, "http://{}:{}".format(*server.server_address[:2])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="本地模拟的Apple Store服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--stores", type=int, default=50, help="模拟的直营店数量")
+    parser.add_argument("--script", help="库存/故障变化脚本（JSON数组）")
+    parser.add_argument("--seed", type=int, help="延迟抖动的随机种子")
+    args = parser.parse_args()
+
+    steps = None
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            steps = json.load(f)
+    server, stub, base_url = serve(args.host, args.port, args.stores, steps, args.seed)
+    print("模拟服务已启动：{}".format(base_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
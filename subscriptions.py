@@ -0,0 +1,97 @@
+# -*- coding: UTF-8 –*-
+"""
+多用户订阅：合并多个用户的监控配置，相同 (地区, 取货区域) 只请求一次，再把结果分发给各个订阅者
+"""
+
+import glob
+import json
+import os
+
+from engine import ScanJob
+from notifier import NotificationDispatcher
+from state import AvailabilityState
+
+
+class Subscriber:
+    """
+    某个用户在某个 (地区, 取货区域) 上的订阅，拥有自己的商品、排除的直营店、通知渠道和货源状态
+    """
+
+    def __init__(self, name, selected_products, exclude_stores, dispatcher, state, alert_exception=False):
+        self.name = name
+        self.parts = frozenset(selected_products)
+        self.exclude_stores = frozenset(exclude_stores)
+        self.dispatcher = dispatcher
+        self.state = state
+        self.alert_exception = alert_exception
+
+    def observe(self, plan, indexes):
+        """
+        从合并后的扫描计划中筛选出本订阅关心的单元格并更新货源状态
+
+        :return: (新到货列表, 售罄列表, 到期提醒列表)
+        """
+        observations = []
+        for index in indexes:
+            cell = plan.cell(index)
+            if cell[2] in self.parts and cell[0] not in self.exclude_stores:
+                observations.append(cell)
+        return self.state.update(observations)
+
+
+def load_subscriber_configs(patterns):
+    """
+    按文件路径或通配符加载订阅者的配置，订阅者名称默认取文件名
+
+    :return: [(订阅者名称, 配置)]
+    """
+    subscriber_configs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, encoding='utf-8') as f:
+                configs = json.load(f)
+            name = configs.get("name") or os.path.splitext(os.path.basename(path))[0]
+            subscriber_configs.append((name, configs))
+    return subscriber_configs
+
+
+def merge_subscriptions(subscriber_configs, server_configs, dispatcher_factory=None):
+    """
+    将所有订阅者的扫描任务按 (地区, 取货区域) 合并
+
+    - 商品型号取并集，每个型号只请求一次
+    - 扫描间隔取各订阅者中的最小值
+    - 只有所有订阅者都排除的直营店才在请求结果中跳过，其余由各订阅者自行过滤
+
+    :param subscriber_configs: load_subscriber_configs的返回值
+    :param server_configs: 服务端配置，提供chunk_size和state_dir
+    :param dispatcher_factory: 根据订阅者配置创建通知分发器，默认使用NotificationDispatcher.from_configs
+    :return: 合并后的ScanJob列表，每个任务的subscribers为订阅者列表
+    """
+    dispatcher_factory = dispatcher_factory or NotificationDispatcher.from_configs
+    state_dir = server_configs.get("state_dir", "states")
+    if state_dir:
+        os.makedirs(state_dir, exist_ok=True)
+
+    merged = {}
+    for name, configs in subscriber_configs:
+        dispatcher = dispatcher_factory(configs)
+        state_configs = configs.get("state", {})
+        state = AvailabilityState(os.path.join(state_dir, "{}.json".format(name)) if state_dir else "",
+                                  reminder_interval=state_configs.get("reminder_interval", 0))
+        for job in ScanJob.from_configs(configs):
+            key = (job.region, job.location)
+            target = merged.get(key)
+            if target is None:
+                target = ScanJob(job.region, job.location, {}, job.scan_interval, list(job.exclude_stores),
+                                 server_configs.get("chunk_size", 10))
+                target.subscribers = []
+                merged[key] = target
+            else:
+                target.scan_interval = min(target.scan_interval, job.scan_interval)
+                target.exclude_stores = [store for store in target.exclude_stores if store in job.exclude_stores]
+            for product_code, product_info in job.selected_products.items():
+                target.selected_products.setdefault(product_code, product_info)
+            target.subscribers.append(Subscriber(name, job.selected_products, job.exclude_stores, dispatcher,
+                                                 state, configs.get("alert_exception", False)))
+    return list(merged.values())
@@ -0,0 +1,419 @@
+# -*- coding: UTF-8 –*-
+"""
+监督模式：每个扫描任务运行在独立的工作进程中，由监督进程负责看门狗和重启
+
+- 工作进程定时发送心跳，并在每次扫描开始、结束时上报
+- 扫描超过scan_deadline秒未完成、超过heartbeat_timeout秒没有心跳、常驻内存超过rss_limit_mb或进程退出时重启该工作进程
+- 货源状态表和通知分发器保留在监督进程中，工作进程只负责请求和比较货源，重启不会丢失状态，
+  重启后的第一次扫描仍按持久化的状态判断翻转，停机期间的到货不会漏报
+- 单个工作进程卡住只影响它自己的扫描任务
+"""
+
+import multiprocessing
+import os
+import signal
+import threading
+import time
+from multiprocessing.connection import wait
+
+from metrics import metrics
+from notifier import PRIORITY_ERROR
+from utils import Utils
+
+
+def rss_bytes(pid):
+    """
+    读取进程的常驻内存，非Linux平台返回None
+    """
+    try:
+        with open("/proc/{}/statm".format(pid)) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "-"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return "{}天{}小时".format(days, hours)
+    if hours:
+        return "{}小时{}分".format(hours, minutes)
+    if minutes:
+        return "{}分{}秒".format(minutes, seconds)
+    return "{}秒".format(seconds)
+
+
+class WorkerChannel:
+    """
+    工作进程到监督进程的连接，心跳线程和扫描线程共用
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._lock = threading.Lock()
+
+    def send(self, kind, **fields):
+        with self._lock:
+            self.connection.send((kind, fields))
+
+
+class ForwardingState:
+    """
+    工作进程中代替AvailabilityState，把观测结果交给监督进程判断翻转，工作进程自身不发送通知
+    """
+
+    def __init__(self, channel, job):
+        self.channel = channel
+        self.job = job
+
+    def update(self, observations, now=None):
+        if observations:
+            self.channel.send("observe", count=self.job.count, observations=observations)
+        return [], [], []
+
+
+class ForwardingDispatcher:
+    """
+    工作进程中代替NotificationDispatcher，把异常消息交给监督进程发送，各渠道的限速仍然全局生效
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def send(self, message, priority=PRIORITY_ERROR, **kwargs):
+        self.channel.send("notify", message=message, priority=priority, kwargs=kwargs)
+
+    def close(self):
+        pass
+
+
+def raise_interrupt(signum, frame):
+    """
+    收到SIGTERM时按Ctrl+C处理，走正常的停止流程
+    """
+    raise KeyboardInterrupt()
+
+
+def worker_configs(configs, index):
+    """
+    工作进程使用的配置：只保留第index个扫描任务，去掉由监督进程负责的部分
+    """
+    configs = dict(configs)
+    configs["jobs"] = [(configs.get("jobs") or [{}])[index]]
+    configs["notification_configs"] = {}
+    configs["state"] = dict(configs.get("state", {}), path="")
+    for section in ("metrics", "event_stream", "supervisor"):
+        configs.pop(section, None)
+    # 录制文件和货源历史库不能由多个进程同时写入，每个工作进程使用各自的文件
+    for section in ("recorder", "history"):
+        if configs.get(section, {}).get("path"):
+            configs[section] = dict(configs[section], path=indexed_path(configs[section]["path"], index))
+    return configs
+
+
+def indexed_path(path, index):
+    """
+    在文件名的第一个扩展名前加上任务序号，如 history.db -> history.job0.db
+    """
+    directory, name = os.path.split(path)
+    stem, dot, extension = name.partition(".")
+    return os.path.join(directory, "{}.job{}{}{}".format(stem, index, dot, extension))
+
+
+def run_job_worker(configs, index, region, count, connection, heartbeat_interval):
+    """
+    工作进程入口：运行单个扫描任务，收到SIGTERM时正常退出
+    """
+    channel = WorkerChannel(connection)
+
+    def heartbeat():
+        while True:
+            try:
+                channel.send("heartbeat")
+            except (OSError, ValueError):
+                # 监督进程已退出
+                os._exit(1)
+            time.sleep(heartbeat_interval)
+
+    # 初始化（加载地址库、获取浏览器会话）期间同样发送心跳
+    threading.Thread(target=heartbeat, name="heartbeat", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, raise_interrupt)
+
+    import asyncio
+    from engine import ScanEngine
+    from monitor import AppleStoreMonitor
+    from subscriptions import Subscriber
+
+    monitor = AppleStoreMonitor(region)
+    try:
+        job = monitor.setup(worker_configs(configs, index))[0]
+    except KeyboardInterrupt:
+        os._exit(0)
+    job.count = count
+    job.subscribers = [Subscriber("default", job.selected_products, job.exclude_stores, ForwardingDispatcher(channel),
+                                  ForwardingState(channel, job), monitor.alert_exception)]
+
+    def scan(job):
+        channel.send("scan_started", count=job.count)
+        available_list = monitor.scan(job)
+        channel.send("scan_finished", count=job.count, last_success=job.last_success)
+        return available_list
+
+    engine = ScanEngine(scan, [job], monitor.scheduler, deadline=monitor.timeout * 3)
+    try:
+        asyncio.run(engine.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.teardown()
+        # 卡住的扫描线程不会再返回，不等待它们直接退出
+        os._exit(0)
+
+
+class WorkerHandle:
+    """
+    监督进程中某个扫描任务的工作进程记录，重启时保留
+    """
+
+    def __init__(self, index, job):
+        self.index = index
+        self.job = job
+        self.process = None
+        self.connection = None
+        self.started_at = None
+        self.last_heartbeat = None
+        self.scan_started_at = None
+        self.scans = 0
+        self.restarts = 0
+        self.consecutive_restarts = 0
+        self.last_reason = None
+        self.next_start_at = 0.0
+        self.rss = None
+
+    @property
+    def name(self):
+        return self.job.name
+
+
+class Supervisor:
+    """
+    监督进程：启动各扫描任务的工作进程，处理它们上报的观测结果、异常消息和心跳，并按看门狗规则重启
+    """
+
+    def __init__(self, monitor, configs, jobs, scan_deadline=120, heartbeat_interval=5, heartbeat_timeout=30,
+                 rss_limit_mb=512, restart_backoff=5, max_restart_backoff=300, report_interval=600,
+                 check_interval=1):
+        """
+        :param monitor: 监督进程中的AppleStoreMonitor，提供货源状态表、通知分发器和通知格式
+        :param jobs: 校验后的扫描任务列表，与配置文件中的jobs一一对应
+        :param scan_deadline: 单次扫描的最长时间（秒），超过后重启工作进程
+        :param heartbeat_interval: 工作进程发送心跳的间隔（秒）
+        :param heartbeat_timeout: 超过该时间（秒）没有收到心跳时重启工作进程
+        :param rss_limit_mb: 工作进程常驻内存上限（MB），0表示不限制
+        :param restart_backoff: 连续重启时的初始等待时间（秒），按连续重启次数翻倍，成功扫描后清零
+        :param max_restart_backoff: 连续重启时的最长等待时间（秒）
+        :param report_interval: 输出各工作进程运行状况的间隔（秒），0表示只在停止时输出
+        :param check_interval: 看门狗检查的间隔（秒）
+        """
+        self.monitor = monitor
+        self.configs = configs
+        self.scan_deadline = scan_deadline
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.rss_limit = rss_limit_mb * 1024 * 1024
+        self.restart_backoff = restart_backoff
+        self.max_restart_backoff = max_restart_backoff
+        self.report_interval = report_interval
+        self.check_interval = check_interval
+        self.handles = [WorkerHandle(index, job) for index, job in enumerate(jobs)]
+        self.context = multiprocessing.get_context("spawn")
+        self.started_at = time.time()
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def from_configs(monitor, configs, jobs):
+        """
+        未启用supervisor时返回None
+        """
+        supervisor_configs = configs.get("supervisor", {})
+        if not supervisor_configs.get("enabled", False):
+            return None
+        return Supervisor(monitor, configs, jobs,
+                          scan_deadline=supervisor_configs.get("scan_deadline", 120),
+                          heartbeat_interval=supervisor_configs.get("heartbeat_interval", 5),
+                          heartbeat_timeout=supervisor_configs.get("heartbeat_timeout", 30),
+                          rss_limit_mb=supervisor_configs.get("rss_limit_mb", 512),
+                          restart_backoff=supervisor_configs.get("restart_backoff", 5),
+                          max_restart_backoff=supervisor_configs.get("max_restart_backoff", 300),
+                          report_interval=supervisor_configs.get("report_interval", 600))
+
+    def spawn(self, handle):
+        receiver, sender = self.context.Pipe(duplex=False)
+        handle.process = self.context.Process(target=run_job_worker,
+                                              args=(self.configs, handle.index, self.monitor.region,
+                                                    handle.job.count, sender, self.heartbeat_interval),
+                                              name="job-{}".format(handle.index), daemon=True)
+        handle.process.start()
+        sender.close()
+        handle.connection = receiver
+        handle.started_at = time.time()
+        handle.last_heartbeat = time.monotonic()
+        handle.scan_started_at = None
+        Utils.log("[{}] 工作进程已启动，pid：{}".format(handle.name, handle.process.pid))
+
+    def stop_worker(self, handle, graceful=False, timeout=5):
+        """
+        :param graceful: 为True时先发送SIGTERM等待工作进程自行退出，否则直接结束（卡住的进程不会响应SIGTERM）
+        """
+        process = handle.process
+        if process is not None and process.is_alive():
+            if graceful:
+                process.terminate()
+                process.join(timeout)
+            if process.is_alive():
+                process.kill()
+                process.join(timeout)
+        if handle.connection is not None:
+            handle.connection.close()
+        handle.process = None
+        handle.connection = None
+
+    def restart(self, handle, reason, kind):
+        """
+        结束工作进程并在退避时间后重新启动，扫描次数和货源状态保留
+        """
+        # 内存超限的工作进程仍然正常，可以等它写出缓冲的数据后退出
+        self.stop_worker(handle, graceful=kind == "memory")
+        handle.restarts += 1
+        handle.consecutive_restarts += 1
+        handle.last_reason = reason
+        backoff = min(self.restart_backoff * 2 ** (handle.consecutive_restarts - 1), self.max_restart_backoff)
+        handle.next_start_at = time.monotonic() + backoff
+        metrics.worker_restarts_total.inc(handle.name, kind)
+        message = "[{}] 工作进程{}，{}秒后重启（第{}次）".format(handle.name, reason, backoff, handle.restarts)
+        Utils.log(message)
+        if self.monitor.alert_exception:
+            self.monitor.dispatcher.send(Utils.time_title(message), priority=PRIORITY_ERROR)
+
+    def handle_message(self, handle, kind, fields):
+        handle.last_heartbeat = time.monotonic()
+        if kind == "scan_started":
+            handle.job.count = fields["count"]
+            # 上一次扫描卡住时保留最早的开始时间，避免之后的扫描不断刷新开始时间
+            if handle.scan_started_at is None:
+                handle.scan_started_at = time.monotonic()
+        elif kind == "scan_finished":
+            handle.scan_started_at = None
+            handle.scans += 1
+            handle.job.count = fields["count"] + 1
+            if fields["last_success"] is not None and fields["last_success"] != handle.job.last_success:
+                handle.job.last_success = fields["last_success"]
+                handle.consecutive_restarts = 0
+                metrics.last_success_timestamp.set(handle.job.last_success, handle.name)
+        elif kind == "observe":
+            handle.job.count = fields["count"]
+            transitions = self.monitor.state.update(fields["observations"])
+            self.monitor.notify_transitions(handle.job, self.monitor.dispatcher, *transitions)
+        elif kind == "notify":
+            self.monitor.dispatcher.send(fields["message"], priority=fields["priority"], **fields["kwargs"])
+
+    def check(self, handle, now):
+        """
+        看门狗：检查单个工作进程，需要时重启
+        """
+        if handle.process is None:
+            if now >= handle.next_start_at:
+                self.spawn(handle)
+            return
+        if not handle.process.is_alive():
+            self.restart(handle, "已退出（退出码{}）".format(handle.process.exitcode), "exit")
+            return
+        if handle.scan_started_at is not None and now - handle.scan_started_at > self.scan_deadline:
+            self.restart(handle, "第{}次扫描超过{}秒未完成".format(handle.job.count, self.scan_deadline), "deadline")
+            return
+        if now - handle.last_heartbeat > self.heartbeat_timeout:
+            self.restart(handle, "超过{}秒没有心跳".format(self.heartbeat_timeout), "heartbeat")
+            return
+        handle.rss = rss_bytes(handle.process.pid)
+        if handle.rss is not None:
+            metrics.worker_rss_bytes.set(handle.rss, handle.name)
+            if 0 < self.rss_limit < handle.rss:
+                self.restart(handle, "常驻内存{:.0f}MB超过上限{:.0f}MB".format(
+                    handle.rss / 1024 / 1024, self.rss_limit / 1024 / 1024), "memory")
+
+    def stats(self):
+        """
+        各工作进程的运行时间、重启次数和距上次成功扫描的时间
+        """
+        now = time.time()
+        stats = {}
+        for handle in self.handles:
+            stats[handle.name] = {
+                "pid": handle.process.pid if handle.process is not None else None,
+                "uptime": round(now - handle.started_at, 1) if handle.process is not None else None,
+                "scans": handle.scans,
+                "restarts": handle.restarts,
+                "last_reason": handle.last_reason,
+                "since_last_success": round(now - handle.job.last_success, 1) if handle.job.last_success else None,
+                "rss_mb": round(handle.rss / 1024 / 1024, 1) if handle.rss is not None else None,
+            }
+        return stats
+
+    def report(self):
+        Utils.log("监督进程已运行{}".format(format_duration(time.time() - self.started_at)))
+        for name, stats in self.stats().items():
+            Utils.log("[{}] 工作进程运行{}，扫描{}次，重启{}次{}，距上次成功扫描{}，内存{}MB".format(
+                name, format_duration(stats["uptime"]), stats["scans"], stats["restarts"],
+                "（最近一次：{}）".format(stats["last_reason"]) if stats["last_reason"] else "",
+                format_duration(stats["since_last_success"]), stats["rss_mb"] if stats["rss_mb"] is not None else "-"))
+
+    def run(self):
+        """
+        运行到收到KeyboardInterrupt或stop()为止
+        """
+        next_report = time.monotonic() + self.report_interval
+        signal.signal(signal.SIGTERM, raise_interrupt)
+        try:
+            while not self._stopped.is_set():
+                connections = {handle.connection: handle for handle in self.handles if handle.connection is not None}
+                for connection in wait(list(connections), timeout=self.check_interval) if connections else []:
+                    handle = connections[connection]
+                    try:
+                        while connection.poll():
+                            self.handle_message(handle, *connection.recv())
+                    except (EOFError, OSError):
+                        # 工作进程已退出，由看门狗重启
+                        handle.connection = None
+                        connection.close()
+                if not connections:
+                    self._stopped.wait(self.check_interval)
+                now = time.monotonic()
+                for handle in self.handles:
+                    self.check(handle, now)
+                if self.report_interval > 0 and now >= next_report:
+                    next_report = now + self.report_interval
+                    self.report()
+        except KeyboardInterrupt:
+            Utils.log("监控已停止")
+        finally:
+            # 停止过程中再次收到的信号不打断清理，避免留下工作进程
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            self.report()
+            # 同时通知所有工作进程退出，超时后再逐个结束
+            for handle in self.handles:
+                if handle.process is not None and handle.process.is_alive():
+                    handle.process.terminate()
+            deadline = time.monotonic() + 5
+            for handle in self.handles:
+                if handle.process is not None:
+                    handle.process.join(max(deadline - time.monotonic(), 0))
+                self.stop_worker(handle)
+
+    def stop(self):
+        self._stopped.set()
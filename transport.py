@@ -0,0 +1,197 @@
+# -*- coding: UTF-8 –*-
+"""
+共享的HTTP传输层：扫描、配置向导和消息通知复用同一组长连接
+"""
+
+import collections
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+
+class DnsCache:
+    """
+    DNS缓存，避免每次建连都重新解析域名
+
+    只作用于挂载了DnsCacheAdapter的连接池，不修改全局的socket.getaddrinfo；
+    按最近使用淘汰，最多保留max_entries个域名，过期的记录在读取或写入时清除
+    """
+
+    def __init__(self, ttl=300, max_entries=256):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # 连接池和连接类按缓存实例生成，连接建立时通过类属性找到所属的缓存
+        connection_attrs = {"dns_cache": self}
+        self.pool_classes = {
+            "http": type("DnsCacheHTTPConnectionPool", (HTTPConnectionPool,), {
+                "ConnectionCls": type("DnsCacheHTTPConnection", (DnsCacheConnection, HTTPConnection),
+                                      connection_attrs)}),
+            "https": type("DnsCacheHTTPSConnectionPool", (HTTPSConnectionPool,), {
+                "ConnectionCls": type("DnsCacheHTTPSConnection", (DnsCacheConnection, HTTPSConnection),
+                                      connection_attrs)}),
+        }
+
+    def resolve(self, host, port):
+        """
+        :return: 解析出的IP地址列表（保持解析结果的顺序）
+        """
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if cached[0] > now:
+                    self._cache.move_to_end(key)
+                    return cached[1]
+                del self._cache[key]
+        result = socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM)
+        addresses = list(dict.fromkeys(sockaddr[0] for _, _, _, _, sockaddr in result))
+        with self._lock:
+            self._cache[key] = (now + self.ttl, addresses)
+            self._cache.move_to_end(key)
+            if len(self._cache) > self.max_entries:
+                for expired in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+                    del self._cache[expired]
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return addresses
+
+    def evict(self, host, port):
+        with self._lock:
+            self._cache.pop((host, port), None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+class DnsCacheConnection:
+    """
+    urllib3连接的混入类，建连时依次尝试缓存中的地址，全部失败时清除该域名的缓存
+    """
+
+    dns_cache = None
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = self.dns_cache.resolve(host, self.port)
+        except OSError:
+            # 解析失败时交给urllib3按原流程解析，由它抛出对应的异常
+            return super()._new_conn()
+        error = None
+        for address in addresses:
+            # urllib3只用_dns_host建立TCP连接，TLS的SNI和证书校验在连接建立后使用还原的域名
+            self._dns_host = address
+            try:
+                return super()._new_conn()
+            except (ConnectTimeoutError, NewConnectionError) as err:
+                error = err
+            finally:
+                self._dns_host = host
+        self.dns_cache.evict(host, self.port)
+        if error is None:
+            return super()._new_conn()
+        raise error
+
+
+class DnsCacheAdapter(HTTPAdapter):
+    """
+    使用DNS缓存建立连接的HTTPAdapter，HTTP代理的连接池同样生效（socks代理由PySocks自行解析）
+    """
+
+    def __init__(self, dns_cache=None, **kwargs):
+        self.dns_cache = dns_cache
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        if getattr(self, "dns_cache", None) is not None:
+            self.poolmanager.pool_classes_by_scheme = self.dns_cache.pool_classes
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        if self.dns_cache is not None and not proxy.lower().startswith("socks"):
+            manager.pool_classes_by_scheme = self.dns_cache.pool_classes
+        return manager
+
+
+class Transport:
+    """
+    基于requests.Session的连接池
+
+    每个域名维护独立的keep-alive连接池，Apple下发的Cookie在多次扫描之间自动复用
+    """
+
+    def __init__(self, timeout=10, notification_timeout=5, pool_connections=10, pool_maxsize=10, dns_ttl=300,
+                 dns_max_entries=256):
+        self.timeout = timeout
+        self.notification_timeout = notification_timeout
+        self.session = requests.Session()
+        self.dns_cache = DnsCache(dns_ttl, dns_max_entries) if dns_ttl > 0 else None
+        adapter = DnsCacheAdapter(self.dns_cache, pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @staticmethod
+    def from_configs(configs):
+        transport_configs = configs.get("transport", {})
+        return Transport(timeout=transport_configs.get("timeout", 10),
+                         notification_timeout=transport_configs.get("notification_timeout", 5),
+                         pool_connections=transport_configs.get("pool_connections", 10),
+                         pool_maxsize=transport_configs.get("pool_maxsize", 10),
+                         dns_ttl=transport_configs.get("dns_ttl", 300),
+                         dns_max_entries=transport_configs.get("dns_max_entries", 256))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def notify(self, url, **kwargs):
+        """
+        发送通知请求，使用独立的（通常更短的）超时时间
+        """
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.notification_timeout
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_default_transport = None
+_default_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    获取进程内共享的传输层实例
+    """
+    global _default_transport
+    with _default_lock:
+        if _default_transport is None:
+            _default_transport = Transport()
+        return _default_transport
+
+
+def set_transport(transport):
+    global _default_transport
+    with _default_lock:
+        if _default_transport is not None and _default_transport is not transport:
+            _default_transport.close()
+        _default_transport = transport
@@ -0,0 +1,95 @@
+# -*- coding: UTF-8 –*-
+"""
+@Author: LennonChin
+@Contact: i@coderap.com
+@Date: 2021-10-19
+"""
+
+import datetime
+import time
+import hmac
+import hashlib
+import base64
+import urllib.parse
+
+from scan_log import logger
+from transport import get_transport
+
+
+class Utils:
+
+    @staticmethod
+    def time_title(message):
+        return "[{}] {}".format(datetime.datetime.now().strftime('%H:%M:%S'), message)
+
+    @staticmethod
+    def log(message):
+        logger.info(message)
+
+    @staticmethod
+    def send_dingtalk_message(dingtalk_configs, message, **kwargs):
+        if len(dingtalk_configs["access_token"]) == 0 or len(dingtalk_configs["secret_key"]) == 0:
+            return
+
+        timestamp = str(round(time.time() * 1000))
+        secret_enc = dingtalk_configs["secret_key"].encode('utf-8')
+        string_to_sign = '{}\n{}'.format(timestamp, dingtalk_configs["secret_key"])
+        string_to_sign_enc = string_to_sign.encode('utf-8')
+        hmac_code = hmac.new(secret_enc, string_to_sign_enc, digestmod=hashlib.sha256).digest()
+        sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+
+        params = {
+            "access_token": dingtalk_configs["access_token"],
+            "timestamp": timestamp,
+            "sign": sign
+        }
+
+        content = {
+            "msgtype": "text" if "message_type" not in kwargs else kwargs["message_type"],
+            "text": {
+                "content": message
+            }
+        }
+
+        response = get_transport().notify("https://oapi.dingtalk.com/robot/send", headers=headers, params=params, json=content,
+                                          timeout=kwargs.get("timeout"))
+        Utils.log("Dingtalk发送消息状态码：{}".format(response.status_code))
+        return response
+
+    @staticmethod
+    def send_telegram_message(telegram_configs, message, **kwargs):
+        if len(telegram_configs["bot_token"]) == 0 or len(telegram_configs["chat_id"]) == 0:
+            return
+
+        headers = {
+            'Content-Type': 'application/json'
+        }
+
+        proxies = {
+            "https": telegram_configs["http_proxy"],
+        }
+
+        content = {
+            "chat_id": telegram_configs["chat_id"],
+            "text": message
+        }
+
+        url = "https://api.telegram.org/bot{}/sendMessage".format(telegram_configs["bot_token"])
+        response = get_transport().notify(url, headers=headers, proxies=proxies, json=content,
+                                          timeout=kwargs.get("timeout"))
+        Utils.log("Telegram发送消息状态码：{}".format(response.status_code))
+        return response
+
+    @staticmethod
+    def send_bark_message(bark_configs, message, **kwargs):
+        if len(bark_configs["url"]) == 0:
+            return
+
+        url = "{}/{}".format(bark_configs["url"].strip("/"), urllib.parse.quote(message, safe=""))
+        response = get_transport().notify(url, params=bark_configs["query_parameters"], timeout=kwargs.get("timeout"))
+        Utils.log("Bark发送消息状态码：{}".format(response.status_code))
+        return response